@@ -3,7 +3,7 @@ import pandas as pd
 import numpy as np
 import math
 import pyfaidx
-from utils import one_hot
+from utils import one_hot, instrument
 
 
 class PeakGenerator(Sequence):
@@ -17,7 +17,8 @@ class PeakGenerator(Sequence):
         self.peaks = peaks
         self.num_peaks = self.peaks.shape[0]
         self.input_len = input_len
-        self.genome = pyfaidx.Fasta(genome_fasta)
+        # a FASTA path, or an already open genome such as genome_mmap.MmapGenome
+        self.genome = pyfaidx.Fasta(genome_fasta) if isinstance(genome_fasta, str) else genome_fasta
         self.debug_mode = debug_mode
         self.flank_size = self.input_len // 2
         self.batch_size = batch_size
@@ -35,10 +36,12 @@ class PeakGenerator(Sequence):
         cur_entries = self.peaks.iloc[idx*self.batch_size:min([self.num_peaks,(idx+1)*self.batch_size])]
         peak_ids = cur_entries['chr'] + ':' + cur_entries['start'].astype(str) + '-' + cur_entries['end'].astype(str)
 
-        seqs = [self.__get_seq__(x, y, z) for x,y,z in
-                zip(cur_entries.chr, cur_entries.start, cur_entries.summit)]
+        with instrument.stage("fasta_fetch", items=len(cur_entries)):
+            seqs = [self.__get_seq__(x, y, z) for x,y,z in
+                    zip(cur_entries.chr, cur_entries.start, cur_entries.summit)]
 
-        return peak_ids, one_hot.dna_to_one_hot(seqs)
+        with instrument.stage("one_hot", items=len(cur_entries)):
+            return peak_ids, one_hot.dna_to_one_hot(seqs)
     
     def __len__(self):
         return math.ceil(self.num_peaks/self.batch_size)
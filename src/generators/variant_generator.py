@@ -3,7 +3,7 @@ import pandas as pd
 import numpy as np
 import math
 import pyfaidx
-from utils import one_hot
+from utils import one_hot, instrument
 from deeplift.dinuc_shuffle import dinuc_shuffle
 
 
@@ -19,7 +19,8 @@ class VariantGenerator(Sequence):
         self.variants_table = variants_table
         self.num_variants = self.variants_table.shape[0]
         self.input_len = input_len
-        self.genome = pyfaidx.Fasta(genome_fasta)
+        # a FASTA path, or an already open genome such as genome_mmap.MmapGenome
+        self.genome = pyfaidx.Fasta(genome_fasta) if isinstance(genome_fasta, str) else genome_fasta
         self.debug_mode = debug_mode
         self.flank_size = self.input_len // 2
         self.shuf = shuf
@@ -77,18 +78,20 @@ class VariantGenerator(Sequence):
         cur_entries = self.variants_table.iloc[idx*self.batch_size:min([self.num_variants,(idx+1)*self.batch_size])]
         variant_ids = cur_entries['variant_id'].tolist()
 
-        if self.shuf:
-            allele1_seqs, allele2_seqs = zip(*[self.__get_allele_seq__(v, w, x, y, z) for v,w,x,y,z in
-                                             zip(cur_entries.chr, cur_entries.pos,
-                                                 cur_entries.allele1, cur_entries.allele2, cur_entries.random_seed)])
-        else:
-            allele1_seqs, allele2_seqs = zip(*[self.__get_allele_seq__(w, x, y, z) for w,x,y,z in
-                                             zip(cur_entries.chr, cur_entries.pos, cur_entries.allele1, cur_entries.allele2)])
+        with instrument.stage("fasta_fetch", items=len(cur_entries)):
+            if self.shuf:
+                allele1_seqs, allele2_seqs = zip(*[self.__get_allele_seq__(v, w, x, y, z) for v,w,x,y,z in
+                                                 zip(cur_entries.chr, cur_entries.pos,
+                                                     cur_entries.allele1, cur_entries.allele2, cur_entries.random_seed)])
+            else:
+                allele1_seqs, allele2_seqs = zip(*[self.__get_allele_seq__(w, x, y, z) for w,x,y,z in
+                                                 zip(cur_entries.chr, cur_entries.pos, cur_entries.allele1, cur_entries.allele2)])
 
         if self.debug_mode:
             return variant_ids, list(allele1_seqs),list(allele2_seqs)
         else:
-            return variant_ids, one_hot.dna_to_one_hot(list(allele1_seqs)), one_hot.dna_to_one_hot(list(allele2_seqs))
+            with instrument.stage("one_hot", items=len(cur_entries)):
+                return variant_ids, one_hot.dna_to_one_hot(list(allele1_seqs)), one_hot.dna_to_one_hot(list(allele2_seqs))
     
     def __len__(self):
         return math.ceil(self.num_variants/self.batch_size)
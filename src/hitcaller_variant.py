@@ -2,20 +2,30 @@ import numpy as np
 import h5py
 import subprocess
 import argparse
+import concurrent.futures
+import importlib.metadata
+import multiprocessing
 import os
 import pandas as pd
 
 
+# the finemo release whose Python API run_hit_calling_in_process calls
+FINEMO_VERSION = "0.41"
+
+
 def parse_args():
 	parser = argparse.ArgumentParser(description="Runs hit calling on variant-based interpretation data")
 	parser.add_argument("--shap_data", type=str, required=True, help="h5 or npz file containing variant sequences and shap_scores")
-	parser.add_argument("--input_type", type=str, choices=["h5", "npz"], default="h5", help="Whether the input data is in h5 or npz format")
+	parser.add_argument("--input_type", type=str, choices=["h5", "npz"], default="h5", help="Whether the input data is in h5 or npz format. variant_shap.py can write npz directly with --output_format npz")
+	parser.add_argument("--window", type=int, default=100, help="Width of the region around each variant used for hit calling")
 	parser.add_argument("--modisco_h5", type=str, help="Modisco h5 file from relevant experiment")
 	parser.add_argument("--variant_file", type=str, help="variant-scorer style file containing list of variants. Required if you want genomic locations as part of the final report")
 	parser.add_argument("--hits_per_loc", type=int, help="Maximum number of hits to return per sequence per locus")
 	parser.add_argument("--output_dir", type=str, help="Output directory")
 	parser.add_argument("--alpha", type=float, default=0.6, help="Alpha value for hit calling")
 	parser.add_argument("--include_motifs", type=str, help="Include motifs")
+	parser.add_argument("--num_shards", type=int, default=1, help="Split the regions into this many shards and call hits on them concurrently, in a pool of processes or with one finemo CLI run each")
+	parser.add_argument("--use_cli", action="store_true", help="Run the hit caller through the finemo CLI even when finemo %s is importable" % FINEMO_VERSION)
 	args = parser.parse_args()
 	return args
 
@@ -23,49 +33,201 @@ def parse_args():
 def h5_to_npz(args):
 	'''
 	If the input is given as a h5, then this function runs the relevant finemo command to convert it to a npz file
-	Regions of width 100 are extracted, since this should be sufficient for hits containing the central variant
+	Regions of width 100 are extracted by default, since this should be sufficient for hits containing the central variant
 	'''
-	extract_command = ["finemo", "extract-regions-chrombpnet-h5", "-c", args.shap_data, "-w", "100", "-o", os.path.join(args.output_dir, "shap_input.npz")]
+	extract_command = ["finemo", "extract-regions-chrombpnet-h5", "-c", args.shap_data, "-w", str(args.window), "-o", os.path.join(args.output_dir, "shap_input.npz")]
 	subprocess.run(extract_command)
 
-def run_hit_calling(args, npz_file):
+def load_regions(args):
 	'''
-	Runs hit calling given the npz file with input interpretation data
+	Returns the sequences and contributions (regions x 4 x window) for hit calling.
+	For h5 input the central window is read directly, the same way finemo extract-regions-chrombpnet-h5 does
 	'''
-	if args.variant_file is not None:
-		if args.include_motifs is not None:
-			subprocess.run(["finemo", "call-hits", "-r", npz_file, "-m", args.modisco_h5, "-o", args.output_dir, "-b", "256", "-a", str(args.alpha), "-p", os.path.join(args.output_dir, "variant_locs.narrowPeak"), "-I", args.include_motifs, "-N", args.include_motifs])
-		else:
-			subprocess.run(["finemo", "call-hits", "-r", npz_file, "-m", args.modisco_h5, "-o", args.output_dir, "-b", "256", "-a", str(args.alpha), "-p", os.path.join(args.output_dir, "variant_locs.narrowPeak")])
+	if args.input_type == "h5":
+		try:
+			with h5py.File(args.shap_data, "r") as f:
+				seq_len = f["raw"]["seq"].shape[-1]
+				start = seq_len // 2 - args.window // 2
+				sequences = f["raw"]["seq"][:, :, start:start + args.window].astype(np.int8)
+				contributions = f["shap"]["seq"][:, :, start:start + args.window].astype(np.float16)
+			return sequences, contributions
+		except OSError:
+			# older deepdish outputs are blosc-compressed, which plain h5py may not be able to decode
+			h5_to_npz(args)
+			regions = np.load(os.path.join(args.output_dir, "shap_input.npz"))
 	else:
-		if args.include_motifs is not None:
-			subprocess.run(["finemo", "call-hits", "-r", npz_file, "-m", args.modisco_h5, "-o", args.output_dir, "-b", "256", "-a", str(args.alpha), "-I", args.include_motifs, "-N", args.include_motifs])
-		else:
-			subprocess.run(["finemo", "call-hits", "-r", npz_file, "-m", args.modisco_h5, "-o", args.output_dir, "-b", "256", "-a", str(args.alpha)])
+		regions = np.load(args.shap_data)
+	return regions["sequences"], regions["contributions"]
+
+def get_hit_calling_command(args, npz_file, output_dir, peaks_file=None):
+	command = ["finemo", "call-hits", "-r", npz_file, "-m", args.modisco_h5, "-o", output_dir, "-b", "256", "-a", str(args.alpha)]
+	if peaks_file is not None:
+		command += ["-p", peaks_file]
+	if args.include_motifs is not None:
+		command += ["-I", args.include_motifs, "-N", args.include_motifs]
+	return command
+
+def load_finemo():
+	'''
+	Returns True if finemo is importable at the version whose Python API is called below (FINEMO_VERSION).
+	Returns False otherwise, and the CLI is used instead
+	'''
+	try:
+		version = importlib.metadata.version("finemo")
+	except importlib.metadata.PackageNotFoundError:
+		return False
+	if version.split(".")[:2] != FINEMO_VERSION.split("."):
+		print("finemo %s is installed, but the in-process hit caller is written against finemo %s; running the finemo CLI instead" % (version, FINEMO_VERSION))
+		return False
+	return True
+
+def to_pandas(df):
+	# finemo returns polars frames; this avoids needing pyarrow for to_pandas()
+	return pd.DataFrame(df.to_dict(as_series=False))
+
+def call_hits(args, sequences, contributions):
+	'''
+	Runs finemo's hit caller on in-memory regions, with the same settings as get_hit_calling_command, and
+	returns the hits with their QC and motif columns. peak_id is the index into the regions given
+	'''
+	from finemo import data_io, hitcaller
+
+	motifs_include = None
+	motif_name_map = None
+	if args.include_motifs is not None:
+		motifs_include = data_io.load_txt(args.include_motifs)
+		motif_name_map = data_io.load_mapping(args.include_motifs, str)
+	# projected contributions against CWMs, as call-hits' default "pp" mode
+	motifs_df, cwms, trim_masks, _ = data_io.load_modisco_motifs(modisco_h5_path=args.modisco_h5,
+																  trim_coords=None,
+																  trim_thresholds=None,
+																  trim_threshold_default=0.3,
+																  motif_type="cwm",
+																  motifs_include=motifs_include,
+																  motif_name_map=motif_name_map,
+																  motif_lambdas=None,
+																  motif_lambda_default=args.alpha,
+																  include_rc=True)
+	hits, qc = hitcaller.fit_contribs(cwms=cwms,
+									  contribs=contributions,
+									  sequences=sequences,
+									  cwm_trim_mask=trim_masks,
+									  use_hypothetical=False,
+									  lambdas=motifs_df.get_column("lambda").to_numpy(writable=True),
+									  batch_size=256)
+	return to_pandas(hits).merge(to_pandas(qc), on="peak_id").merge(to_pandas(motifs_df), on="motif_id")
+
+def run_hit_calling_in_process(args, sequences, contributions, narrowpeak_df=None):
+	'''
+	Runs finemo's hit caller in this process, or with --num_shards > 1 on contiguous shards in a pool of
+	processes, and returns the hits with the hits.tsv columns used here, in genomic coordinates when the
+	variant locations are known
+	'''
+	if args.num_shards == 1:
+		hits = call_hits(args, sequences, contributions)
+	else:
+		shard_bounds = np.linspace(0, len(sequences), args.num_shards + 1).astype(int)
+		# spawned, so the workers do not inherit a torch or CUDA state from this process
+		with concurrent.futures.ProcessPoolExecutor(args.num_shards, mp_context=multiprocessing.get_context("spawn")) as pool:
+			futures = [pool.submit(call_hits, args, sequences[start:end], contributions[start:end])
+					   for start, end in zip(shard_bounds[:-1], shard_bounds[1:])]
+			shard_hits = [future.result() for future in futures]
+		for start, hits in zip(shard_bounds, shard_hits):
+			hits["peak_id"] = hits["peak_id"] + start
+		hits = pd.concat(shard_hits, ignore_index=True)
+
+	# regions are centred on the variant, as finemo's narrowPeak loading does with the summit column,
+	# and hits are placed in them as finemo 0.41's write_hits does
+	if narrowpeak_df is not None:
+		hits["chr"] = narrowpeak_df.iloc[:, 0].to_numpy()[hits["peak_id"].to_numpy()]
+		region_start = (narrowpeak_df.iloc[:, 1].astype(np.int64) + narrowpeak_df.iloc[:, 9].astype(np.int64)).to_numpy() - args.window // 2
+		region_start = region_start[hits["peak_id"].to_numpy()]
+	else:
+		hits["chr"] = "NA"
+		region_start = 0
+	hits_df = pd.DataFrame({"chr": hits["chr"],
+							"start": region_start + hits["hit_start"] + hits["motif_start"],
+							"end": region_start + hits["hit_start"] + hits["motif_end"],
+							"motif_name": hits["motif_name"],
+							"hit_coefficient": hits["hit_coefficient"],
+							"hit_coefficient_global": hits["hit_coefficient"] * hits["global_scale"] ** 2,
+							"hit_correlation": hits["hit_similarity"],
+							"hit_importance": hits["hit_importance"] * hits["global_scale"],
+							"strand": hits["strand"],
+							"peak_id": hits["peak_id"].astype(np.int64)})
+	hits_df = hits_df.sort_values(["peak_id", "start"], kind="stable", ignore_index=True)
+	hits_df.to_csv(os.path.join(args.output_dir, "hits.tsv"), sep="\t", index=False)
+	return hits_df
+
+def run_hit_calling(args, npz_file, narrowpeak_df=None):
+	'''
+	Runs hit calling given the npz file with input interpretation data
+	'''
+	peaks_file = None
+	if narrowpeak_df is not None:
+		peaks_file = os.path.join(args.output_dir, "variant_locs.narrowPeak")
+		narrowpeak_df.to_csv(peaks_file, sep="\t", header=False, index=False)
+	subprocess.run(get_hit_calling_command(args, npz_file, args.output_dir, peaks_file), check=True)
+	return pd.read_csv(os.path.join(args.output_dir, "hits.tsv"), sep="\t")
 
-def parse_hit_calls(args):
+def run_sharded_hit_calling(args, sequences, contributions, narrowpeak_df=None):
 	'''
-	Given an output file from the hit caller, identifies hits containing the central variant and returns the top n hits per sequence
+	Splits the regions into contiguous shards, runs the hit caller on all shards concurrently and
+	merges the hits, shifting peak_id back to the index in the full region list
 	'''
-	hits_file = os.path.join(args.output_dir, "hits.tsv")
-	hits_df = pd.read_csv(hits_file, sep="\t")
-	# print(hits_df.head())
+	shard_bounds = np.linspace(0, len(sequences), args.num_shards + 1).astype(int)
+	processes = []
+	for shard in range(args.num_shards):
+		start, end = shard_bounds[shard], shard_bounds[shard + 1]
+		if args.num_shards == 1:
+			shard_dir = args.output_dir
+		else:
+			shard_dir = os.path.join(args.output_dir, "shard_%d" % shard)
+			os.makedirs(shard_dir, exist_ok=True)
+		shard_npz = os.path.join(shard_dir, "shap_input.npz")
+		np.savez(shard_npz, sequences=sequences[start:end], contributions=contributions[start:end])
+		peaks_file = None
+		if narrowpeak_df is not None:
+			peaks_file = os.path.join(shard_dir, "variant_locs.narrowPeak")
+			narrowpeak_df.iloc[start:end].to_csv(peaks_file, sep="\t", header=False, index=False)
+		command = get_hit_calling_command(args, shard_npz, shard_dir, peaks_file)
+		processes.append((shard, start, shard_dir, command, subprocess.Popen(command)))
 
+	shard_hits = []
+	for shard, start, shard_dir, command, process in processes:
+		# a failed shard would leave no hits.tsv, or a stale one from an earlier run
+		if process.wait() != 0:
+			raise RuntimeError("hit calling failed for shard %d: %s" % (shard, " ".join(command)))
+		hits_df = pd.read_csv(os.path.join(shard_dir, "hits.tsv"), sep="\t")
+		hits_df["peak_id"] = hits_df["peak_id"] + start
+		shard_hits.append(hits_df)
+	hits_df = pd.concat(shard_hits, ignore_index=True)
+	if args.num_shards > 1:
+		hits_df.to_csv(os.path.join(args.output_dir, "hits.tsv"), sep="\t", index=False)
+	return hits_df
+
+def parse_hit_calls(args, hits_df):
+	'''
+	Given the hits from the hit caller, identifies hits containing the central variant and returns the top n hits per sequence
+	'''
 	#Define location of variants to identify correct hits
 	if args.variant_file is not None:
 		variant_table = pd.read_csv(args.variant_file, sep="\t", header=None)
 		hits_df["variant_loc"] = variant_table.loc[(hits_df["peak_id"] % len(variant_table)).astype(int), 1].values
 		print(hits_df.head())
 	else:
-		hits_df["variant_loc"] = [50] * len(hits_df)
+		hits_df["variant_loc"] = args.window // 2
 
-	variant_hits = hits_df.loc[(hits_df["start"] <= hits_df["variant_loc"]) & (hits_df["end"] >= hits_df["variant_loc"])].copy()
-	variant_hits["inv_coeff"] = -1 * variant_hits["hit_coefficient"]
+	variant_hits = hits_df.loc[(hits_df["start"] <= hits_df["variant_loc"]) & (hits_df["end"] >= hits_df["variant_loc"])]
 	print()
 	print(variant_hits.head())
-	variant_hits = variant_hits.sort_values(["peak_id", "inv_coeff"]).groupby("peak_id").head(args.hits_per_loc)
+	variant_hits = variant_hits.sort_values(["peak_id", "hit_coefficient"], ascending=[True, False], kind="stable")
+	if args.hits_per_loc is not None:
+		variant_hits = variant_hits.groupby("peak_id", sort=False).head(args.hits_per_loc)
+	variant_hits = variant_hits.copy()
 	if args.variant_file is not None:
-		variant_hits['allele'] = variant_hits['peak_id'].apply(lambda x: "allele2" if x > len(variant_table) else "allele1")
+		# regions are all allele1 sequences followed by all allele2 sequences
+		variant_hits['allele'] = np.where(variant_hits['peak_id'] >= len(variant_table), "allele2", "allele1")
 	else:
 		variant_hits['allele'] = "N/A"
 	variant_out_final = variant_hits[["peak_id", "chr", "start", "end", "motif_name", "allele",
@@ -82,32 +244,31 @@ def variant_file_to_narrowpeak(args):
                       ["."] * len(variant_table), ["."] * len(variant_table), ["."] * len(variant_table), ["."] * len(variant_table),
                       ["."] * len(variant_table), ["."] * len(variant_table), [1] * len(variant_table)]
 	narrowpeak_df = pd.DataFrame(narrowpeak_raw_data).T
-	narrowpeak_df = pd.concat([narrowpeak_df, narrowpeak_df])
-
-	narrowpeak_df.to_csv(os.path.join(args.output_dir, "variant_locs.narrowPeak"), sep="\t", header=False, index=False)
-	return narrowpeak_df
+	# allele1 regions followed by allele2 regions
+	return pd.concat([narrowpeak_df, narrowpeak_df], ignore_index=True)
 
 
 def main():
 
-	#Produce npz file if it does not already exist
 	args = parse_args()
-	if args.input_type == "npz":
-		npz_file = args.shap_data
-	elif args.input_type == "h5":
-		h5_to_npz(args)
-		npz_file = os.path.join(args.output_dir, "shap_input.npz")
 
-	#Produce narrowpeak file if desired
+	#Variant locations, for genomic coordinates in the hits
+	narrowpeak_df = None
 	if args.variant_file is not None:
-		npeak = variant_file_to_narrowpeak(args)
+		narrowpeak_df = variant_file_to_narrowpeak(args)
 
-	#Run the hit caller and save the results
-	run_hit_calling(args, npz_file)
-	output_df = parse_hit_calls(args)
+	#Run the hit caller and save the results; in-process finemo needs no npz, narrowPeak or hits.tsv round trip
+	if not args.use_cli and load_finemo():
+		sequences, contributions = load_regions(args)
+		hits_df = run_hit_calling_in_process(args, sequences, contributions, narrowpeak_df)
+	elif args.input_type == "npz" and args.num_shards == 1:
+		hits_df = run_hit_calling(args, args.shap_data, narrowpeak_df)
+	else:
+		sequences, contributions = load_regions(args)
+		hits_df = run_sharded_hit_calling(args, sequences, contributions, narrowpeak_df)
+	output_df = parse_hit_calls(args, hits_df)
 	output_df.to_csv(os.path.join(args.output_dir, "variant_hit_calls.tsv"), sep="\t", header=True, index=False)
 
 
 if __name__ == "__main__":
 	main()
-
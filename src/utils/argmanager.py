@@ -1,4 +1,15 @@
 import argparse
+import os
+
+
+def batch_size(value):
+    # a positive integer, or "auto" to calibrate it on the first batches (see utils/autobatch.py)
+    if value == "auto":
+        return value
+    value = int(value)
+    if value < 1:
+        raise ValueError("batch size must be positive")
+    return value
 
 
 def update_scoring_args(parser):
@@ -12,8 +23,10 @@ def update_scoring_args(parser):
     parser.add_argument("-b", "--bias", type=str, help="Bias model to use for variant scoring")
     parser.add_argument("-li", "--lite", action='store_true', help="Models were trained with chrombpnet-lite")
     parser.add_argument("-dm", "--debug_mode", action='store_true', help="Display allele input sequences")
-    parser.add_argument("-bs", "--batch_size", type=int, default=512, help="Batch size to use for the model")
-    parser.add_argument("-sc", "--schema", type=str, choices=['bed', 'plink', 'chrombpnet', 'original'], default='chrombpnet', help="Format for the input variants list")
+    parser.add_argument("-bs", "--batch_size", type=batch_size, default=512, help="Batch size to use for the model, or auto to pick the fastest size that fits in memory from a short calibration on the first variants. Out-of-memory batches are retried at half the size")
+    parser.add_argument("-sc", "--schema", type=str, choices=['bed', 'plink', 'plink2', 'chrombpnet', 'original', 'vcf'], default='chrombpnet', help="Format for the input variants list. Plain, gzip or bgzip")
+    parser.add_argument("-cs", "--chunk_size", type=int, help="Read and score the variants list in chunks of this many records, appending to the outputs. Without --shuffled_scores the null is built from the first chunk (variant_scoring.py only)")
+    parser.add_argument("-rg", "--region", type=str, help="Only score variants in these tabix regions (chr, chr:start-end, comma-separated). Needs a bgzip list with a tabix index")
     parser.add_argument("-p", "--peaks", type=str, help="Bed file containing peak regions")
     parser.add_argument("-n", "--num_shuf", type=int, default=10, help="Number of shuffled scores per SNP")
     parser.add_argument("-t", "--total_shuf", type=int, help="Total number of shuffled scores across all SNPs. Overrides --num_shuf")
@@ -23,33 +36,108 @@ def update_scoring_args(parser):
     parser.add_argument("--no_hdf5", action='store_true', help="Do not save detailed predictions in hdf5 file")
     parser.add_argument("-nc", "--num_chunks", type=int, default=10, help="Number of chunks to divide SNP file into")
     parser.add_argument("-fo", "--forward_only", action='store_true', help="Run variant scoring only on forward sequence")
+    parser.add_argument("-pm", "--predict_mode", type=str, choices=['compiled', 'xla', 'predict'], default='compiled', help="Run the model as a tf.function with a fixed batch size (compiled), additionally XLA-compiled (xla), or through keras model.predict (predict)")
+    parser.add_argument("-co", "--counts_only", action='store_true', help="Only run the counts head of the model. Scores logfc and quantiles, without jsd or saved profiles")
+    parser.add_argument("-gh", "--scoring_head", action='store_true', help="Compute counts, logfc, jsd and indel-adjusted jsd on the TF graph in one call per batch. Profiles are only copied back when they are saved to hdf5")
+    parser.add_argument("-q", "--quantize", type=str, choices=['int8', 'float16'], help="Run a TFLite version of the model with dynamic-range int8 or float16 weights. Cached in --model_cache when given")
+    parser.add_argument("-qr", "--quantization_report", type=int, default=1000, help="With --quantize, compare logfc, jsd and their p-values against the float32 model on this many variants first. 0 skips the report")
+    parser.add_argument("-tt", "--tflite_threads", type=int, help="Number of threads for the TFLite interpreter. Defaults to all cores")
+    parser.add_argument("-mc", "--model_cache", type=str, default=os.environ.get("VARIANT_SCORER_MODEL_CACHE"), help="Directory of traced model artifacts keyed by the model file's sha256. Built on first use and loaded automatically afterwards. Defaults to $VARIANT_SCORER_MODEL_CACHE")
+    parser.add_argument("-vc", "--variant_cache", type=str, default=os.environ.get("VARIANT_SCORER_VARIANT_CACHE"), help="Directory of prepared (parsed, compacted and validated) variant tables keyed by the list's sha256 and the validation settings. Defaults to $VARIANT_SCORER_VARIANT_CACHE")
     parser.add_argument("-st", "--shap_type",  nargs='+', default=["counts"])
     parser.add_argument("-sh", "--shuffled_scores", type=str, help="Pre-computed shuffled scores")
+    parser.add_argument("-nw", "--num_workers", type=int, default=1, help="Number of inference worker processes, each pinned to its own cores with its own copy of the model and reading a shared memory-mapped genome")
+    parser.add_argument("-tpw", "--threads_per_worker", type=int, help="TF/OpenMP threads per inference worker. Defaults to the number of cores divided by --num_workers")
+    parser.add_argument("-pc", "--prediction_cache", type=str, default=os.environ.get("VARIANT_SCORER_PREDICTION_CACHE"), help="Directory of a persistent prediction cache keyed by the model, genome, input length, --forward_only and the variant's chr, pos and alleles. Only variants not in the cache are predicted. Not used with --scoring_head. Defaults to $VARIANT_SCORER_PREDICTION_CACHE")
+    parser.add_argument("-pcs", "--prediction_cache_size", type=float, default=50, help="Size bound of the prediction cache in GB. Least recently used entries are evicted beyond it")
+    parser.add_argument("-pb", "--profile_budget", type=float, help="Memory budget in GB for predicted profiles. Beyond it the profiles are written batch by batch to memory-mapped files in --scratch_dir and read back in chunks. Defaults to half the physical memory")
+    parser.add_argument("-sd", "--scratch_dir", type=str, help="Directory for memory-mapped profiles. Defaults to the temp directory")
+    parser.add_argument("-ix", "--index", action='store_true', help="Also write the scores as a coordinate-sorted bgzip file with a tabix index and a variant_id index ([OUT_PREFIX].variant_scores.tsv.gz). variant_scoring.per_chrom.py merges all chromosomes into one")
+    parser.add_argument("-u", "--update", action='store_true', help="Only score variants (by chr, pos, allele1, allele2) missing from the existing outputs at --out_prefix, against the same null and peaks, and rewrite the outputs merged in list order")
 
 def fetch_scoring_args():
     parser = argparse.ArgumentParser()
     update_scoring_args(parser)
     args = parser.parse_args()
+    if args.update and args.chunk_size:
+        parser.error("--update merges with the whole prior table and can't be combined with --chunk_size")
+    if args.update and args.debug_mode:
+        parser.error("--update can't be combined with --debug_mode")
+    print(args)
+    return args
+
+def update_server_args(parser):
+    parser.add_argument("-m", "--model", type=str, nargs='+', required=True, help="ChromBPNet model(s) to serve, as path or name=path. Names default to the file name without .h5")
+    parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta")
+    parser.add_argument("-pg", "--peak_genome", type=str, help="Genome fasta for peaks")
+    parser.add_argument("-s", "--chrom_sizes", type=str, required=True, help="Path to TSV file with chromosome sizes")
+    parser.add_argument("-ps", "--peak_chrom_sizes", type=str, help="Path to TSV file with chromosome sizes for peak genome")
+    parser.add_argument("-p", "--peaks", type=str, help="Bed file containing peak regions. Scored once per model at startup")
+    parser.add_argument("-mp", "--max_peaks", type=int, help="Maximum number of peaks to use for peak percentile calculation")
+    parser.add_argument("-nl", "--null", type=str, nargs='+', help="Shuffled scores (variant_scores.shuffled.tsv) to compute p-values from, one per model in --model order")
+    parser.add_argument("-li", "--lite", action='store_true', help="Models were trained with chrombpnet-lite")
+    parser.add_argument("-bs", "--batch_size", type=int, default=512, help="Batch size to use for the model")
+    parser.add_argument("-fo", "--forward_only", action='store_true', help="Run variant scoring only on forward sequence")
+    parser.add_argument("-pm", "--predict_mode", type=str, choices=['compiled', 'xla', 'predict'], default='compiled', help="Run the model as a tf.function with a fixed batch size (compiled), additionally XLA-compiled (xla), or through keras model.predict (predict)")
+    parser.add_argument("-co", "--counts_only", action='store_true', help="Only run the counts head of the model. Scores logfc and quantiles, without jsd")
+    parser.add_argument("-gh", "--scoring_head", action='store_true', help="Compute counts, logfc, jsd and indel-adjusted jsd on the TF graph in one call per batch")
+    parser.add_argument("-q", "--quantize", type=str, choices=['int8', 'float16'], help="Serve a TFLite version of the model with dynamic-range int8 or float16 weights")
+    parser.add_argument("-tt", "--tflite_threads", type=int, help="Number of threads for the TFLite interpreter. Defaults to all cores")
+    parser.add_argument("-mc", "--model_cache", type=str, default=os.environ.get("VARIANT_SCORER_MODEL_CACHE"), help="Directory of traced model artifacts keyed by the model file's sha256. Defaults to $VARIANT_SCORER_MODEL_CACHE")
+    parser.add_argument("-pc", "--prediction_cache", type=str, default=os.environ.get("VARIANT_SCORER_PREDICTION_CACHE"), help="Directory of a persistent prediction cache keyed by the model, genome, input length, --forward_only and the variant's chr, pos and alleles. Only variants not in the cache are predicted. Not used with --scoring_head. Defaults to $VARIANT_SCORER_PREDICTION_CACHE")
+    parser.add_argument("-pcs", "--prediction_cache_size", type=float, default=50, help="Size bound of the prediction cache in GB. Least recently used entries are evicted beyond it")
+    parser.add_argument("-r", "--random_seed", type=int, default=1234, help="Random seed for reproducibility when sampling peaks")
+    parser.add_argument("-H", "--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-P", "--port", type=int, default=8642, help="Port to listen on")
+    parser.add_argument("-us", "--unix_socket", type=str, help="Listen on this Unix socket instead of --host/--port")
+    parser.add_argument("-ml", "--max_latency_ms", type=float, default=20, help="How long the first request of a micro-batch waits for others to join it")
+    parser.add_argument("-mb", "--max_batch", type=int, help="Maximum number of variants per micro-batch. Defaults to --batch_size")
+
+def fetch_server_args():
+    parser = argparse.ArgumentParser()
+    update_server_args(parser)
+    args = parser.parse_args()
+    if args.null is not None and len(args.null) != len(args.model):
+        parser.error("--null needs one shuffled score file per model")
+    if args.max_batch is None:
+        args.max_batch = args.batch_size
     print(args)
     return args
 
 def update_shap_args(parser):
-    parser.add_argument("-l", "--list", type=str, required=True, help="a TSV file containing a list of variants to score")
+    parser.add_argument("-l", "--list", type=str, help="a TSV file containing a list of variants to score. Required unless --score_file is given")
     parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta")
-    parser.add_argument("-m", "--model", type=str, required=True, help="ChromBPNet model to use for variant scoring")
+    parser.add_argument("-m", "--model", type=str, nargs='+', required=True, help="ChromBPNet model(s) to use for variant scoring. With several models (e.g. folds) the mean attribution is written")
     parser.add_argument("-o", "--out_prefix", type=str, required=True, help="Path to storing snp effect score predictions from the script, directory should already exist")
     parser.add_argument("-s", "--chrom_sizes", type=str, required=True, help="Path to TSV file with chromosome sizes")
     parser.add_argument("-li", "--lite", action='store_true', help="Models were trained with chrombpnet-lite")
     parser.add_argument("-dm", "--debug_mode", action='store_true', help="Display allele input sequences")
-    parser.add_argument("-bs", "--batch_size", type=int, default=10000, help="Batch size to use for the model")
-    parser.add_argument("-sc", "--schema", type=str, choices=['bed', 'plink', 'chrombpnet', 'original'], default='chrombpnet', help="Format for the input variants list")
+    parser.add_argument("-bs", "--batch_size", type=batch_size, default=10000, help="Number of variants extracted per batch. With auto, batches of 10000 are explained in chunks whose size is calibrated on the first batch, and out-of-memory chunks are retried at half the size")
+    parser.add_argument("-sc", "--schema", type=str, choices=['bed', 'plink', 'plink2', 'chrombpnet', 'original', 'vcf'], default='chrombpnet', help="Format for the input variants list. Plain, gzip or bgzip")
     parser.add_argument("-c", "--chrom", type=str, help="Only score SNPs in selected chromosome")
     parser.add_argument("-st", "--shap_type",  nargs='+', default=["counts"])
+    parser.add_argument("-w", "--shap_window", type=int, help="Only store SHAP values for this many bp centred on the variant")
+    parser.add_argument("-of", "--output_format", type=str, choices=['h5', 'npz'], default='h5', help="Write h5 (raw/shap/projected_shap) or finemo-ready npz (regions x 4 x width) output")
+    parser.add_argument("-sf", "--score_file", type=str, help="variant_scoring.py or variant_summary_across_folds.py output to select variants from instead of --list")
+    parser.add_argument("-sel", "--select_by", type=str, help="Score column used to select variants from --score_file, e.g. abs_logfc_x_jsd or jsd.pval")
+    parser.add_argument("-k", "--top_k", type=int, help="Keep the top K variants by --select_by (smallest first for p-value columns)")
+    parser.add_argument("-smin", "--select_min", type=float, help="Keep variants with --select_by >= this value")
+    parser.add_argument("-smax", "--select_max", type=float, help="Keep variants with --select_by <= this value")
+    parser.add_argument("-pc", "--per_chrom", action='store_true', help="Apply --top_k within each chromosome")
+    parser.add_argument("-at", "--attribution", type=str, choices=['deepshap', 'grad_x_input', 'integrated_gradients'], default='deepshap', help="Attribution method. The gradient methods are much faster than DeepSHAP and are meant for screening")
+    parser.add_argument("-is", "--ig_steps", type=int, default=10, help="Number of integration steps for --attribution integrated_gradients")
+    parser.add_argument("-svf", "--save_folds", action='store_true', help="With several models, also write each model's attributions as <type>.fold_<i>")
+    parser.add_argument("-nw", "--num_workers", type=int, default=1, help="Number of worker processes, each explaining --batch_size chunks of variants with its own copy of the model(s)")
+    parser.add_argument("-tpw", "--threads_per_worker", type=int, help="TF/OpenMP threads per worker. Defaults to the number of cores divided by --num_workers")
     
 def fetch_shap_args():
     parser = argparse.ArgumentParser()
     update_shap_args(parser)
     args = parser.parse_args()
+    if args.list is None and args.score_file is None:
+        parser.error("one of --list or --score_file is required")
+    if args.score_file is not None and args.select_by is None:
+        parser.error("--score_file requires --select_by")
     print(args)
     return args
 
@@ -57,7 +145,7 @@ def update_variant_summary_args(parser):
     parser.add_argument("-sd", "--score_dir", type=str, required=True, help="Path to directory with variant scores that will be used to generate summary")
     parser.add_argument("-sl", "--score_list",  nargs='+', required=True, help="Names of variant score files that will be used to generate summary")
     parser.add_argument("-o", "--out_prefix", type=str, required=True, help="Path prefix for storing the summary file with average scores across folds; directory should already exist")
-    parser.add_argument("-sc", "--schema", type=str, required=True, choices=['bed', 'plink', 'plink2', 'chrombpnet', 'original'], default='chrombpnet', help="Format for the input variants list")
+    parser.add_argument("-sc", "--schema", type=str, required=True, choices=['bed', 'plink', 'plink2', 'chrombpnet', 'original', 'vcf'], default='chrombpnet', help="Format for the input variants list")
 
 def fetch_variant_summary_args():
     parser = argparse.ArgumentParser()
@@ -66,12 +154,32 @@ def fetch_variant_summary_args():
     print(args)
     return args
 
+def update_store_args(parser):
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Merge score tables (e.g. the per-chrom outputs) into one indexed score store")
+    build.add_argument("-i", "--inputs", type=str, nargs='+', required=True, help="Score tables (variant_scores.tsv) or stores to merge")
+    build.add_argument("-o", "--out", type=str, required=True, help="Path of the store, ending in .tsv.gz")
+    query = subparsers.add_parser("query", help="Fetch score rows from an indexed score store by region or variant_id")
+    query.add_argument("-i", "--store", type=str, required=True, help="Indexed score store (variant_scores.tsv.gz)")
+    query.add_argument("-rg", "--region", type=str, nargs='+', help="Tabix regions (chr, chr:start-end)")
+    query.add_argument("-id", "--variant_id", type=str, nargs='+', help="Variant ids")
+    query.add_argument("-if", "--variant_id_file", type=str, help="File with one variant id per line")
+    query.add_argument("-o", "--out", type=str, help="Output TSV. Defaults to stdout")
+
+def fetch_store_args():
+    parser = argparse.ArgumentParser()
+    update_store_args(parser)
+    args = parser.parse_args()
+    if args.command == "query" and not (args.region or args.variant_id or args.variant_id_file):
+        parser.error("query needs --region, --variant_id or --variant_id_file")
+    return args
+
 def update_variant_annotation_args(parser):
     parser.add_argument("-l", "--list", type=str, required=True, help="a TSV file containing a list of variants to annotate")
     parser.add_argument("-o", "--out_prefix", type=str, required=True, help="Path prefix for storing the annotated file; directory should already exist")
     parser.add_argument("-p", "--peaks", type=str, help="Bed file containing peak regions")
     parser.add_argument("-ge", "--genes", type=str, help="Bed file containing gene regions")
-    parser.add_argument("-sc", "--schema", type=str, required=True, choices=['bed', 'plink', 'plink2', 'chrombpnet', 'original'], default='chrombpnet', help="Format for the input variants list")
+    parser.add_argument("-sc", "--schema", type=str, required=True, choices=['bed', 'plink', 'plink2', 'chrombpnet', 'original', 'vcf'], default='chrombpnet', help="Format for the input variants list")
 
 def fetch_variant_annotation_args():
     parser = argparse.ArgumentParser()
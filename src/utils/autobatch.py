@@ -0,0 +1,201 @@
+"""
+Automatic batch size tuning with out-of-memory back-off.
+
+--batch_size auto replaces a fixed batch size with a short calibration on
+real sequences from the list being scored: each candidate size in turn is
+run a few times (after a warm-up call, so tracing is not timed) and the
+throughput and peak RSS are recorded. Growing stops at the first candidate
+that runs out of memory, pushes peak RSS past MEMORY_CEILING (80% of
+physical memory) or is slower than the best so far, and the smallest size
+within 5% of the best throughput is chosen. The curve and the choice are
+printed, and kept in `curves` for the benchmark. Calibration runs once per
+model and settings in a process, so the shuffled, observed and
+per-chromosome fetches share it.
+
+    batch_size = autobatch.resolve_for_predictions("auto", model, lambda: autobatch.variant_sample(variants_table, input_len, genome_fasta))
+    runner = autobatch.get_runner(model, batch_size)
+
+The scoring head of fetch_variant_scores runs both alleles (and their
+reverse complements) in one call, so resolve_for_scoring calibrates the
+head itself rather than the single-sequence runner.
+
+BackoffRunner wraps a prediction runner: when a batch raises
+ResourceExhaustedError (or MemoryError), the batch size is halved and the
+same batch is run again, so no progress is lost. BackoffHead does the same
+for the scoring head, scoring the batch in slices of the smaller size. The
+prediction fetchers (fetch_variant_predictions, fetch_variant_scores,
+fetch_peak_predictions) and fetch_shap (which tunes its explainer chunk
+size) share this logic.
+"""
+
+import time
+
+import numpy as np
+
+from utils import instrument
+
+
+AUTO = "auto"
+PREDICT_CANDIDATES = [32, 64, 128, 256, 512, 1024, 2048, 4096]
+SHAP_CANDIDATES = [16, 32, 64, 128, 256, 512]
+CALIBRATION_REPEATS = 2
+THROUGHPUT_TOLERANCE = 0.05
+MEMORY_CEILING = 0.8
+
+calibrated = {}
+curves = {}
+
+
+def memory_ceiling_mb():
+    from utils.profile_store import physical_memory
+    return MEMORY_CEILING * physical_memory() / 1024 / 1024
+
+
+def is_oom(error):
+    import tensorflow as tf
+    return isinstance(error, (tf.errors.ResourceExhaustedError, MemoryError))
+
+
+def calibrate(run, sample, candidates, ceiling_mb=None, repeats=CALIBRATION_REPEATS):
+    # (chosen size, [{batch_size, items_per_sec, peak_rss_mb}, ...]) from timing run() on tiled real sequences
+    ceiling_mb = ceiling_mb if ceiling_mb is not None else memory_ceiling_mb()
+    curve = []
+    for batch_size in candidates:
+        seqs = np.resize(sample, (batch_size,) + sample.shape[1:])
+        try:
+            run(seqs)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                run(seqs)
+            seconds = time.perf_counter() - start
+        except Exception as e:
+            if not is_oom(e):
+                raise
+            print("batch size %d ran out of memory" % batch_size)
+            break
+        rss_mb = instrument.peak_rss_mb()
+        if rss_mb > ceiling_mb:
+            print("batch size %d went past the memory ceiling (%.0f MB)" % (batch_size, ceiling_mb))
+            break
+        curve.append({'batch_size': batch_size, 'items_per_sec': batch_size * repeats / seconds, 'peak_rss_mb': rss_mb})
+        print("batch size %6d: %10.1f items/s, peak RSS %.0f MB" % (batch_size, curve[-1]['items_per_sec'], rss_mb))
+        if len(curve) > 1 and curve[-1]['items_per_sec'] < max(x['items_per_sec'] for x in curve[:-1]):
+            break
+    if not curve:
+        raise MemoryError("no batch size in %s fits in memory" % candidates)
+    best = max(x['items_per_sec'] for x in curve)
+    chosen = min(x['batch_size'] for x in curve if x['items_per_sec'] >= (1 - THROUGHPUT_TOLERANCE) * best)
+    print("chose batch size", chosen)
+    return chosen, curve
+
+
+def resolve(batch_size, key, run, get_sample, candidates, repeats=CALIBRATION_REPEATS):
+    # a fixed batch size is returned as is; "auto" is calibrated once per key
+    if batch_size != AUTO:
+        return batch_size
+    if key not in calibrated:
+        with instrument.stage("autobatch.calibrate"):
+            calibrated[key], curves[key] = calibrate(run, get_sample(), candidates, repeats=repeats)
+    return calibrated[key]
+
+
+def resolve_for_predictions(batch_size, model, get_sample, lite=False, predict_mode="compiled", counts_only=False):
+    from utils import inference
+
+    key = ('predict', id(model), lite, predict_mode, counts_only)
+    run = lambda seqs: inference.get_runner(model, len(seqs), lite=lite, predict_mode=predict_mode, counts_only=counts_only)(seqs)
+    return resolve(batch_size, key, run, get_sample, PREDICT_CANDIDATES)
+
+
+def resolve_for_scoring(batch_size, model, get_sample, lite=False, forward_only=False, return_profiles=False,
+                        predict_mode="compiled"):
+    # the scoring head runs 2 or 4 sequences per variant, so it is calibrated on its own
+    from utils import inference
+
+    def run(seqs):
+        lengths = np.ones(len(seqs), dtype=int)
+        inference.get_scoring_head(model, len(seqs), lite=lite, forward_only=forward_only, return_profiles=return_profiles,
+                                   predict_mode=predict_mode)(seqs, seqs, lengths, lengths)
+
+    key = ('score', id(model), lite, forward_only, return_profiles, predict_mode)
+    return resolve(batch_size, key, run, get_sample, PREDICT_CANDIDATES)
+
+
+def variant_sample(variants_table, input_len, genome_fasta, num_variants=PREDICT_CANDIDATES[-1]):
+    from generators.variant_generator import VariantGenerator
+
+    sample = variants_table.head(num_variants)
+    return VariantGenerator(sample, input_len, genome_fasta, batch_size=len(sample))[0][1]
+
+
+def peak_sample(peaks, input_len, genome_fasta, num_peaks=PREDICT_CANDIDATES[-1]):
+    from generators.peak_generator import PeakGenerator
+
+    sample = peaks.head(num_peaks)
+    return PeakGenerator(sample, input_len, genome_fasta, batch_size=len(sample))[0][1]
+
+
+class BackoffRunner:
+    def __init__(self, make_runner, batch_size):
+        self.make_runner = make_runner
+        self.batch_size = batch_size
+        self.runner = make_runner(batch_size)
+
+    def back_off(self, error):
+        if not is_oom(error) or self.batch_size == 1:
+            raise error
+        self.batch_size = max(1, self.batch_size // 2)
+        print("out of memory, retrying the batch with batch size", self.batch_size)
+        self.runner = self.make_runner(self.batch_size)
+
+    def __call__(self, seqs):
+        while True:
+            try:
+                return self.runner(seqs)
+            except Exception as e:
+                self.back_off(e)
+
+
+class BackoffHead(BackoffRunner):
+    # the scoring head takes at most its batch size, so after backing off a batch is scored in slices
+    def __call__(self, *inputs):
+        n = len(inputs[0])
+        outputs = []
+        start = 0
+        while start < n:
+            stop = min(n, start + self.batch_size)
+            try:
+                outputs.append(self.runner(*[x[start:stop] for x in inputs]))
+            except Exception as e:
+                self.back_off(e)
+                continue
+            start = stop
+        return {k: np.concatenate([x[k] for x in outputs]) for k in outputs[0]}
+
+
+runners = {}
+
+def get_runner(model, batch_size, lite=False, predict_mode="compiled", counts_only=False):
+    # kept per model and settings like inference.get_runner, so a size backed off from stays backed off from
+    from utils import inference
+
+    key = (id(model), batch_size, lite, predict_mode, counts_only)
+    if key not in runners or runners[key][0] is not model:
+        runners[key] = (model, BackoffRunner(lambda b: inference.get_runner(model, b, lite=lite, predict_mode=predict_mode,
+                                                                           counts_only=counts_only),
+                                             batch_size))
+    return runners[key][1]
+
+
+heads = {}
+
+def get_scoring_head(model, batch_size, lite=False, forward_only=False, return_profiles=False, predict_mode="compiled"):
+    from utils import inference
+
+    key = (id(model), batch_size, lite, forward_only, return_profiles, predict_mode)
+    if key not in heads or heads[key][0] is not model:
+        heads[key] = (model, BackoffHead(lambda b: inference.get_scoring_head(model, b, lite=lite, forward_only=forward_only,
+                                                                             return_profiles=return_profiles,
+                                                                             predict_mode=predict_mode),
+                                         batch_size))
+    return heads[key][1]
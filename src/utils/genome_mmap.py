@@ -0,0 +1,105 @@
+"""
+Memory-mapped genome shared by the inference workers.
+
+The FASTA is converted once to a flat file of sequence bytes (case kept, no
+newlines) with a JSON index of each chromosome's offset and length:
+
+    <cache_dir>/<key>.genome        sequence bytes
+    <cache_dir>/<key>.genome.json   chromosome offsets and lengths
+
+keyed by the FASTA's absolute path, size and modification time. Every
+process maps the same file read-only, so N workers share one copy of the
+genome in the page cache instead of each reading through its own pyfaidx
+handle. MmapGenome supports the slicing the generators use
+(genome[chrom][start:end], get_seq, str() and .seq) and can be passed to
+VariantGenerator and PeakGenerator in place of the FASTA path.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def genome_key(genome_fasta):
+    stat = os.stat(genome_fasta)
+    key = "%s:%d:%d" % (os.path.abspath(genome_fasta), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class MmapSequence(str):
+    @property
+    def seq(self):
+        return str(self)
+
+
+class MmapChrom:
+    def __init__(self, data, offset, length):
+        self.data = data
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.length)
+        return MmapSequence(self.data[self.offset + start:self.offset + max(start, stop)].tobytes().decode('ascii'))
+
+
+class MmapGenome:
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".json") as f:
+            self.index = json.load(f)
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, chrom):
+        return chrom in self.index
+
+    def __getitem__(self, chrom):
+        offset, length = self.index[chrom]
+        return MmapChrom(self.data, offset, length)
+
+    def get_seq(self, chrom, start, end):
+        # 1-based and end-inclusive, as in pyfaidx
+        return self[chrom][start - 1:end]
+
+
+def build(genome_fasta, path):
+    # one pass over the FASTA; chromosome names are the first word of the header, as in pyfaidx
+    index = {}
+    tmp_path = path + ".tmp.%d" % os.getpid()
+    offset = 0
+    chrom = None
+    with open(genome_fasta, 'rb') as fasta, open(tmp_path, 'wb') as out:
+        for line in fasta:
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'>'):
+                if chrom is not None:
+                    index[chrom] = [start, offset - start]
+                chrom = line[1:].split()[0].decode()
+                start = offset
+            else:
+                out.write(line)
+                offset += len(line)
+        if chrom is not None:
+            index[chrom] = [start, offset - start]
+    with open(tmp_path + ".json", 'w') as f:
+        json.dump(index, f)
+    # the index goes last, since load() checks for it
+    os.replace(tmp_path, path)
+    os.replace(tmp_path + ".json", path + ".json")
+    print("memory-mapped genome written to", path)
+
+
+def load(genome_fasta, cache_dir):
+    path = os.path.join(cache_dir, "%s.genome" % genome_key(genome_fasta))
+    if not os.path.isfile(path + ".json"):
+        os.makedirs(cache_dir, exist_ok=True)
+        build(genome_fasta, path)
+    return path
@@ -1,15 +1,14 @@
-from tensorflow.keras.utils import get_custom_objects
-from tensorflow.keras.models import load_model
-import tensorflow as tf
 from scipy.spatial.distance import jensenshannon
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 import sys
 sys.path.append('..')
-from generators.variant_generator import VariantGenerator
-from generators.peak_generator import PeakGenerator
-from utils import losses
+from utils import instrument, profile_store, autobatch
+
+# TensorFlow, the generators (pyfaidx, deeplift) and the custom losses are
+# imported inside the functions that need them, so that the summary and
+# annotation entry points never pay for loading TensorFlow.
 
 
 def get_variant_schema(schema):
@@ -17,7 +16,8 @@ def get_variant_schema(schema):
                   'plink': ['chr', 'variant_id', 'ignore1', 'pos', 'allele1', 'allele2'],
                   'plink2': ['chr', 'variant_id', 'pos', 'allele1', 'allele2'],
                   'bed': ['chr', 'pos', 'end', 'allele1', 'allele2', 'variant_id'],
-                  'chrombpnet': ['chr', 'pos', 'allele1', 'allele2', 'variant_id']}
+                  'chrombpnet': ['chr', 'pos', 'allele1', 'allele2', 'variant_id'],
+                  'vcf': ['chr', 'pos', 'variant_id', 'allele1', 'allele2']}
     return var_SCHEMA[schema]
 
 def get_peak_schema(schema):
@@ -53,19 +53,51 @@ def get_valid_variants(chrom, pos, allele1, allele2, input_len, chrom_sizes_dict
     else:
         return False
 
+def allele_lengths(alleles):
+    # "-" is an empty allele; categoricals are measured once per category
+    if isinstance(alleles.dtype, pd.CategoricalDtype):
+        return allele_lengths(pd.Series(alleles.cat.categories))[alleles.cat.codes.to_numpy()]
+    alleles = alleles.astype(str)
+    return np.where(alleles == '-', 0, alleles.str.len()).astype(np.int64)
+
 def softmax(x, temp=1):
     norm_x = x - np.mean(x, axis=1, keepdims=True)
     return np.exp(temp*norm_x)/np.sum(np.exp(temp*norm_x), axis=1, keepdims=True)
 
-def load_model_wrapper(model_file):
+@instrument.timed("load_model")
+def load_model_wrapper(model_file, cache_dir=None):
+    import tensorflow as tf
+    from tensorflow.keras.utils import get_custom_objects
+    from tensorflow.keras.models import load_model
+    from utils import losses, model_cache
+
+    # with a cache directory, reuse the traced artifact of this exact .h5 file
+    if cache_dir is not None:
+        model = model_cache.load(model_file, cache_dir)
+        if model is not None:
+            print("model loaded succesfully")
+            return model
+
     # read .h5 model
     custom_objects = {"multinomial_nll": losses.multinomial_nll, "tf": tf}
     get_custom_objects().update(custom_objects)
     model = load_model(model_file, compile=False)
     print("model loaded succesfully")
+
+    if cache_dir is not None:
+        with instrument.stage("model_cache.build"):
+            model_cache.build(model, model_file, cache_dir)
     return model
 
-def fetch_peak_predictions(model, peaks, input_len, genome_fasta, batch_size, debug_mode=False, lite=False,forward_only=False):
+def fetch_peak_predictions(model, peaks, input_len, genome_fasta, batch_size, debug_mode=False, lite=False,forward_only=False, predict_mode="compiled", counts_only=True):
+    from generators.peak_generator import PeakGenerator
+
+    # peak scores only use the counts, so by default the profile head is skipped
+    # and None is returned for the profiles
+    batch_size = autobatch.resolve_for_predictions(batch_size, model, lambda: autobatch.peak_sample(peaks, input_len, genome_fasta),
+                                                   lite=lite, predict_mode=predict_mode, counts_only=counts_only)
+    runner = autobatch.get_runner(model, batch_size, lite=lite, predict_mode=predict_mode, counts_only=counts_only)
+
     peak_ids = []
     pred_counts = []
     pred_profiles = []
@@ -84,47 +116,55 @@ def fetch_peak_predictions(model, peaks, input_len, genome_fasta, batch_size, de
         batch_peak_ids, seqs = peak_gen[i]
         revcomp_seq = seqs[:, ::-1, ::-1]
 
-        if lite:
-            batch_preds = model.predict([seqs,
-                                         np.zeros((len(seqs), model.output_shape[0][1])),
-                                         np.zeros((len(seqs), ))],
-                                        verbose=False)
-
+        with instrument.stage("peaks.predict", items=len(seqs)):
+            batch_preds = runner(seqs)
             if not forward_only:
-                revcomp_batch_preds = model.predict([revcomp_seq,
-                                             np.zeros((len(revcomp_seq), model.output_shape[0][1])),
-                                             np.zeros((len(revcomp_seq), ))],
-                                            verbose=False)
-        else:
-            batch_preds = model.predict(seqs, verbose=False)
-            if not forward_only:
-                revcomp_batch_preds = model.predict(revcomp_seq, verbose=False)
+                revcomp_batch_preds = runner(revcomp_seq)
 
-        batch_preds[1] = np.array([batch_preds[1][i] for i in range(len(batch_preds[1]))])
         pred_counts.extend(np.exp(batch_preds[1]))
-        pred_profiles.extend(np.array(batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
+        if not counts_only:
+            pred_profiles.extend(np.array(batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
 
         if not forward_only:
-            revcomp_batch_preds[1] = np.array([revcomp_batch_preds[1][i] for i in range(len(revcomp_batch_preds[1]))])
             revcomp_counts.extend(np.exp(revcomp_batch_preds[1]))
-            revcomp_profiles.extend(np.array(revcomp_batch_preds[0]))    # np.squeeze(softmax()) to get probability profile
+            if not counts_only:
+                revcomp_profiles.extend(np.array(revcomp_batch_preds[0]))    # np.squeeze(softmax()) to get probability profile
 
         peak_ids.extend(batch_peak_ids)
 
     peak_ids = np.array(peak_ids)
     pred_counts = np.array(pred_counts)
-    pred_profiles = np.array(pred_profiles)
+    pred_profiles = None if counts_only else np.array(pred_profiles)
 
     if not forward_only:
         revcomp_counts = np.array(revcomp_counts)
-        revcomp_profiles = np.array(revcomp_profiles)
         average_counts = np.average([pred_counts,revcomp_counts],axis=0)
-        average_profiles = np.average([pred_profiles,revcomp_profiles[:,::-1]],axis=0)
+        average_profiles = None
+        if not counts_only:
+            revcomp_profiles = np.array(revcomp_profiles)
+            average_profiles = np.average([pred_profiles,revcomp_profiles[:,::-1]],axis=0)
         return peak_ids,average_counts,average_profiles
     else:
         return peak_ids,pred_counts,pred_profiles
 
-def fetch_variant_predictions(model, variants_table, input_len, genome_fasta, batch_size, debug_mode=False, lite=False, shuf=False, forward_only=False):
+def fetch_variant_predictions(model, variants_table, input_len, genome_fasta, batch_size, debug_mode=False, lite=False, shuf=False, forward_only=False, predict_mode="compiled", counts_only=False, prediction_cache=None, profile_dir=None):
+    from generators.variant_generator import VariantGenerator
+
+    # cached variants are looked up first and only the misses are batched and predicted
+    if prediction_cache is not None and not shuf:
+        return prediction_cache.fetch(variants_table,
+                                      lambda misses: fetch_variant_predictions(model, misses, input_len, genome_fasta, batch_size,
+                                                                               lite=lite, forward_only=forward_only,
+                                                                               predict_mode=predict_mode, counts_only=counts_only,
+                                                                               profile_dir=profile_dir),
+                                      counts_only=counts_only, profile_dir=profile_dir)
+
+    # with counts_only the profile head is skipped and None is returned for the profiles;
+    # batch_size "auto" is calibrated on the first variants, and out-of-memory batches are rerun smaller
+    batch_size = autobatch.resolve_for_predictions(batch_size, model, lambda: autobatch.variant_sample(variants_table, input_len, genome_fasta),
+                                                   lite=lite, predict_mode=predict_mode, counts_only=counts_only)
+    runner = autobatch.get_runner(model, batch_size, lite=lite, predict_mode=predict_mode, counts_only=counts_only)
+
     variant_ids = []
     allele1_pred_counts = []
     allele2_pred_counts = []
@@ -150,70 +190,117 @@ def fetch_variant_predictions(model, variants_table, input_len, genome_fasta, ba
         revcomp_allele1_seqs = allele1_seqs[:, ::-1, ::-1]
         revcomp_allele2_seqs = allele2_seqs[:, ::-1, ::-1]
 
-        if lite:
-            allele1_batch_preds = model.predict([allele1_seqs,
-                                                 np.zeros((len(allele1_seqs), model.output_shape[0][1])),
-                                                 np.zeros((len(allele1_seqs), ))],
-                                                verbose=False)
-            allele2_batch_preds = model.predict([allele2_seqs,
-                                                 np.zeros((len(allele2_seqs), model.output_shape[0][1])),
-                                                 np.zeros((len(allele2_seqs), ))],
-                                                verbose=False)
-
+        predict_stage = "shuffled_variants.predict" if shuf else "variants.predict"
+        with instrument.stage(predict_stage, items=len(allele1_seqs)):
+            allele1_batch_preds = runner(allele1_seqs)
+            allele2_batch_preds = runner(allele2_seqs)
             if not forward_only:
-                revcomp_allele1_batch_preds = model.predict([revcomp_allele1_seqs,
-                                                     np.zeros((len(revcomp_allele1_seqs), model.output_shape[0][1])),
-                                                     np.zeros((len(revcomp_allele1_seqs), ))],
-                                                    verbose=False)
-                revcomp_allele2_batch_preds = model.predict([revcomp_allele2_seqs,
-                                         np.zeros((len(revcomp_allele2_seqs), model.output_shape[0][1])),
-                                         np.zeros((len(revcomp_allele2_seqs), ))],
-                                        verbose=False)
-        else:
-            allele1_batch_preds = model.predict(allele1_seqs, verbose=False)
-            allele2_batch_preds = model.predict(allele2_seqs, verbose=False)
-            if not forward_only:
-                revcomp_allele1_batch_preds = model.predict(revcomp_allele1_seqs, verbose=False)
-                revcomp_allele2_batch_preds = model.predict(revcomp_allele2_seqs, verbose=False)
+                revcomp_allele1_batch_preds = runner(revcomp_allele1_seqs)
+                revcomp_allele2_batch_preds = runner(revcomp_allele2_seqs)
 
-        allele1_batch_preds[1] = np.array([allele1_batch_preds[1][i] for i in range(len(allele1_batch_preds[1]))])
-        allele2_batch_preds[1] = np.array([allele2_batch_preds[1][i] for i in range(len(allele2_batch_preds[1]))])
         allele1_pred_counts.extend(np.exp(allele1_batch_preds[1]))
         allele2_pred_counts.extend(np.exp(allele2_batch_preds[1]))
-        allele1_pred_profiles.extend(np.array(allele1_batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
-        allele2_pred_profiles.extend(np.array(allele2_batch_preds[0]))
+        if not counts_only and profile_dir is not None:
+            # strand-averaged profiles go straight into memory-mapped arrays sized for the whole table
+            if i == 0:
+                allele1_pred_profiles = profile_store.allocate((len(variants_table),) + np.shape(allele1_batch_preds[0])[1:], profile_dir)
+                allele2_pred_profiles = profile_store.allocate((len(variants_table),) + np.shape(allele2_batch_preds[0])[1:], profile_dir)
+            batch_slice = slice(i * batch_size, i * batch_size + len(batch_variant_ids))
+            if forward_only:
+                allele1_pred_profiles[batch_slice] = np.array(allele1_batch_preds[0])
+                allele2_pred_profiles[batch_slice] = np.array(allele2_batch_preds[0])
+            else:
+                allele1_pred_profiles[batch_slice] = np.average([np.array(allele1_batch_preds[0]), np.array(revcomp_allele1_batch_preds[0])[:,::-1]], axis=0)
+                allele2_pred_profiles[batch_slice] = np.average([np.array(allele2_batch_preds[0]), np.array(revcomp_allele2_batch_preds[0])[:,::-1]], axis=0)
+        elif not counts_only:
+            allele1_pred_profiles.extend(np.array(allele1_batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
+            allele2_pred_profiles.extend(np.array(allele2_batch_preds[0]))
 
         if not forward_only:
-            revcomp_allele1_batch_preds[1] = np.array([revcomp_allele1_batch_preds[1][i] for i in range(len(revcomp_allele1_batch_preds[1]))])
-            revcomp_allele2_batch_preds[1] = np.array([revcomp_allele2_batch_preds[1][i] for i in range(len(revcomp_allele2_batch_preds[1]))])
             revcomp_allele1_pred_counts.extend(np.exp(revcomp_allele1_batch_preds[1]))
             revcomp_allele2_pred_counts.extend(np.exp(revcomp_allele2_batch_preds[1]))
-            revcomp_allele1_pred_profiles.extend(np.array(revcomp_allele1_batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
-            revcomp_allele2_pred_profiles.extend(np.array(revcomp_allele2_batch_preds[0]))
+            if not counts_only and profile_dir is None:
+                revcomp_allele1_pred_profiles.extend(np.array(revcomp_allele1_batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
+                revcomp_allele2_pred_profiles.extend(np.array(revcomp_allele2_batch_preds[0]))
 
         variant_ids.extend(batch_variant_ids)
 
     variant_ids = np.array(variant_ids)
     allele1_pred_counts = np.array(allele1_pred_counts)
     allele2_pred_counts = np.array(allele2_pred_counts)
-    allele1_pred_profiles = np.array(allele1_pred_profiles)
-    allele2_pred_profiles = np.array(allele2_pred_profiles)
+    if profile_dir is None:
+        allele1_pred_profiles = None if counts_only else np.array(allele1_pred_profiles)
+        allele2_pred_profiles = None if counts_only else np.array(allele2_pred_profiles)
+    elif counts_only:
+        allele1_pred_profiles = None
+        allele2_pred_profiles = None
 
     if not forward_only:
         revcomp_allele1_pred_counts = np.array(revcomp_allele1_pred_counts)
         revcomp_allele2_pred_counts = np.array(revcomp_allele2_pred_counts)
-        revcomp_allele1_pred_profiles = np.array(revcomp_allele1_pred_profiles)
-        revcomp_allele2_pred_profiles = np.array(revcomp_allele2_pred_profiles)
         average_allele1_pred_counts = np.average([allele1_pred_counts,revcomp_allele1_pred_counts],axis=0)
-        average_allele1_pred_profiles = np.average([allele1_pred_profiles,revcomp_allele1_pred_profiles[:,::-1]],axis=0)
         average_allele2_pred_counts = np.average([allele2_pred_counts,revcomp_allele2_pred_counts],axis=0)
-        average_allele2_pred_profiles = np.average([allele2_pred_profiles,revcomp_allele2_pred_profiles[:,::-1]],axis=0)
+        average_allele1_pred_profiles = None
+        average_allele2_pred_profiles = None
+        if profile_dir is not None:
+            # averaged batch by batch already
+            average_allele1_pred_profiles = allele1_pred_profiles
+            average_allele2_pred_profiles = allele2_pred_profiles
+        elif not counts_only:
+            revcomp_allele1_pred_profiles = np.array(revcomp_allele1_pred_profiles)
+            revcomp_allele2_pred_profiles = np.array(revcomp_allele2_pred_profiles)
+            average_allele1_pred_profiles = np.average([allele1_pred_profiles,revcomp_allele1_pred_profiles[:,::-1]],axis=0)
+            average_allele2_pred_profiles = np.average([allele2_pred_profiles,revcomp_allele2_pred_profiles[:,::-1]],axis=0)
         return variant_ids, average_allele1_pred_counts, average_allele2_pred_counts, \
                average_allele1_pred_profiles, average_allele2_pred_profiles
     else:
         return variant_ids, allele1_pred_counts, allele2_pred_counts, \
                allele1_pred_profiles, allele2_pred_profiles
 
+def fetch_variant_scores(model, variants_table, input_len, genome_fasta, batch_size, debug_mode=False, lite=False, shuf=False, forward_only=False, predict_mode="compiled", return_profiles=False):
+    from generators.variant_generator import VariantGenerator
+
+    # same scores as fetch_variant_predictions + get_variant_scores + adjust_indel_jsd,
+    # computed on the graph by the scoring head; profiles only come back if asked for.
+    # "auto" is calibrated on the head itself, which halves its batch size when it runs out of memory
+    batch_size = autobatch.resolve_for_scoring(batch_size, model, lambda: autobatch.variant_sample(variants_table, input_len, genome_fasta),
+                                               lite=lite, forward_only=forward_only, return_profiles=return_profiles,
+                                               predict_mode=predict_mode)
+    head = autobatch.get_scoring_head(model, batch_size, lite=lite, forward_only=forward_only,
+                                      return_profiles=return_profiles, predict_mode=predict_mode)
+    allele1_lengths = allele_lengths(variants_table['allele1'])
+    allele2_lengths = allele_lengths(variants_table['allele2'])
+
+    var_gen = VariantGenerator(variants_table=variants_table,
+                           input_len=input_len,
+                           genome_fasta=genome_fasta,
+                           batch_size=batch_size,
+                           debug_mode=False,
+                           shuf=shuf)
+
+    variant_ids = []
+    batch_scores = []
+    for i in tqdm(range(len(var_gen))):
+        batch_variant_ids, allele1_seqs, allele2_seqs = var_gen[i]
+        batch_slice = slice(i * batch_size, i * batch_size + len(batch_variant_ids))
+
+        predict_stage = "shuffled_variants.predict" if shuf else "variants.predict"
+        with instrument.stage(predict_stage, items=len(allele1_seqs)):
+            batch_scores.append(head(allele1_seqs, allele2_seqs, allele1_lengths[batch_slice], allele2_lengths[batch_slice]))
+        variant_ids.extend(batch_variant_ids)
+
+    scores = {k: np.concatenate([x[k] for x in batch_scores]) for k in batch_scores[0]}
+    return np.array(variant_ids), scores['allele1_pred_counts'], scores['allele2_pred_counts'], \
+           scores['logfc'], scores['jsd'], scores['adjusted_jsd'], \
+           scores.get('allele1_pred_profiles'), scores.get('allele2_pred_profiles')
+
+def get_quantiles(allele1_pred_counts, allele2_pred_counts, pred_counts):
+    with instrument.stage("scores.quantiles", items=len(allele1_pred_counts)):
+        allele1_quantile = np.array([np.max([np.mean(pred_counts < x), (1/len(pred_counts))]) for x in allele1_pred_counts])
+        allele2_quantile = np.array([np.max([np.mean(pred_counts < x), (1/len(pred_counts))]) for x in allele2_pred_counts])
+
+    return allele1_quantile, allele2_quantile
+
 def get_variant_scores_with_peaks(allele1_pred_counts, allele2_pred_counts,
                        allele1_pred_profiles, allele2_pred_profiles, pred_counts):
     # logfc = np.log2(allele2_pred_counts / allele1_pred_counts)
@@ -221,8 +308,7 @@ def get_variant_scores_with_peaks(allele1_pred_counts, allele2_pred_counts,
 
     logfc, jsd = get_variant_scores(allele1_pred_counts, allele2_pred_counts,
                                     allele1_pred_profiles, allele2_pred_profiles)
-    allele1_quantile = np.array([np.max([np.mean(pred_counts < x), (1/len(pred_counts))]) for x in allele1_pred_counts])
-    allele2_quantile = np.array([np.max([np.mean(pred_counts < x), (1/len(pred_counts))]) for x in allele2_pred_counts])
+    allele1_quantile, allele2_quantile = get_quantiles(allele1_pred_counts, allele2_pred_counts, pred_counts)
 
     return logfc, jsd, allele1_quantile, allele2_quantile
 
@@ -231,31 +317,29 @@ def get_variant_scores(allele1_pred_counts, allele2_pred_counts,
 
     print('allele1_pred_counts shape:', allele1_pred_counts.shape)
     print('allele2_pred_counts shape:', allele2_pred_counts.shape)
-    print('allele1_pred_profiles shape:', allele1_pred_profiles.shape)
-    print('allele2_pred_profiles shape:', allele2_pred_profiles.shape)
 
-    logfc = np.squeeze(np.log2(allele2_pred_counts / allele1_pred_counts))
-    jsd = np.squeeze([jensenshannon(x, y, base=2.0)
-                     for x,y in zip(softmax(allele2_pred_profiles),
-                                    softmax(allele1_pred_profiles))])
+    # counts-only predictions have no profiles, and no jsd
+    with instrument.stage("scores.logfc_jsd", items=len(allele1_pred_counts)):
+        logfc = np.squeeze(np.log2(allele2_pred_counts / allele1_pred_counts))
+        jsd = None
+        if allele1_pred_profiles is not None:
+            print('allele1_pred_profiles shape:', allele1_pred_profiles.shape)
+            print('allele2_pred_profiles shape:', allele2_pred_profiles.shape)
+            # in row chunks, so memory-mapped profiles are read sequentially
+            jsd = np.squeeze([jensenshannon(x, y, base=2.0)
+                             for rows in profile_store.chunks(len(allele1_pred_profiles))
+                             for x,y in zip(softmax(allele2_pred_profiles[rows]),
+                                            softmax(allele1_pred_profiles[rows]))])
 
     print('logfc shape:', logfc.shape)
-    print('jsd shape:', jsd.shape)
+    if jsd is not None:
+        print('jsd shape:', jsd.shape)
 
     return logfc, jsd
 
+@instrument.timed("scores.indel_jsd")
 def adjust_indel_jsd(variants_table,allele1_pred_profiles,allele2_pred_profiles,original_jsd):
-    allele1_pred_profiles = softmax(allele1_pred_profiles)
-    allele2_pred_profiles = softmax(allele2_pred_profiles)
-    indel_idx = []
-    for i, row in variants_table.iterrows():
-        allele1, allele2 = row[['allele1','allele2']]
-        if allele1 == "-":
-            allele1 = ""
-        if allele2 == "-":
-            allele2 = ""
-        if len(allele1) != len(allele2):
-            indel_idx += [i]
+    indel_idx = np.flatnonzero(allele_lengths(variants_table['allele1']) != allele_lengths(variants_table['allele2'])).tolist()
 
     adjusted_jsd = []
     for i in indel_idx:
@@ -269,8 +353,9 @@ def adjust_indel_jsd(variants_table,allele1_pred_profiles,allele2_pred_profiles,
         allele1_length = len(allele1)
         allele2_length = len(allele2)
 
-        allele1_p = allele1_pred_profiles[i]
-        allele2_p = allele2_pred_profiles[i]
+        # only the indel rows are normalized, in order
+        allele1_p = softmax(allele1_pred_profiles[i:i+1])[0]
+        allele2_p = softmax(allele2_pred_profiles[i:i+1])[0]
         assert len(allele1_p) == len(allele2_p)
         assert allele1_length != allele2_length
         flank_size = len(allele1_p)//2
@@ -301,8 +386,12 @@ def adjust_indel_jsd(variants_table,allele1_pred_profiles,allele2_pred_profiles,
 
     return indel_idx, adjusted_jsd_list
 
-def load_variant_table(table_path, schema):
-    variants_table = pd.read_csv(table_path, header=None, sep='\t', names=get_variant_schema(schema))
+@instrument.timed("load_variant_table")
+def load_variant_table(table_path, schema, region=None):
+    from utils.variant_reader import read_variant_table
+    return read_variant_table(table_path, schema, region=region)
+
+def format_variant_table(variants_table, schema):
     variants_table.drop(columns=[str(x) for x in variants_table.columns if str(x).startswith('ignore')], inplace=True)
     variants_table['chr'] = variants_table['chr'].astype(str)
     has_chr_prefix = any('chr' in x.lower() for x in variants_table['chr'].tolist())
@@ -312,6 +401,36 @@ def load_variant_table(table_path, schema):
         variants_table['pos'] = variants_table['pos'] + 1
     return variants_table
 
+def load_score_table(score_path, schema):
+    scores_table = pd.read_table(score_path)
+    scores_table['chr'] = scores_table['chr'].astype(str)
+    scores_table[['allele1', 'allele2']] = scores_table[['allele1', 'allele2']].fillna('-')
+    # score files store bed positions 0-based, like the input list
+    if schema == "bed":
+        scores_table['pos'] = scores_table['pos'] + 1
+    return scores_table
+
+def select_variants(scores_table, select_by, top_k=None, select_min=None, select_max=None, per_chrom=False):
+    if select_by not in scores_table.columns:
+        raise ValueError("Selection column not found in score file: " + select_by)
+    selected = scores_table.loc[scores_table[select_by].notna()]
+    if select_min is not None:
+        selected = selected.loc[selected[select_by] >= select_min]
+    if select_max is not None:
+        selected = selected.loc[selected[select_by] <= select_max]
+    if top_k is not None:
+        # for p-values the most significant variants are the smallest
+        ascending = select_by.endswith('pval')
+        selected = selected.sort_values(by=select_by, ascending=ascending, kind='stable')
+        if per_chrom:
+            selected = selected.groupby('chr', sort=False).head(top_k)
+        else:
+            selected = selected.head(top_k)
+    # keep the original file order so outputs line up with the score file
+    selected = selected.sort_index()
+    selected.reset_index(drop=True, inplace=True)
+    return selected
+
 def create_shuffle_table(variants_table, random_seed=None, total_shuf=None, num_shuf=None):
     if total_shuf != None:
         if len(variants_table) > total_shuf:
@@ -338,6 +457,7 @@ def create_shuffle_table(variants_table, random_seed=None, total_shuf=None, num_
             shuf_variants_table = pd.DataFrame()
     return shuf_variants_table
 
+@instrument.timed("pvals")
 def get_pvals(obs, bg, tail):
     sorted_bg = np.sort(bg)
     if tail == 'right' or tail == 'both':
@@ -356,6 +476,18 @@ def get_pvals(obs, bg, tail):
 
     return pval_both
 
+def append_h5_dataset(group, name, data):
+    # resizable along the first axis, so chunked scoring can keep appending;
+    # written in row chunks, so memory-mapped profiles are read sequentially
+    if name not in group:
+        group.create_dataset(name, shape=(0,) + data.shape[1:], dtype=data.dtype, maxshape=(None,) + data.shape[1:],
+                             compression='gzip', compression_opts=9)
+    dataset = group[name]
+    start = len(dataset)
+    dataset.resize(start + len(data), axis=0)
+    for rows in profile_store.chunks(len(data)):
+        dataset[start + rows.start:start + rows.stop] = data[rows]
+
 def geo_mean_overflow(iterable,axis=0):
     return np.exp(np.log(iterable).mean(axis=0))
 
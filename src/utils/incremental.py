@@ -0,0 +1,174 @@
+"""
+Incremental rescoring of a grown or edited variant list.
+
+Every scoring run writes a manifest next to its score table,
+
+    <out_prefix>[.<chrom>].variant_scores.manifest.json
+
+with what the scores depend on: the model and genome, the schema, input
+length, forward_only, counts_only, lite, quantization and the sha256 of the
+shuffled null and peak scores. With --update, the prior table is read back
+and the new list is diffed against it by (chr, pos, allele1, allele2).
+Only variants not in the prior table are scored, against the same null and
+peaks, and the merged table (and hdf5 predictions) is written in the new
+list's canonical order. Variants dropped from the list are dropped from the
+output. A manifest that does not match the current run is an error, since
+merging would mix incomparable scores.
+"""
+
+import json
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from utils.model_cache import model_hash as file_hash
+
+
+KEY_COLUMNS = ['chr', 'pos', 'allele1', 'allele2']
+MERGE_CHUNK_SIZE = 10000
+
+
+def manifest_path(scores_file):
+    return scores_file[:-len(".tsv")] + ".manifest.json"
+
+
+def build_manifest(args, session, shuf_scores_file, peak_scores_file, num_variants):
+    from utils.genome_mmap import genome_key
+
+    return {'model': file_hash(args.model),
+            'genome': genome_key(args.genome),
+            'schema': args.schema,
+            'input_len': session.input_len,
+            'forward_only': args.forward_only,
+            'counts_only': args.counts_only,
+            'lite': args.lite,
+            'quantize': args.quantize,
+            'null': file_hash(shuf_scores_file) if os.path.isfile(shuf_scores_file) else None,
+            'peaks': file_hash(peak_scores_file) if args.peaks else None,
+            'hdf5': not args.no_hdf5,
+            'num_variants': num_variants}
+
+
+def write_manifest(scores_file, manifest):
+    with open(manifest_path(scores_file), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(scores_file):
+    path = manifest_path(scores_file)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_manifest(prior, current):
+    # everything except the output options must match for the scores to be comparable
+    mismatches = [k for k in current if k not in ['schema', 'hdf5', 'num_variants'] and prior.get(k) != current[k]]
+    if mismatches:
+        raise ValueError("--update: prior scores were made with a different " + ", ".join(mismatches) +
+                         "; rescore without --update")
+    if current['hdf5'] and not prior['hdf5']:
+        raise ValueError("--update: prior run has no variant_predictions.h5; rescore without --update or pass --no_hdf5")
+
+
+def load_prior(scores_file, manifest):
+    # the prior score table with pos back in the 1-based input convention, or None if there is none
+    if not os.path.isfile(scores_file):
+        print("--update: no prior scores in", scores_file, ", scoring all variants")
+        return None
+    prior_manifest = read_manifest(scores_file)
+    if prior_manifest is None:
+        raise ValueError("--update: " + scores_file + " has no manifest; rescore without --update")
+    check_manifest(prior_manifest, manifest)
+    prior_scores = pd.read_table(scores_file, dtype={'chr': str, 'allele1': str, 'allele2': str})
+    if prior_manifest['schema'] == "bed":
+        prior_scores['pos'] = prior_scores['pos'] + 1
+    print("--update: prior score table shape:", prior_scores.shape)
+    return prior_scores
+
+
+def diff_variants(variants_table, prior_scores):
+    # for every variant, its row in the prior table or -1 if it has to be scored
+    keys = pd.DataFrame({'chr': variants_table['chr'].astype(str).to_numpy(),
+                         'pos': variants_table['pos'].astype(np.int64).to_numpy(),
+                         'allele1': variants_table['allele1'].astype(str).to_numpy(),
+                         'allele2': variants_table['allele2'].astype(str).to_numpy()})
+    prior_keys = pd.DataFrame({'chr': prior_scores['chr'].astype(str).to_numpy(),
+                               'pos': prior_scores['pos'].astype(np.int64).to_numpy(),
+                               'allele1': prior_scores['allele1'].fillna('-').astype(str).to_numpy(),
+                               'allele2': prior_scores['allele2'].fillna('-').astype(str).to_numpy(),
+                               'prior_row': np.arange(len(prior_scores))})
+    prior_keys = prior_keys.drop_duplicates(KEY_COLUMNS)
+    prior_rows = keys.merge(prior_keys, on=KEY_COLUMNS, how='left')['prior_row']
+    prior_rows = prior_rows.fillna(-1).to_numpy(dtype=np.int64)
+    print("--update: %d variants already scored, %d to score, %d dropped from the list" %
+          ((prior_rows >= 0).sum(), (prior_rows < 0).sum(), len(prior_scores) - len(np.unique(prior_rows[prior_rows >= 0]))))
+    return prior_rows
+
+
+def merge_scores(variants_table, prior_scores, prior_rows, new_scores):
+    # the variants in list order, with prior scores where they exist and new scores elsewhere
+    from utils.scoring import SCORE_COLUMNS, order_columns
+
+    score_columns = [x for x in prior_scores.columns if x in SCORE_COLUMNS]
+    old = variants_table.loc[prior_rows >= 0].copy()
+    for column in score_columns:
+        old[column] = prior_scores[column].to_numpy()[prior_rows[prior_rows >= 0]]
+    old['_row'] = np.flatnonzero(prior_rows >= 0)
+    parts = [old]
+    if new_scores is not None and len(new_scores) > 0:
+        parts.append(new_scores.assign(_row=np.flatnonzero(prior_rows < 0)))
+    merged = pd.concat(parts, ignore_index=True).sort_values('_row', kind='stable')
+    return order_columns(merged.drop(columns='_row').reset_index(drop=True))
+
+
+def merge_predictions(prior_file, out_file, prior_rows, new_preds, names):
+    # rows from the prior hdf5 and the new predictions, in list order, through a temporary file
+    tmp_file = out_file + ".tmp.%d" % os.getpid()
+    new_rows = np.cumsum(prior_rows < 0) - 1
+    with h5py.File(prior_file, 'r') as prior, h5py.File(tmp_file, 'w') as out:
+        observed = out.create_group('observed')
+        for name in names:
+            prior_data = prior['observed'][name]
+            data = observed.create_dataset(name, shape=(len(prior_rows),) + prior_data.shape[1:], dtype=prior_data.dtype,
+                                           compression='gzip', compression_opts=9)
+            for start in range(0, len(prior_rows), MERGE_CHUNK_SIZE):
+                rows = prior_rows[start:start + MERGE_CHUNK_SIZE]
+                from_prior = rows >= 0
+                block = np.empty((len(rows),) + prior_data.shape[1:], dtype=prior_data.dtype)
+                if from_prior.any():
+                    # h5py reads increasing, unique indices
+                    unique_rows, inverse = np.unique(rows[from_prior], return_inverse=True)
+                    block[from_prior] = prior_data[unique_rows][inverse]
+                if not from_prior.all():
+                    block[~from_prior] = new_preds[name][new_rows[start:start + MERGE_CHUNK_SIZE][~from_prior]]
+                data[start:start + len(rows)] = block
+    os.replace(tmp_file, out_file)
+
+
+def update_outputs(session, variants_table, prior_scores, scores_file, predictions_file=None, schema="chrombpnet",
+                   counts_only=False):
+    # score the variants missing from the prior outputs and rewrite both merged, in list order
+    prior_rows = diff_variants(variants_table, prior_scores)
+    new_table = variants_table.loc[prior_rows < 0].reset_index(drop=True)
+    new_scores, new_preds = None, None
+    if len(new_table) > 0:
+        new_scores, new_preds = session.score(new_table, validate=False, return_predictions=True,
+                                              return_profiles=predictions_file is not None)
+    merged = merge_scores(variants_table, prior_scores, prior_rows, new_scores)
+    if schema == "bed":
+        merged['pos'] = merged['pos'] - 1
+
+    if predictions_file is not None:
+        names = ['allele1_pred_counts', 'allele2_pred_counts']
+        if not counts_only:
+            names += ['allele1_pred_profiles', 'allele2_pred_profiles']
+        merge_predictions(predictions_file, predictions_file, prior_rows, new_preds, names)
+
+    tmp_file = scores_file + ".tmp.%d" % os.getpid()
+    merged.to_csv(tmp_file, sep="\t", index=False)
+    os.replace(tmp_file, scores_file)
+    return merged
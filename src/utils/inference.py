@@ -0,0 +1,214 @@
+"""
+Compiled inference for the prediction fetchers.
+
+model.predict() builds a new data adapter and iterator on every call, and the
+fetchers call it four times per batch. CompiledRunner instead traces the model
+once into a tf.function with a fixed batch size and pads the last, partial
+batch so it never retraces.
+
+    runner = get_runner(model, batch_size, lite=lite, predict_mode="compiled")
+    profiles, logcounts = runner(seqs)
+
+With counts_only the runner wraps a keras sub-model ending at the counts head,
+so the profile head is not computed and only the logcounts are copied back;
+it then returns [None, logcounts].
+
+ScoringHead goes one step further for variant scoring: one traced call takes
+the allele1 and allele2 batches, builds the reverse complements, runs the model
+once on all of them and computes the strand-averaged counts, log2 fold change,
+JSD and indel-aligned JSD on the graph, so only a few numbers per variant (and
+the profiles, if asked for) come back to the host.
+
+predict_mode is one of PREDICT_MODES: "compiled" (tf.function), "xla"
+(tf.function with jit_compile=True) or "predict" (plain model.predict). In TF1
+graph mode (variant_shap.py disables v2 behaviour) tf.function is not
+available, and the runner always falls back to model.predict.
+"""
+
+import numpy as np
+
+
+PREDICT_MODES = ['compiled', 'xla', 'predict']
+
+
+class CompiledRunner:
+    def __init__(self, model, batch_size, lite=False, predict_mode="compiled", counts_only=False):
+        import tensorflow as tf
+
+        assert predict_mode in PREDICT_MODES
+        self.model = model
+        self.batch_size = batch_size
+        self.lite = lite
+        self.counts_only = counts_only
+        # models that can only predict (e.g. TFLite) are never traced
+        self.compiled = predict_mode != "predict" and tf.executing_eagerly() and callable(model)
+
+        # keras models can be cut at the counts head; other models (e.g. a
+        # CachedModel) still run both heads and the profiles are dropped
+        self.predictor = model
+        if counts_only and isinstance(model, tf.keras.Model):
+            self.predictor = tf.keras.Model(model.inputs, model.outputs[1])
+        predictor = self.predictor
+
+        # the bias inputs of lite models are always zero at scoring time
+        self.specs = [tf.TensorSpec((batch_size,) + tuple(x.shape[1:]), x.dtype) for x in model.inputs]
+        self.bias_inputs = [tf.zeros(spec.shape, spec.dtype) for spec in self.specs[1:]]
+
+        if self.compiled:
+            self.function = tf.function(lambda *inputs: predictor(list(inputs) if lite else inputs[0], training=False),
+                                        input_signature=self.specs,
+                                        jit_compile=predict_mode == "xla")
+
+    def predict_batch(self, seqs):
+        n = len(seqs)
+        if n < self.batch_size:
+            seqs = np.concatenate([seqs, np.zeros((self.batch_size - n,) + seqs.shape[1:], dtype=seqs.dtype)])
+        preds = self.function(seqs.astype(self.specs[0].dtype.as_numpy_dtype, copy=False), *self.bias_inputs)
+        return self.select(preds, n)
+
+    def select(self, preds, n):
+        if self.predictor is not self.model:
+            return [None, np.asarray(preds)[:n]]
+        if self.counts_only:
+            return [None, np.asarray(preds[1])[:n]]
+        return [np.asarray(x)[:n] for x in preds]
+
+    def __call__(self, seqs):
+        if not self.compiled:
+            if self.lite:
+                preds = self.predictor.predict([seqs,
+                                                np.zeros((len(seqs), self.model.output_shape[0][1])),
+                                                np.zeros((len(seqs), ))],
+                                               verbose=False)
+            else:
+                preds = self.predictor.predict(seqs, verbose=False)
+            return self.select(preds, len(seqs))
+
+        outputs = [self.predict_batch(seqs[i:i + self.batch_size]) for i in range(0, len(seqs), self.batch_size)]
+        if len(outputs) == 1:
+            return outputs[0]
+        return [None if x[0] is None else np.concatenate(x) for x in zip(*outputs)]
+
+
+runners = {}
+
+def get_runner(model, batch_size, lite=False, predict_mode="compiled", counts_only=False):
+    # one runner per model and batch size, so repeated fetches (per chromosome,
+    # shuffled then observed variants) reuse the traced function
+    key = (id(model), batch_size, lite, predict_mode, counts_only)
+    if key not in runners or runners[key].model is not model:
+        runners[key] = CompiledRunner(model, batch_size, lite=lite, predict_mode=predict_mode, counts_only=counts_only)
+    return runners[key]
+
+
+def get_indel_alignment(allele1_lengths, allele2_lengths, profile_len):
+    # gather indices and weights that line up the two allele profiles around
+    # an indel, as adjust_indel_jsd does: the longer allele drops the extra
+    # bases after the variant and the shorter allele drops the same number of
+    # positions from its right end. Substitutions get the identity.
+    allele1_lengths = np.asarray(allele1_lengths)[:, None]
+    allele2_lengths = np.asarray(allele2_lengths)[:, None]
+    positions = np.arange(profile_len)[None, :]
+    flank_size = profile_len // 2
+    mismatch = np.abs(allele1_lengths - allele2_lengths)
+    shorter = np.minimum(allele1_lengths, allele2_lengths)
+
+    longer_idx = np.where(positions < flank_size + shorter, positions, positions + mismatch)
+    longer_idx = np.minimum(longer_idx, profile_len - 1)
+    allele1_idx = np.where(allele1_lengths > allele2_lengths, longer_idx, positions).astype(np.int32)
+    allele2_idx = np.where(allele2_lengths > allele1_lengths, longer_idx, positions).astype(np.int32)
+    weights = (positions < profile_len - mismatch).astype(np.float64)
+    return allele1_idx, allele2_idx, weights
+
+
+class ScoringHead:
+    def __init__(self, model, batch_size, lite=False, forward_only=False, return_profiles=False, predict_mode="compiled"):
+        import tensorflow as tf
+
+        assert predict_mode in PREDICT_MODES
+        if not tf.executing_eagerly():
+            raise RuntimeError("the scoring head needs TF2 eager execution")
+
+        self.model = model
+        self.batch_size = batch_size
+        self.return_profiles = return_profiles
+        self.profile_len = model.output_shape[0][1]
+
+        seq_spec = tf.TensorSpec((batch_size,) + tuple(model.inputs[0].shape[1:]), model.inputs[0].dtype)
+        idx_spec = tf.TensorSpec((batch_size, self.profile_len), tf.int32)
+        weight_spec = tf.TensorSpec((batch_size, self.profile_len), tf.float64)
+        # all four strands and alleles go through the model in one call
+        num_seqs = 2 if forward_only else 4
+        bias_inputs = [tf.zeros((num_seqs * batch_size,) + tuple(x.shape[1:]), x.dtype) for x in model.inputs[1:]]
+
+        def jsd(p, q, weights=None):
+            # scipy.spatial.distance.jensenshannon(p, q, base=2.0), row-wise
+            if weights is not None:
+                p = p * weights
+                q = q * weights
+            p = p / tf.reduce_sum(p, axis=1, keepdims=True)
+            q = q / tf.reduce_sum(q, axis=1, keepdims=True)
+            m = (p + q) / 2
+            divergence = tf.reduce_sum(tf.math.xlogy(p, p) - tf.math.xlogy(p, m) +
+                                       tf.math.xlogy(q, q) - tf.math.xlogy(q, m), axis=1)
+            return tf.sqrt(tf.maximum(divergence / np.log(2.0), 0) / 2)
+
+        def score(allele1_seqs, allele2_seqs, allele1_idx, allele2_idx, weights):
+            seqs = [allele1_seqs, allele2_seqs]
+            if not forward_only:
+                seqs += [tf.reverse(allele1_seqs, axis=[1, 2]), tf.reverse(allele2_seqs, axis=[1, 2])]
+            seqs = tf.concat(seqs, axis=0)
+            profiles, logcounts = model([seqs] + bias_inputs if lite else seqs, training=False)
+            profiles = tf.cast(tf.reshape(profiles, (num_seqs, batch_size, self.profile_len)), tf.float64)
+            counts = tf.exp(tf.cast(tf.reshape(logcounts, (num_seqs, batch_size, -1)), tf.float64))
+
+            # average the profile logits and the counts over the two strands
+            if forward_only:
+                allele1_profiles, allele2_profiles = profiles[0], profiles[1]
+                allele1_counts, allele2_counts = counts[0], counts[1]
+            else:
+                allele1_profiles = (profiles[0] + tf.reverse(profiles[2], axis=[1])) / 2
+                allele2_profiles = (profiles[1] + tf.reverse(profiles[3], axis=[1])) / 2
+                allele1_counts = (counts[0] + counts[2]) / 2
+                allele2_counts = (counts[1] + counts[3]) / 2
+
+            allele1_probs = tf.nn.softmax(allele1_profiles, axis=1)
+            allele2_probs = tf.nn.softmax(allele2_profiles, axis=1)
+            outputs = {'allele1_pred_counts': allele1_counts,
+                       'allele2_pred_counts': allele2_counts,
+                       'logfc': tf.squeeze(tf.math.log(allele2_counts / allele1_counts), axis=1) / np.log(2.0),
+                       'jsd': jsd(allele2_probs, allele1_probs),
+                       'adjusted_jsd': jsd(tf.gather(allele1_probs, allele1_idx, batch_dims=1),
+                                           tf.gather(allele2_probs, allele2_idx, batch_dims=1),
+                                           weights)}
+            if return_profiles:
+                outputs['allele1_pred_profiles'] = tf.cast(allele1_profiles, tf.float32)
+                outputs['allele2_pred_profiles'] = tf.cast(allele2_profiles, tf.float32)
+            return outputs
+
+        self.function = tf.function(score,
+                                    input_signature=[seq_spec, seq_spec, idx_spec, idx_spec, weight_spec],
+                                    jit_compile=predict_mode == "xla")
+
+    def __call__(self, allele1_seqs, allele2_seqs, allele1_lengths, allele2_lengths):
+        n = len(allele1_seqs)
+        assert n <= self.batch_size
+        allele1_idx, allele2_idx, weights = get_indel_alignment(allele1_lengths, allele2_lengths, self.profile_len)
+        inputs = [allele1_seqs, allele2_seqs, allele1_idx, allele2_idx, weights]
+        if n < self.batch_size:
+            # padded rows get identity alignment and are dropped below
+            inputs = [np.concatenate([x, np.zeros((self.batch_size - n,) + x.shape[1:], dtype=x.dtype)]) for x in inputs]
+            inputs[4][n:] = 1
+        dtype = self.function.input_signature[0].dtype.as_numpy_dtype
+        outputs = self.function(inputs[0].astype(dtype, copy=False), inputs[1].astype(dtype, copy=False), *inputs[2:])
+        return {k: np.asarray(v)[:n] for k, v in outputs.items()}
+
+
+scoring_heads = {}
+
+def get_scoring_head(model, batch_size, lite=False, forward_only=False, return_profiles=False, predict_mode="compiled"):
+    key = (id(model), batch_size, lite, forward_only, return_profiles, predict_mode)
+    if key not in scoring_heads or scoring_heads[key].model is not model:
+        scoring_heads[key] = ScoringHead(model, batch_size, lite=lite, forward_only=forward_only,
+                                         return_profiles=return_profiles, predict_mode=predict_mode)
+    return scoring_heads[key]
@@ -0,0 +1,164 @@
+"""
+Lightweight per-stage instrumentation.
+
+    with instrument.stage("variants.predict", items=len(seqs)):
+        ...
+
+Every named stage accumulates wall time, call count, items and the process
+peak RSS (ru_maxrss, the high-water mark of the whole process so far, not of
+the stage) seen when it finished. report() returns the totals, report_at_exit() writes
+them as JSON when the process exits, and a progress line is printed at most
+every VARIANT_SCORER_PROGRESS_INTERVAL seconds (default 60, 0 disables).
+
+Stages can be profiled by listing their names (or "all") in
+VARIANT_SCORER_PROFILE (cProfile, <stage>.prof) or VARIANT_SCORER_TRACEMALLOC
+(tracemalloc, <stage>.tracemalloc.txt). A traced stage resets the
+tracemalloc peak when it starts, so its traced_peak_mb is its own, and
+tracing stops when the outermost traced stage ends. Dumps go to
+VARIANT_SCORER_PROFILE_DIR (default: current directory) at exit.
+
+Stage names are part of the report format; keep them stable.
+"""
+
+import atexit
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+start_time = time.perf_counter()
+stages = {}
+
+progress_interval = float(os.environ.get("VARIANT_SCORER_PROGRESS_INTERVAL", 60))
+last_progress = time.perf_counter()
+
+profile_stages = set(filter(None, os.environ.get("VARIANT_SCORER_PROFILE", "").split(",")))
+tracemalloc_stages = set(filter(None, os.environ.get("VARIANT_SCORER_TRACEMALLOC", "").split(",")))
+profile_dir = os.environ.get("VARIANT_SCORER_PROFILE_DIR", ".")
+profilers = {}
+profiling_active = False
+tracemalloc_snapshots = {}
+# the traced peak seen so far by each enclosing traced stage, since nested stages reset it
+traced_peaks = []
+
+
+def peak_rss_mb():
+    # high-water mark of the whole process; ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def selected(name, names):
+    return "all" in names or name in names
+
+
+@contextmanager
+def stage(name, items=0):
+    global profiling_active, last_progress
+
+    profiler = None
+    if profile_stages and not profiling_active and selected(name, profile_stages):
+        # only one cProfile can be enabled at a time, so nested stages are not profiled
+        profiler = profilers.setdefault(name, cProfile.Profile())
+        profiling_active = True
+        profiler.enable()
+    trace = tracemalloc_stages and selected(name, tracemalloc_stages)
+    started_tracing = False
+    if trace:
+        if traced_peaks:
+            traced_peaks[-1] = max(traced_peaks[-1], tracemalloc.get_traced_memory()[1])
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        tracemalloc.reset_peak()
+        traced_peaks.append(0)
+
+    stage_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - stage_start
+        if profiler is not None:
+            profiler.disable()
+            profiling_active = False
+        traced_peak = None
+        if trace:
+            traced_peak = max(traced_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if traced_peaks:
+                traced_peaks[-1] = max(traced_peaks[-1], traced_peak)
+            # keep the snapshot of the call with the highest peak
+            if name not in tracemalloc_snapshots or traced_peak > tracemalloc_snapshots[name][1]:
+                tracemalloc_snapshots[name] = (tracemalloc.take_snapshot(), traced_peak)
+            if started_tracing:
+                tracemalloc.stop()
+
+        stats = stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'items': 0, 'process_peak_rss_mb': 0.0})
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['items'] += items
+        stats['process_peak_rss_mb'] = max(stats['process_peak_rss_mb'], peak_rss_mb())
+        if traced_peak is not None:
+            stats['traced_peak_mb'] = max(stats.get('traced_peak_mb', 0.0), traced_peak / 1024 / 1024)
+
+        now = time.perf_counter()
+        if progress_interval > 0 and now - last_progress >= progress_interval:
+            last_progress = now
+            print(progress_line(name), file=sys.stderr)
+
+
+def timed(name):
+    # decorator form of stage() for whole functions
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def progress_line(name):
+    stats = stages[name]
+    line = "[progress] %.0fs | %s: %d calls, %.1fs" % (time.perf_counter() - start_time, name,
+                                                     stats['calls'], stats['seconds'])
+    if stats['items'] > 0 and stats['seconds'] > 0:
+        line += ", %d items, %.1f items/s" % (stats['items'], stats['items'] / stats['seconds'])
+    return line + " | process peak RSS %.0f MB" % peak_rss_mb()
+
+
+def report():
+    stage_report = {}
+    for name, stats in stages.items():
+        stage_report[name] = dict(stats)
+        stage_report[name]['items_per_sec'] = stats['items'] / stats['seconds'] if stats['items'] > 0 and stats['seconds'] > 0 else None
+    return {'argv': sys.argv,
+            'wall_seconds': time.perf_counter() - start_time,
+            'process_peak_rss_mb': peak_rss_mb(),
+            'stages': stage_report}
+
+
+def write_report(report_file):
+    with open(report_file, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+
+def dump_profiles():
+    for name, profiler in profilers.items():
+        profiler.dump_stats(os.path.join(profile_dir, name + ".prof"))
+    for name, (snapshot, peak) in tracemalloc_snapshots.items():
+        with open(os.path.join(profile_dir, name + ".tracemalloc.txt"), 'w') as f:
+            f.write("peak traced memory: %.1f MB\n" % (peak / 1024 / 1024))
+            for stat in snapshot.statistics('lineno')[:50]:
+                f.write(str(stat) + "\n")
+
+
+def report_at_exit(report_file):
+    atexit.register(write_report, report_file)
+
+
+atexit.register(dump_profiles)
@@ -0,0 +1,138 @@
+"""
+Cache of pre-traced scoring models.
+
+Loading a ChromBPNet .h5 rebuilds the keras model from its config (including
+the Lambda layers) on every run, and the per-chrom and multi-fold workflows do
+that in dozens of processes. The first time a model is loaded with a cache
+directory, its forward pass is saved as a SavedModel holding a single traced
+function, keyed by the sha256 of the .h5 file:
+
+    <cache_dir>/<sha256>/             SavedModel
+    <cache_dir>/<sha256>/meta.json    shapes, TF version and equivalence check
+
+The artifact is only kept if its outputs match the keras model on a random
+one-hot batch. Later loads of the same file return a CachedModel, which
+exposes the parts of the keras model the scoring code uses (inputs,
+input_shape, output_shape, __call__ and predict). SHAP needs the real keras
+graph and does not use the cache.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+CHECK_BATCH_SIZE = 8
+CHECK_RTOL = 1e-4
+CHECK_ATOL = 1e-4
+
+
+def model_hash(model_file):
+    sha = hashlib.sha256()
+    with open(model_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def to_shape(shape):
+    # keras reports one tuple for single-input models and a list of tuples otherwise
+    if len(shape) > 0 and isinstance(shape[0], (list, tuple)):
+        return [tuple(x) for x in shape]
+    return tuple(shape)
+
+
+class CachedModel:
+    def __init__(self, path, meta):
+        import tensorflow as tf
+
+        self.path = path
+        self.meta = meta
+        self.loaded = tf.saved_model.load(path)
+        self.input_shape = to_shape(meta['input_shape'])
+        self.output_shape = to_shape(meta['output_shape'])
+        self.inputs = [tf.TensorSpec(shape, dtype) for shape, dtype in zip(meta['input_specs'], meta['input_dtypes'])]
+
+    def __call__(self, inputs, training=False):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        return self.loaded.serve(*inputs)
+
+    def predict(self, inputs, verbose=False):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        inputs = [np.reshape(x, (len(x),) + tuple(spec.shape[1:])).astype(spec.dtype.as_numpy_dtype, copy=False)
+                  for x, spec in zip(inputs, self.inputs)]
+        return [np.asarray(x) for x in self(inputs)]
+
+
+def random_inputs(model, seed=1234):
+    # one-hot sequences plus small random bias tracks for lite models
+    rng = np.random.default_rng(seed)
+    seq_shape = model.inputs[0].shape
+    seqs = np.eye(4, dtype=np.float32)[rng.integers(0, 4, size=(CHECK_BATCH_SIZE, seq_shape[1]))]
+    bias = [rng.normal(size=(CHECK_BATCH_SIZE,) + tuple(x.shape[1:])).astype(np.float32) for x in model.inputs[1:]]
+    return [seqs] + bias
+
+
+def build(model, model_file, cache_dir):
+    import tensorflow as tf
+
+    path = os.path.join(cache_dir, model_hash(model_file))
+    tmp_path = path + ".tmp.%d" % os.getpid()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    specs = [tf.TensorSpec(x.shape, x.dtype) for x in model.inputs]
+    multi_input = len(specs) > 1
+    module = tf.Module()
+    module.weights = list(model.weights)
+    module.serve = tf.function(lambda *inputs: model(list(inputs) if multi_input else inputs[0], training=False),
+                               input_signature=specs)
+    tf.saved_model.save(module, tmp_path)
+
+    meta = {'model_file': os.path.abspath(model_file),
+            'tf_version': tf.__version__,
+            'input_shape': model.input_shape,
+            'output_shape': model.output_shape,
+            'input_specs': [list(x.shape) for x in model.inputs],
+            'input_dtypes': [x.dtype.name for x in model.inputs]}
+
+    cached_model = CachedModel(tmp_path, meta)
+    inputs = random_inputs(model)
+    expected = model(inputs if multi_input else inputs[0], training=False)
+    observed = cached_model(inputs)
+    max_abs_diff = max(float(np.max(np.abs(np.asarray(x) - np.asarray(y)))) for x, y in zip(expected, observed))
+    if not all(np.allclose(x, y, rtol=CHECK_RTOL, atol=CHECK_ATOL) for x, y in zip(expected, observed)):
+        print("cached model does not match %s (max abs diff %g), not caching it" % (model_file, max_abs_diff))
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return None
+
+    meta['max_abs_diff'] = max_abs_diff
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=2)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished building the same model first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print("cached model written to", path)
+    return path
+
+
+def load(model_file, cache_dir):
+    import tensorflow as tf
+
+    path = os.path.join(cache_dir, model_hash(model_file))
+    meta_file = os.path.join(path, "meta.json")
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta['tf_version'] != tf.__version__:
+        print("cached model %s was built with TF %s, ignoring it" % (path, meta['tf_version']))
+        return None
+    print("loading cached model", path)
+    return CachedModel(path, meta)
@@ -0,0 +1,114 @@
+"""
+Multi-process inference pool.
+
+A single TF process stops scaling past 8-16 threads, so on large CPU nodes
+the variant batches are spread over several worker processes instead:
+
+    pool = InferencePool(model_file, genome_fasta, num_workers=8, batch_size=512, cache_dir=...)
+    variant_ids, allele1_pred_counts, ... = pool.fetch_variant_predictions(variants_table, shuf=False)
+    pool.close()
+
+Each worker is pinned to its own subset of cores with matching TF and OpenMP
+thread counts, loads its own copy of the model (through the model cache when
+one is given) and reads sequences from one memory-mapped genome shared by all
+workers (genome_mmap). The variants are cut into tasks of a few whole
+batches, which the workers take from the pool's task queue as they free up.
+imap hands the results back in submission order, so the concatenated arrays
+are laid out, and batched, exactly as in the serial fetchers.
+"""
+
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+
+worker = {}
+
+
+def worker_cores(index, threads):
+    # consecutive blocks of the cores this process may use, wrapping around
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    return [cores[(index * threads + i) % len(cores)] for i in range(threads)]
+
+
+def init_worker(counter, model_file, genome_path, batch_size, threads, lite=False, predict_mode="compiled",
+                model_cache=None, quantize=None, tflite_threads=None):
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    cores = worker_cores(index, threads)
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+
+    import tensorflow as tf
+    from utils.helpers import load_model_wrapper
+    from utils import genome_mmap
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(threads, 2))
+    model = load_model_wrapper(model_file, cache_dir=model_cache)
+    if quantize:
+        from utils.quantize import load_quantized_model
+        model = load_quantized_model(model, model_file, quantize, cache_dir=model_cache,
+                                     num_threads=tflite_threads if tflite_threads else threads)
+    worker.update(model=model,
+                  genome=genome_mmap.MmapGenome(genome_path),
+                  input_len=model.input_shape[0][1] if lite else model.input_shape[1],
+                  batch_size=batch_size,
+                  lite=lite,
+                  predict_mode=predict_mode)
+
+
+def run_worker(task):
+    from utils.helpers import fetch_variant_predictions, fetch_variant_scores
+
+    fetch, sub_table, kwargs = task
+    fetcher = fetch_variant_scores if fetch == "scores" else fetch_variant_predictions
+    return fetcher(worker['model'], sub_table, worker['input_len'], worker['genome'], worker['batch_size'],
+                   lite=worker['lite'], predict_mode=worker['predict_mode'], **kwargs)
+
+
+def concatenate(results):
+    # per-output concatenation of the task results; None outputs stay None
+    return tuple(None if parts[0] is None else np.concatenate(parts) for parts in zip(*results))
+
+
+class InferencePool:
+    def __init__(self, model_file, genome_fasta, num_workers, batch_size, threads_per_worker=None, lite=False,
+                 predict_mode="compiled", cache_dir=None, quantize=None, tflite_threads=None, task_batches=4):
+        from utils import genome_mmap, autobatch
+
+        self.batch_size = batch_size
+        # with batch_size "auto" each worker calibrates its own size on its first task
+        self.task_size = (autobatch.PREDICT_CANDIDATES[-1] if batch_size == autobatch.AUTO else batch_size) * task_batches
+        threads = threads_per_worker if threads_per_worker else max(1, os.cpu_count() // num_workers)
+        genome_path = genome_mmap.load(genome_fasta, cache_dir if cache_dir is not None else tempfile.gettempdir())
+        print("running", num_workers, "inference workers with", threads, "threads each")
+
+        context = multiprocessing.get_context("spawn")
+        counter = context.Value('i', 0)
+        self.pool = context.Pool(num_workers,
+                                 initializer=init_worker,
+                                 initargs=(counter, model_file, genome_path, batch_size, threads, lite, predict_mode,
+                                           cache_dir, quantize, tflite_threads))
+
+    def map(self, fetch, variants_table, **kwargs):
+        # tasks are whole batches, so every batch holds the same variants as in the serial path
+        tasks = ((fetch, variants_table[start:start + self.task_size], kwargs)
+                 for start in range(0, len(variants_table), self.task_size))
+        return concatenate(self.pool.imap(run_worker, tasks))
+
+    def fetch_variant_predictions(self, variants_table, shuf=False, forward_only=False, counts_only=False):
+        return self.map("predictions", variants_table, shuf=shuf, forward_only=forward_only, counts_only=counts_only)
+
+    def fetch_variant_scores(self, variants_table, shuf=False, forward_only=False, return_profiles=False):
+        return self.map("scores", variants_table, shuf=shuf, forward_only=forward_only, return_profiles=return_profiles)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,232 @@
+"""
+Persistent cache of variant predictions.
+
+Overlapping variant lists (credible sets within GWAS lists within 1000G) are
+scored again and again against the same models. With a cache directory,
+fetch_variant_predictions looks every variant up first and only sends the
+misses to the model:
+
+    cache = PredictionCache(cache_dir, model_file, genome_fasta, input_len, forward_only=False)
+    fetch_variant_predictions(model, variants_table, ..., prediction_cache=cache)
+
+Entries live in one SQLite database, <cache_dir>/predictions.sqlite, keyed by
+(model key, chr, pos, allele1, allele2). The model key is the sha256 of
+everything that changes a prediction: the model file's sha256, the
+quantization, the genome (path, size and modification time), the input
+length and forward_only. Values are both alleles' counts and, unless the run
+was counts_only, both profiles zlib-compressed. A counts_only entry does not
+satisfy a later run that needs profiles. The dtypes the model's predictions
+come in are recorded per model key, and profiles are stored and all rows
+returned at those dtypes, so a cached variant comes back bit for bit as it
+was predicted.
+
+The database is bounded by max_size_gb. Hits refresh an entry's last-used
+time, and after every insert the least recently used entries are evicted
+until the stored values are back under 90% of the bound. Shuffled
+predictions are never cached, since their sequences depend on the shuffle
+seeds.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+
+from utils import profile_store
+from utils.model_cache import model_hash
+
+
+EVICT_TO = 0.9
+ROW_OVERHEAD = 64
+LOOKUP_CHUNK_SIZE = 100000
+EVICT_CHUNK_SIZE = 10000
+
+
+def model_key(model_file, genome_fasta, input_len, forward_only=False, quantize=None):
+    from utils.genome_mmap import genome_key
+
+    key = {'model': model_hash(model_file),
+           'quantize': quantize,
+           'genome': genome_key(genome_fasta),
+           'input_len': input_len,
+           'forward_only': forward_only,
+           # entries before the dtypes were recorded were always packed as float32
+           'format': 2}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def variant_keys(variants_table):
+    return list(zip(variants_table['chr'].astype(str),
+                    variants_table['pos'].astype(np.int64).tolist(),
+                    variants_table['allele1'].astype(str),
+                    variants_table['allele2'].astype(str)))
+
+
+def pack_profiles(allele1_profile, allele2_profile):
+    return zlib.compress(np.stack([allele1_profile, allele2_profile]).tobytes(), 1)
+
+
+def unpack_profiles(blob, dtype=np.float32):
+    profiles = np.frombuffer(zlib.decompress(blob), dtype=dtype)
+    return profiles.reshape(2, -1)
+
+
+def allocate_profiles(shape, profile_dir=None, dtype=np.float32):
+    if profile_dir is not None:
+        return profile_store.allocate(shape, profile_dir, dtype=dtype)
+    return np.zeros(shape, dtype=dtype)
+
+
+class PredictionCache:
+    def __init__(self, cache_dir, model_file, genome_fasta, input_len, forward_only=False, quantize=None, max_size_gb=50):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "predictions.sqlite")
+        self.model = model_key(model_file, genome_fasta, input_len, forward_only=forward_only, quantize=quantize)
+        self.max_size = int(max_size_gb * 1e9)
+        self.hits = 0
+        self.misses = 0
+        # the scoring server predicts from its executor thread; access is serialized there
+        self.db = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                        "model TEXT, chr TEXT, pos INTEGER, allele1 TEXT, allele2 TEXT, "
+                        "allele1_count REAL, allele2_count REAL, profiles BLOB, size INTEGER, last_used REAL, "
+                        "PRIMARY KEY (model, chr, pos, allele1, allele2)) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dtypes (model TEXT PRIMARY KEY, counts TEXT, profiles TEXT)")
+        self.db.commit()
+
+    def dtypes(self):
+        # (counts dtype, profiles dtype) of this model's predictions, float32 until some are stored
+        row = self.db.execute("SELECT counts, profiles FROM dtypes WHERE model = ?", (self.model,)).fetchone()
+        if row is None:
+            return np.dtype(np.float32), np.dtype(np.float32)
+        return np.dtype(row[0]), np.dtype(row[1] if row[1] is not None else np.float32)
+
+    def set_dtypes(self, counts_dtype, profiles_dtype=None):
+        # a counts_only run leaves the recorded profiles dtype as it is
+        self.db.execute("INSERT INTO dtypes VALUES (?, ?, ?) ON CONFLICT (model) DO UPDATE SET "
+                        "counts = excluded.counts, profiles = COALESCE(excluded.profiles, dtypes.profiles)",
+                        (self.model, np.dtype(counts_dtype).name,
+                         np.dtype(profiles_dtype).name if profiles_dtype is not None else None))
+        self.db.commit()
+
+    def lookup(self, keys, counts_only=False):
+        # yields (row index, allele1 count, allele2 count, profiles blob) for the cached rows
+        # straight from the cursor, a lookup chunk at a time, so the blobs are never held together
+        now = time.time()
+        for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (idx INTEGER, chr TEXT, pos INTEGER, allele1 TEXT, allele2 TEXT)")
+            self.db.execute("DELETE FROM lookup")
+            self.db.executemany("INSERT INTO lookup VALUES (?, ?, ?, ?, ?)",
+                                ((start + i,) + key for i, key in enumerate(keys[start:start + LOOKUP_CHUNK_SIZE])))
+            yield from self.db.execute("SELECT l.idx, p.allele1_count, p.allele2_count, p.profiles "
+                                       "FROM lookup l JOIN predictions p ON p.model = ? AND p.chr = l.chr AND p.pos = l.pos "
+                                       "AND p.allele1 = l.allele1 AND p.allele2 = l.allele2"
+                                       + ("" if counts_only else " WHERE p.profiles IS NOT NULL"), (self.model,))
+            self.db.execute("UPDATE predictions SET last_used = ? WHERE model = ? AND (chr, pos, allele1, allele2) IN "
+                            "(SELECT chr, pos, allele1, allele2 FROM lookup)", (now, self.model))
+        self.db.commit()
+
+    def store(self, keys, allele1_pred_counts, allele2_pred_counts, allele1_pred_profiles=None, allele2_pred_profiles=None):
+        now = time.time()
+        rows = []
+        for i, key in enumerate(keys):
+            profiles = None
+            if allele1_pred_profiles is not None:
+                profiles = pack_profiles(allele1_pred_profiles[i], allele2_pred_profiles[i])
+            size = ROW_OVERHEAD + sum(len(x) for x in key[:1] + key[2:]) + (len(profiles) if profiles is not None else 0)
+            rows.append((self.model,) + key + (float(allele1_pred_counts[i]), float(allele2_pred_counts[i]), profiles, size, now))
+        self.db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+        self.evict()
+
+    def size(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+
+    def evict(self):
+        # least recently used entries first, across all models sharing the database
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return
+        target = excess + self.max_size * (1 - EVICT_TO)
+        freed = 0
+        evicted = 0
+        while freed < target:
+            rows = self.db.execute("SELECT model, chr, pos, allele1, allele2, size FROM predictions "
+                                   "ORDER BY last_used LIMIT ?", (EVICT_CHUNK_SIZE,)).fetchall()
+            if not rows:
+                break
+            sizes = np.cumsum([row[-1] for row in rows])
+            rows = rows[:int(np.searchsorted(sizes, target - freed)) + 1]
+            self.db.executemany("DELETE FROM predictions WHERE model = ? AND chr = ? AND pos = ? AND allele1 = ? AND allele2 = ?",
+                                [row[:-1] for row in rows])
+            freed += sum(row[-1] for row in rows)
+            evicted += len(rows)
+        self.db.commit()
+        print("prediction cache: evicted", evicted, "entries (%.1f MB)" % (freed / 1e6))
+
+    def fetch(self, variants_table, predict, counts_only=False, profile_dir=None):
+        # predict(misses) -> fetch_variant_predictions outputs for the rows not in the cache;
+        # with profile_dir the profiles are gathered into memory-mapped arrays there.
+        # Hits are unpacked into the outputs as they are read, so their blobs are never all in memory.
+        keys = variant_keys(variants_table)
+        variant_ids = np.array(variants_table['variant_id'].tolist())
+        # hits are returned at the dtypes the model predicts in, as uncached rows are;
+        # a model with cached rows has its dtypes recorded
+        counts_dtype, profiles_dtype = self.dtypes()
+
+        # ChromBPNet's count outputs are (n, 1)
+        allele1_pred_counts = np.zeros((len(keys), 1), dtype=counts_dtype)
+        allele2_pred_counts = np.zeros((len(keys), 1), dtype=counts_dtype)
+        allele1_pred_profiles = None
+        allele2_pred_profiles = None
+
+        hit = np.zeros(len(keys), dtype=bool)
+        for i, allele1_count, allele2_count, profiles in self.lookup(keys, counts_only=counts_only):
+            hit[i] = True
+            allele1_pred_counts[i] = allele1_count
+            allele2_pred_counts[i] = allele2_count
+            if not counts_only:
+                profiles = unpack_profiles(profiles, profiles_dtype)
+                if allele1_pred_profiles is None:
+                    allele1_pred_profiles = allocate_profiles((len(keys), profiles.shape[1]), profile_dir, profiles_dtype)
+                    allele2_pred_profiles = allocate_profiles((len(keys), profiles.shape[1]), profile_dir, profiles_dtype)
+                allele1_pred_profiles[i] = profiles[0]
+                allele2_pred_profiles[i] = profiles[1]
+
+        miss_idx = np.flatnonzero(~hit)
+        num_hits = len(keys) - len(miss_idx)
+        self.hits += num_hits
+        self.misses += len(miss_idx)
+        print("prediction cache: %d hits, %d misses" % (num_hits, len(miss_idx)))
+
+        if len(miss_idx) > 0:
+            misses = variants_table.iloc[miss_idx]
+            _, miss_allele1_counts, miss_allele2_counts, miss_allele1_profiles, miss_allele2_profiles = predict(misses)
+            self.set_dtypes(miss_allele1_counts.dtype, None if counts_only else miss_allele1_profiles.dtype)
+            if num_hits == 0:
+                # nothing was cached, so the dtypes are only known now
+                allele1_pred_counts = allele1_pred_counts.astype(miss_allele1_counts.dtype, copy=False)
+                allele2_pred_counts = allele2_pred_counts.astype(miss_allele2_counts.dtype, copy=False)
+            allele1_pred_counts[miss_idx] = np.reshape(miss_allele1_counts, (len(miss_idx), 1))
+            allele2_pred_counts[miss_idx] = np.reshape(miss_allele2_counts, (len(miss_idx), 1))
+            if not counts_only:
+                if allele1_pred_profiles is None:
+                    allele1_pred_profiles = allocate_profiles((len(keys),) + miss_allele1_profiles.shape[1:], profile_dir,
+                                                              miss_allele1_profiles.dtype)
+                    allele2_pred_profiles = allocate_profiles((len(keys),) + miss_allele2_profiles.shape[1:], profile_dir,
+                                                              miss_allele2_profiles.dtype)
+                allele1_pred_profiles[miss_idx] = miss_allele1_profiles
+                allele2_pred_profiles[miss_idx] = miss_allele2_profiles
+            self.store([keys[i] for i in miss_idx], np.ravel(miss_allele1_counts), np.ravel(miss_allele2_counts),
+                       miss_allele1_profiles, miss_allele2_profiles)
+
+        return variant_ids, allele1_pred_counts, allele2_pred_counts, allele1_pred_profiles, allele2_pred_profiles
+
+    def close(self):
+        self.db.close()
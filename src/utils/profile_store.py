@@ -0,0 +1,61 @@
+"""
+Spill-to-disk storage for predicted profiles.
+
+A whole-genome list keeps two (num_variants, 1000) float32 profile arrays
+alive until scoring, plus the reverse-complement copies and the lists they
+are gathered in, which does not fit in memory on a 64 GB node. When the
+estimated in-memory footprint exceeds the profile budget,
+fetch_variant_predictions writes the strand-averaged profiles batch by batch
+into np.memmap arrays in a scratch directory instead:
+
+    allele1_pred_profiles = profile_store.allocate((num_variants, profile_len), scratch_dir)
+
+The backing files are unlinked as soon as they are mapped, so the space is
+given back when the arrays are garbage collected, even if the run dies.
+Scoring, indel adjustment and the hdf5 export read the profiles in chunks of
+PROFILE_CHUNK_SIZE rows, so only those chunks are resident at a time.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+
+PROFILE_CHUNK_SIZE = 10000
+
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def default_budget_gb():
+    # half the node's memory for profiles, leaving the rest to the model and tables
+    return physical_memory() / 2 / 1e9
+
+
+def in_memory_bytes(num_variants, profile_len, forward_only=False):
+    # allele1/allele2 (and reverse complement) lists of rows, plus the stacked arrays made from them
+    arrays = 2 if forward_only else 4
+    return 2 * arrays * num_variants * profile_len * np.dtype(np.float32).itemsize
+
+
+def spill(num_variants, profile_len, forward_only=False, budget_gb=None):
+    budget_gb = budget_gb if budget_gb is not None else default_budget_gb()
+    return in_memory_bytes(num_variants, profile_len, forward_only=forward_only) > budget_gb * 1e9
+
+
+def allocate(shape, scratch_dir=None, dtype=np.float32):
+    scratch_dir = scratch_dir if scratch_dir is not None else tempfile.gettempdir()
+    os.makedirs(scratch_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="profiles.", suffix=".mmap", dir=scratch_dir)
+    os.close(fd)
+    profiles = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+    # the mapping keeps the data alive; nothing is left behind in the scratch directory
+    os.remove(path)
+    return profiles
+
+
+def chunks(num_rows, chunk_size=PROFILE_CHUNK_SIZE):
+    for start in range(0, num_rows, chunk_size):
+        yield slice(start, min(num_rows, start + chunk_size))
@@ -0,0 +1,158 @@
+"""
+Post-training quantized inference with TFLite.
+
+    model = quantize.load_quantized_model(model, model_file, "int8", cache_dir=...)
+
+converts the model once to a TFLite flatbuffer, either with dynamic-range int8
+weights ("int8") or float16 weights ("float16"). The flatbuffer is written to
+<cache_dir>/<sha256 of the .h5>.<quantization>.tflite when a cache directory
+is given. TFLiteModel runs it on an interpreter thread pool and exposes the
+parts of the keras model the prediction fetchers use (inputs, input_shape,
+output_shape and predict), so fetch_variant_predictions and
+fetch_peak_predictions use it unchanged.
+
+accuracy_report() scores a calibration subset with both the float32 and the
+quantized model, and compares logfc, jsd and their p-values.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from utils import model_cache
+
+
+QUANTIZATIONS = ['int8', 'float16']
+
+
+def convert(model, quantization):
+    import tensorflow as tf
+
+    assert quantization in QUANTIZATIONS
+    specs = [tf.TensorSpec(x.shape, x.dtype) for x in model.inputs]
+    multi_input = len(specs) > 1
+    function = tf.function(lambda *inputs: model(list(inputs) if multi_input else inputs[0], training=False),
+                           input_signature=specs)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([function.get_concrete_function()],
+                                                                getattr(model, 'loaded', model))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    # Lambda layers may use ops without a TFLite builtin
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    return converter.convert()
+
+
+class TFLiteModel:
+    def __init__(self, model_content, input_shape, output_shape, num_threads=None):
+        import tensorflow as tf
+
+        self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+        self.input_shape = input_shape
+        self.output_shape = output_shape
+        self.input_details = self.interpreter.get_input_details()
+        self.inputs = [tf.TensorSpec([None] + list(x['shape_signature'][1:]), tf.as_dtype(x['dtype'])) for x in self.input_details]
+        self.batch_size = None
+
+        # outputs are matched to [profile, counts] by their width
+        profile_len = output_shape[0][1]
+        output_details = sorted(self.interpreter.get_output_details(),
+                                key=lambda x: 0 if x['shape_signature'][-1] == profile_len else 1)
+        self.output_index = [x['index'] for x in output_details]
+
+    def resize(self, batch_size):
+        for x in self.input_details:
+            self.interpreter.resize_tensor_input(x['index'], [batch_size] + list(x['shape_signature'][1:]))
+        self.interpreter.allocate_tensors()
+        self.batch_size = batch_size
+
+    def predict(self, inputs, verbose=False):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        if len(inputs[0]) != self.batch_size:
+            self.resize(len(inputs[0]))
+        for x, spec, details in zip(inputs, self.inputs, self.input_details):
+            x = np.reshape(x, (len(x),) + tuple(spec.shape[1:])).astype(spec.dtype.as_numpy_dtype, copy=False)
+            self.interpreter.set_tensor(details['index'], x)
+        self.interpreter.invoke()
+        return [self.interpreter.get_tensor(i).copy() for i in self.output_index]
+
+
+def load_quantized_model(model, model_file, quantization, cache_dir=None, num_threads=None):
+    tflite_file = None
+    model_content = None
+    if cache_dir is not None:
+        tflite_file = os.path.join(cache_dir, "%s.%s.tflite" % (model_cache.model_hash(model_file), quantization))
+        if os.path.isfile(tflite_file):
+            print("loading quantized model", tflite_file)
+            with open(tflite_file, 'rb') as f:
+                model_content = f.read()
+
+    if model_content is None:
+        print("converting model to", quantization)
+        model_content = convert(model, quantization)
+        if tflite_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = tflite_file + ".tmp.%d" % os.getpid()
+            with open(tmp_file, 'wb') as f:
+                f.write(model_content)
+            os.replace(tmp_file, tflite_file)
+
+    return TFLiteModel(model_content, model.input_shape, model.output_shape, num_threads=num_threads)
+
+
+def compare(float_scores, quant_scores):
+    import scipy.stats
+
+    float_scores = np.asarray(float_scores, dtype=np.float64)
+    quant_scores = np.asarray(quant_scores, dtype=np.float64)
+    diff = np.abs(float_scores - quant_scores)
+    return {'max_abs_diff': float(np.max(diff)),
+            'mean_abs_diff': float(np.mean(diff)),
+            'pearson': float(scipy.stats.pearsonr(float_scores, quant_scores)[0]),
+            'spearman': float(scipy.stats.spearmanr(float_scores, quant_scores)[0])}
+
+
+def accuracy_report(float_model, quant_model, variants_table, input_len, genome_fasta, batch_size,
+                    lite=False, forward_only=False, num_variants=1000, random_seed=1234):
+    from utils.helpers import fetch_variant_predictions, get_variant_scores, adjust_indel_jsd, \
+        create_shuffle_table, get_pvals
+
+    if len(variants_table) > num_variants:
+        variants_table = variants_table.sample(num_variants, random_state=random_seed, ignore_index=True)
+    shuf_variants_table = create_shuffle_table(variants_table, random_seed, len(variants_table), None)
+
+    scores = {}
+    for name, model in [("float32", float_model), ("quantized", quant_model)]:
+        model_scores = {}
+        for table_name, table, shuf in [("observed", variants_table, False), ("shuffled", shuf_variants_table, True)]:
+            _, allele1_pred_counts, allele2_pred_counts, \
+            allele1_pred_profiles, allele2_pred_profiles = fetch_variant_predictions(model, table, input_len, genome_fasta,
+                                                                                     batch_size, lite=lite, shuf=shuf,
+                                                                                     forward_only=forward_only)
+            logfc, jsd = get_variant_scores(allele1_pred_counts, allele2_pred_counts,
+                                            allele1_pred_profiles, allele2_pred_profiles)
+            _, jsd = adjust_indel_jsd(table, allele1_pred_profiles, allele2_pred_profiles, jsd)
+            model_scores[table_name] = {'logfc': logfc, 'jsd': jsd}
+        model_scores['logfc.pval'] = get_pvals(model_scores['observed']['logfc'], model_scores['shuffled']['logfc'], tail="both")
+        model_scores['jsd.pval'] = get_pvals(model_scores['observed']['jsd'], model_scores['shuffled']['jsd'], tail="right")
+        scores[name] = model_scores
+
+    report = {'num_variants': len(variants_table),
+              'num_shuffled': len(shuf_variants_table)}
+    for score in ['logfc', 'jsd']:
+        report[score] = compare(scores['float32']['observed'][score], scores['quantized']['observed'][score])
+        pval = score + '.pval'
+        report[pval] = compare(-np.log10(scores['float32'][pval]), -np.log10(scores['quantized'][pval]))
+        for threshold in [0.05, 0.01]:
+            # variants called significant by one model but not the other
+            report[pval]['discordant_at_%g' % threshold] = int(np.sum((scores['float32'][pval] < threshold) !=
+                                                                     (scores['quantized'][pval] < threshold)))
+    return report
+
+
+def write_accuracy_report(report, report_file):
+    print(json.dumps(report, indent=2))
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
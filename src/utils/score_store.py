@@ -0,0 +1,178 @@
+"""
+Indexed score store.
+
+Browsers and fine-mapping pipelines fetch a few loci or rsIDs at a time, and
+grepping or loading a multi-GB variant_scores.tsv for that is slow. A store
+is the same table, coordinate-sorted and bgzip-compressed, with two indexes:
+
+    <prefix>.variant_scores.tsv.gz        header line prefixed with '#'
+    <prefix>.variant_scores.tsv.gz.tbi    tabix index on chr and pos
+    <prefix>.variant_scores.tsv.gz.ids    variant_id index
+
+The variant_id index is a sorted .npy array of (64-bit hash of the id,
+bgzf virtual offset of its line), memory-mapped for lookups, so fetching an
+id costs a binary search and one block read. Ids are compared after reading,
+so hash collisions cannot return the wrong row.
+
+    build_store(["fold_0.variant_scores.tsv"], "fold_0.variant_scores.tsv.gz")
+    scores = query("fold_0.variant_scores.tsv.gz", regions=["chr1:1000000-2000000"])
+    scores = query("fold_0.variant_scores.tsv.gz", variant_ids=["rs123", "rs456"])
+
+build_store takes one or more score tables (TSVs or stores), so the
+per-chromosome outputs of variant_scoring.per_chrom.py merge into one
+genome-wide store. Tables are split by chromosome into temporary files
+first, so memory stays bounded by the largest chromosome.
+"""
+
+import io
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from utils.variant_reader import DEFAULT_CHUNK_SIZE
+
+
+STORE_SUFFIX = ".variant_scores.tsv.gz"
+STRING_COLUMNS = ['chr', 'allele1', 'allele2', 'variant_id']
+INDEX_DTYPE = np.dtype([('hash', '<u8'), ('offset', '<u8')])
+
+
+def id_index_path(path):
+    return path + ".ids"
+
+
+def hash_ids(variant_ids):
+    return pd.util.hash_pandas_object(pd.Series(variant_ids, dtype=str), index=False).to_numpy(dtype=np.uint64)
+
+
+def read_score_chunks(score_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    # score tables and stores alike; the store header starts with '#'
+    for chunk in pd.read_table(score_file, chunksize=chunk_size, dtype={x: str for x in STRING_COLUMNS},
+                               keep_default_na=False, na_values=['']):
+        yield chunk.rename(columns={chunk.columns[0]: chunk.columns[0].lstrip('#')})
+
+
+class StoreWriter:
+    def __init__(self, path, columns):
+        import pysam
+
+        self.path = path
+        self.columns = list(columns)
+        self.hashes = []
+        self.offsets = []
+        self.file = pysam.BGZFile(path, 'wb')
+        self.file.write(('#' + '\t'.join(self.columns) + '\n').encode())
+
+    def write(self, table):
+        # one line at a time, to record where each starts
+        lines = table[self.columns].to_csv(sep='\t', header=False, index=False).splitlines(keepends=True)
+        offsets = np.empty(len(lines), dtype=np.uint64)
+        for i, line in enumerate(lines):
+            offsets[i] = self.file.tell()
+            self.file.write(line.encode())
+        self.hashes.append(hash_ids(table['variant_id']))
+        self.offsets.append(offsets)
+
+    def close(self):
+        import pysam
+
+        self.file.close()
+        index = np.empty(sum(len(x) for x in self.hashes), dtype=INDEX_DTYPE)
+        if len(index) > 0:
+            index['hash'] = np.concatenate(self.hashes)
+            index['offset'] = np.concatenate(self.offsets)
+        index.sort(order=['hash', 'offset'])
+        with open(id_index_path(self.path), 'wb') as f:
+            np.save(f, index)
+
+        # bed outputs have 0-based starts and an end column
+        zerobased = 'end' in self.columns
+        end_col = self.columns.index('end') if zerobased else self.columns.index('pos')
+        pysam.tabix_index(self.path, force=True, seq_col=self.columns.index('chr'), start_col=self.columns.index('pos'),
+                          end_col=end_col, meta_char='#', zerobased=zerobased)
+        print("indexed score store written to", self.path)
+
+
+def build_store(score_files, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    # split by chromosome, then write each chromosome sorted by position
+    columns = None
+    chrom_files = {}
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+        for score_file in score_files:
+            for chunk in read_score_chunks(score_file, chunk_size=chunk_size):
+                if columns is None:
+                    columns = list(chunk.columns)
+                elif list(chunk.columns) != columns:
+                    raise ValueError("score tables to merge have different columns: " + score_file)
+                for chrom, part in chunk.groupby('chr', sort=False):
+                    if chrom not in chrom_files:
+                        chrom_files[chrom] = os.path.join(tmp_dir, "%d.tsv" % len(chrom_files))
+                    part.to_csv(chrom_files[chrom], sep='\t', header=False, index=False, mode='a')
+        if columns is None:
+            raise ValueError("no score tables to index")
+
+        writer = StoreWriter(path, columns)
+        for chrom in sorted(chrom_files):
+            table = pd.read_table(chrom_files[chrom], header=None, names=columns, dtype={x: str for x in STRING_COLUMNS},
+                                  keep_default_na=False, na_values=[''])
+            writer.write(table.sort_values('pos', kind='stable'))
+        writer.close()
+    return path
+
+
+def read_lines(path, lines):
+    # parse store lines with the store's header and the same types as the score tables
+    import pysam
+
+    with pysam.BGZFile(path, 'rb') as f:
+        columns = f.readline().decode().rstrip('\n').lstrip('#').split('\t')
+    if not lines:
+        return pd.DataFrame(columns=columns)
+    return pd.read_table(io.StringIO(''.join(lines)), header=None, names=columns, dtype={x: str for x in STRING_COLUMNS},
+                         keep_default_na=False, na_values=[''])
+
+
+def query_regions(path, regions):
+    import pysam
+
+    lines = []
+    with pysam.TabixFile(path) as tabix:
+        for region in regions:
+            lines.extend(line + '\n' for line in tabix.fetch(region=region))
+    return read_lines(path, lines)
+
+
+def query_ids(path, variant_ids):
+    import pysam
+
+    variant_ids = [str(x) for x in variant_ids]
+    index = np.load(id_index_path(path), mmap_mode='r')
+    hashes = hash_ids(variant_ids)
+    starts = np.searchsorted(index['hash'], hashes, side='left')
+    stops = np.searchsorted(index['hash'], hashes, side='right')
+    offsets = sorted({int(offset) for start, stop in zip(starts, stops) for offset in index['offset'][start:stop]})
+
+    lines = []
+    with pysam.BGZFile(path, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            # BGZFile.readline drops the newline
+            lines.append(f.readline().decode().rstrip('\n') + '\n')
+    table = read_lines(path, lines)
+    # drop hash collisions, and return the rows in the order asked for
+    order = {x: i for i, x in enumerate(variant_ids)}
+    table = table.loc[table['variant_id'].isin(list(order))]
+    return table.iloc[np.argsort(table['variant_id'].map(order).to_numpy(), kind='stable')].reset_index(drop=True)
+
+
+def query(path, regions=None, variant_ids=None):
+    tables = []
+    if regions:
+        tables.append(query_regions(path, regions))
+    if variant_ids:
+        tables.append(query_ids(path, variant_ids))
+    if not tables:
+        raise ValueError("query needs regions or variant_ids")
+    return pd.concat(tables, ignore_index=True)
@@ -0,0 +1,392 @@
+"""
+Programmatic variant scoring.
+
+ScoringSession loads the model, genome, chromosome sizes, peak scores and
+shuffled null once and keeps them for every later call, so small lists can
+be re-scored interactively without reloading TensorFlow or the model:
+
+    session = ScoringSession("model.h5", "hg38.fa", "hg38.chrom.sizes", peaks="peaks.bed")
+    session.build_null(variants_table, num_shuf=10)
+    scores = session.score(variants_table)
+    scores = session.score([("chr1", 1000000, "A", "G"), ("chr2", 2000000, "C", "-")])
+
+With num_workers > 1 the predictions run in a pool of pinned worker
+processes (utils.pool), and with a prediction_cache directory variants
+scored before are looked up instead of predicted (utils.prediction_cache);
+call close() when done to shut both down.
+
+score() returns a DataFrame with the same columns as variant_scoring.py
+(p-values only once a null is set), and read() streams validated chunks of
+a variant list for score() to consume. variant_scoring.py and
+variant_scoring.per_chrom.py are thin wrappers around this class.
+"""
+
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from utils import instrument, profile_store
+from utils.quantize import load_quantized_model, accuracy_report
+from utils.pool import InferencePool
+from utils.prediction_cache import PredictionCache
+from utils.variant_reader import read_variant_chunks, DEFAULT_CHUNK_SIZE
+from utils.variant_table import fill_missing_alleles, compact_variant_table, validate_variants, validate_peaks, \
+    prepared_key, load_prepared, save_prepared
+from utils.helpers import load_model_wrapper, fetch_peak_predictions, fetch_variant_predictions, fetch_variant_scores, \
+    get_variant_scores, get_quantiles, adjust_indel_jsd, get_pvals, create_shuffle_table, add_missing_columns_to_peaks_df, \
+    load_variant_table
+
+
+# score columns in output order, and the tail used for each p-value
+SCORE_COLUMNS = ["allele1_pred_counts", "allele2_pred_counts", "logfc", "abs_logfc", "jsd", "original_jsd",
+                 "logfc_x_jsd", "abs_logfc_x_jsd",
+                 "logfc.pval", "abs_logfc.pval", "jsd.pval", "logfc_x_jsd.pval", "abs_logfc_x_jsd.pval",
+                 "allele1_quantile", "allele2_quantile", "active_allele_quantile", "quantile_change",
+                 "abs_quantile_change", "logfc_x_active_allele_quantile", "abs_logfc_x_active_allele_quantile",
+                 "jsd_x_active_allele_quantile", "logfc_x_jsd_x_active_allele_quantile",
+                 "abs_logfc_x_jsd_x_active_allele_quantile",
+                 "active_allele_quantile.pval", "quantile_change.pval", "abs_quantile_change.pval",
+                 "logfc_x_active_allele_quantile.pval", "abs_logfc_x_active_allele_quantile.pval",
+                 "jsd_x_active_allele_quantile.pval", "logfc_x_jsd_x_active_allele_quantile.pval",
+                 "abs_logfc_x_jsd_x_active_allele_quantile.pval"]
+
+PVAL_TAILS = {"logfc": "both", "abs_logfc": "right", "jsd": "right", "logfc_x_jsd": "both", "abs_logfc_x_jsd": "right",
+              "active_allele_quantile": "right", "quantile_change": "both", "abs_quantile_change": "right",
+              "logfc_x_active_allele_quantile": "both", "abs_logfc_x_active_allele_quantile": "right",
+              "jsd_x_active_allele_quantile": "right", "logfc_x_jsd_x_active_allele_quantile": "both",
+              "abs_logfc_x_jsd_x_active_allele_quantile": "right"}
+
+
+def read_chrom_sizes(chrom_sizes):
+    if isinstance(chrom_sizes, dict):
+        return chrom_sizes
+    chrom_sizes = pd.read_csv(chrom_sizes, header=None, sep='\t', names=['chrom', 'size'])
+    return chrom_sizes.set_index('chrom')['size'].to_dict()
+
+
+def to_variants_table(variants):
+    # DataFrames pass through; records are (chr, pos, allele1, allele2[, variant_id])
+    if isinstance(variants, pd.DataFrame):
+        return variants.copy()
+    rows = [list(x) for x in variants]
+    for row in rows:
+        if len(row) == 4:
+            row.append(':'.join(str(x) for x in row))
+    return pd.DataFrame(rows, columns=['chr', 'pos', 'allele1', 'allele2', 'variant_id'])
+
+
+def order_columns(table):
+    score_columns = [x for x in SCORE_COLUMNS if x in table.columns]
+    other_columns = [x for x in table.columns if x not in score_columns]
+    return table[other_columns + score_columns]
+
+
+class ScoringSession:
+    def __init__(self, model, genome, chrom_sizes, peaks=None, null=None, peak_genome=None, peak_chrom_sizes=None,
+                 lite=False, batch_size=512, forward_only=False, counts_only=False, scoring_head=False,
+                 predict_mode="compiled", model_cache=None, quantize=None, tflite_threads=None,
+                 max_peaks=None, random_seed=1234, debug_mode=False, num_workers=1, threads_per_worker=None,
+                 prediction_cache=None, prediction_cache_size=50, profile_budget=None, scratch_dir=None):
+        if scoring_head and counts_only:
+            print("no profiles to score with --counts_only, not using the scoring head")
+            scoring_head = False
+        if scoring_head and quantize:
+            print("the quantized model runs outside the TF graph, not using the scoring head")
+            scoring_head = False
+
+        self.model_file = model if isinstance(model, str) else None
+        if isinstance(model, str):
+            model = load_model_wrapper(model, cache_dir=model_cache)
+        self.float_model = model
+        if quantize:
+            assert self.model_file is not None, "quantize needs the model file"
+            model = load_quantized_model(model, self.model_file, quantize,
+                                         cache_dir=model_cache, num_threads=tflite_threads)
+        self.model = model
+        self.genome = genome
+        self.chrom_sizes = read_chrom_sizes(chrom_sizes)
+        self.peak_genome = peak_genome if peak_genome is not None else genome
+        self.peak_chrom_sizes = read_chrom_sizes(peak_chrom_sizes) if peak_chrom_sizes is not None else self.chrom_sizes
+        self.lite = lite
+        self.batch_size = batch_size
+        self.forward_only = forward_only
+        self.counts_only = counts_only
+        self.scoring_head = scoring_head
+        self.predict_mode = predict_mode
+        self.max_peaks = max_peaks
+        self.random_seed = random_seed
+        self.debug_mode = debug_mode
+        self.profile_budget = profile_budget
+        self.scratch_dir = scratch_dir
+
+        # variant batches go to a pool of pinned worker processes, each with its own model
+        self.pool = None
+        if num_workers > 1:
+            assert self.model_file is not None and isinstance(genome, str), "num_workers needs the model and genome files"
+            self.pool = InferencePool(self.model_file, genome, num_workers, batch_size,
+                                      threads_per_worker=threads_per_worker, lite=lite, predict_mode=predict_mode,
+                                      cache_dir=model_cache, quantize=quantize, tflite_threads=tflite_threads)
+
+        # infer input length
+        self.input_len = model.input_shape[0][1] if lite else model.input_shape[1]
+        print("Input length inferred from the model:", self.input_len)
+
+        # predictions of variants scored before with the same model, genome and settings are reused
+        self.prediction_cache = None
+        if prediction_cache is not None and scoring_head:
+            print("the scoring head computes scores on the graph, not using the prediction cache")
+        elif prediction_cache is not None:
+            assert self.model_file is not None and isinstance(genome, str), "prediction_cache needs the model and genome files"
+            self.prediction_cache = PredictionCache(prediction_cache, self.model_file, genome, self.input_len,
+                                                    forward_only=forward_only, quantize=quantize,
+                                                    max_size_gb=prediction_cache_size)
+
+        self.drop_counts = None
+        self.peaks = None
+        if peaks is not None:
+            self.set_peaks(peaks)
+        self.null = None
+        if null is not None:
+            self.null = null if isinstance(null, pd.DataFrame) else pd.read_table(null)
+
+    def validate(self, variants_table):
+        variants_table = fill_missing_alleles(variants_table)
+        with instrument.stage("validate_variants", items=len(variants_table)):
+            variants_table, self.drop_counts = validate_variants(variants_table, self.input_len, self.chrom_sizes)
+        return variants_table
+
+    def prepare(self, variants_file, schema="chrombpnet", region=None, chrom=None, cache_dir=None):
+        # the parsed, compacted and validated list, from the prepared-input cache when possible
+        key = None
+        if cache_dir is not None:
+            key = prepared_key(variants_file, schema, self.input_len, self.chrom_sizes, region=region, chrom=chrom)
+            variants_table = load_prepared(cache_dir, key)
+            if variants_table is not None:
+                return variants_table
+
+        variants_table = load_variant_table(variants_file, schema, region=region)
+        print("Original variants table shape:", variants_table.shape)
+
+        if chrom:
+            variants_table = variants_table.loc[variants_table['chr'] == chrom]
+            print("Chromosome variants table shape:", variants_table.shape)
+
+        variants_table = self.validate(compact_variant_table(variants_table))
+        if key is not None:
+            save_prepared(variants_table, cache_dir, key)
+        return variants_table
+
+    def read(self, variants_file, schema="chrombpnet", chunk_size=DEFAULT_CHUNK_SIZE, region=None, chrom=None):
+        # validated chunks of a (possibly bgzip or VCF) variant list, read as they are consumed
+        for chunk in read_variant_chunks(variants_file, schema, chunk_size=chunk_size, region=region, chrom=chrom):
+            chunk = self.validate(compact_variant_table(chunk))
+            if len(chunk) > 0:
+                yield chunk
+
+    def set_peaks(self, peaks):
+        # a peak table that already has peak_score (e.g. a previous peak_scores.tsv) is used as is
+        if isinstance(peaks, pd.DataFrame) and 'peak_score' in peaks.columns:
+            self.peaks = peaks
+            return self.peaks
+
+        if not isinstance(peaks, pd.DataFrame):
+            peaks = pd.read_csv(peaks, header=None, sep='\t')
+            peaks = add_missing_columns_to_peaks_df(peaks, schema='narrowpeak')
+        peaks['peak_id'] = peaks['chr'] + ':' + peaks['start'].astype(str) + '-' + peaks['end'].astype(str)
+
+        print("Original peak table shape:", peaks.shape)
+
+        peaks.sort_values(by=['chr', 'start', 'end', 'summit', 'rank'], ascending=[True, True, True, True, False], inplace=True)
+        peaks.drop_duplicates(subset=['chr', 'start', 'end', 'summit'], inplace=True)
+        peaks, _ = validate_peaks(peaks, self.input_len, self.peak_chrom_sizes)
+
+        print("De-duplicated peak table shape:", peaks.shape)
+
+        if self.debug_mode:
+            peaks = peaks.sample(10000, random_state=self.random_seed, ignore_index=True)
+            print()
+            print(peaks.head())
+            print("Debug peak table shape:", peaks.shape)
+            print()
+
+        if self.max_peaks:
+            if len(peaks) > self.max_peaks:
+                peaks = peaks.sample(self.max_peaks, random_state=self.random_seed, ignore_index=True)
+                print("Subsampled peak table shape:", peaks.shape)
+
+        self.peaks = peaks
+        return self.peaks
+
+    def score_peaks(self):
+        if 'peak_score' not in self.peaks.columns:
+            peak_ids, peak_pred_counts, _ = fetch_peak_predictions(self.model,
+                                                                   self.peaks,
+                                                                   self.input_len,
+                                                                   self.peak_genome,
+                                                                   self.batch_size,
+                                                                   debug_mode=self.debug_mode,
+                                                                   lite=self.lite,
+                                                                   forward_only=self.forward_only,
+                                                                   predict_mode=self.predict_mode)
+            assert np.array_equal(self.peaks["peak_id"].tolist(), peak_ids)
+            self.peaks["peak_score"] = peak_pred_counts
+        return self.peaks
+
+    def profile_dir(self, num_variants):
+        # where to memory-map the profiles when they would not fit in the profile budget
+        if self.counts_only or not profile_store.spill(num_variants, self.model.output_shape[0][1],
+                                                       forward_only=self.forward_only, budget_gb=self.profile_budget):
+            return None
+        profile_dir = self.scratch_dir if self.scratch_dir is not None else tempfile.gettempdir()
+        print("profiles of", num_variants, "variants exceed the profile budget, memory-mapping them in", profile_dir)
+        return profile_dir
+
+    def predict(self, variants_table, shuf=False, return_profiles=True):
+        # counts, logfc and (unless counts_only) jsd and indel-adjusted jsd per variant
+        if self.scoring_head and self.pool is not None:
+            variant_ids, allele1_pred_counts, allele2_pred_counts, \
+            logfc, jsd, adjusted_jsd, \
+            allele1_pred_profiles, allele2_pred_profiles = self.pool.fetch_variant_scores(variants_table,
+                                                                                          shuf=shuf,
+                                                                                          forward_only=self.forward_only,
+                                                                                          return_profiles=return_profiles)
+        elif self.scoring_head:
+            variant_ids, allele1_pred_counts, allele2_pred_counts, \
+            logfc, jsd, adjusted_jsd, \
+            allele1_pred_profiles, allele2_pred_profiles = fetch_variant_scores(self.model,
+                                                                                variants_table,
+                                                                                self.input_len,
+                                                                                self.genome,
+                                                                                self.batch_size,
+                                                                                debug_mode=self.debug_mode,
+                                                                                lite=self.lite,
+                                                                                shuf=shuf,
+                                                                                forward_only=self.forward_only,
+                                                                                predict_mode=self.predict_mode,
+                                                                                return_profiles=return_profiles)
+        else:
+            if self.pool is not None and self.prediction_cache is not None and not shuf:
+                predict_misses = lambda misses: self.pool.fetch_variant_predictions(misses,
+                                                                                    forward_only=self.forward_only,
+                                                                                    counts_only=self.counts_only)
+                variant_ids, allele1_pred_counts, allele2_pred_counts, \
+                allele1_pred_profiles, allele2_pred_profiles = self.prediction_cache.fetch(variants_table,
+                                                                                           predict_misses,
+                                                                                           counts_only=self.counts_only,
+                                                                                           profile_dir=self.profile_dir(len(variants_table)))
+            elif self.pool is not None:
+                variant_ids, allele1_pred_counts, allele2_pred_counts, \
+                allele1_pred_profiles, allele2_pred_profiles = self.pool.fetch_variant_predictions(variants_table,
+                                                                                                   shuf=shuf,
+                                                                                                   forward_only=self.forward_only,
+                                                                                                   counts_only=self.counts_only)
+            else:
+                profile_dir = self.profile_dir(len(variants_table))
+                variant_ids, allele1_pred_counts, allele2_pred_counts, \
+                allele1_pred_profiles, allele2_pred_profiles = fetch_variant_predictions(self.model,
+                                                                                         variants_table,
+                                                                                         self.input_len,
+                                                                                         self.genome,
+                                                                                         self.batch_size,
+                                                                                         debug_mode=self.debug_mode,
+                                                                                         lite=self.lite,
+                                                                                         shuf=shuf,
+                                                                                         forward_only=self.forward_only,
+                                                                                         predict_mode=self.predict_mode,
+                                                                                         counts_only=self.counts_only,
+                                                                                         prediction_cache=self.prediction_cache,
+                                                                                         profile_dir=profile_dir)
+            logfc, jsd = get_variant_scores(allele1_pred_counts,
+                                            allele2_pred_counts,
+                                            allele1_pred_profiles,
+                                            allele2_pred_profiles)
+            adjusted_jsd = None
+            if not self.counts_only:
+                indel_idx, adjusted_jsd = adjust_indel_jsd(variants_table, allele1_pred_profiles, allele2_pred_profiles, jsd)
+                # without indels the adjusted jsd is the jsd
+                assert len(indel_idx) > 0 or np.array_equal(adjusted_jsd, jsd)
+
+        assert np.array_equal(variants_table["variant_id"].tolist(), variant_ids)
+        return {'variant_ids': variant_ids,
+                'allele1_pred_counts': allele1_pred_counts,
+                'allele2_pred_counts': allele2_pred_counts,
+                'logfc': logfc,
+                'jsd': jsd,
+                'adjusted_jsd': adjusted_jsd,
+                'allele1_pred_profiles': allele1_pred_profiles,
+                'allele2_pred_profiles': allele2_pred_profiles}
+
+    def add_scores(self, variants_table, preds):
+        variants_table["allele1_pred_counts"] = preds['allele1_pred_counts']
+        variants_table["allele2_pred_counts"] = preds['allele2_pred_counts']
+        variants_table["logfc"] = preds['logfc']
+        variants_table["abs_logfc"] = np.abs(variants_table["logfc"])
+        if not self.counts_only:
+            variants_table["jsd"] = preds['adjusted_jsd']
+            variants_table["original_jsd"] = preds['jsd']
+            variants_table["logfc_x_jsd"] = variants_table["logfc"] * variants_table["jsd"]
+            variants_table["abs_logfc_x_jsd"] = variants_table["abs_logfc"] * variants_table["jsd"]
+
+        if self.peaks is not None:
+            allele1_quantile, allele2_quantile = get_quantiles(preds['allele1_pred_counts'],
+                                                               preds['allele2_pred_counts'],
+                                                               np.array(self.score_peaks()["peak_score"].tolist()))
+            variants_table["allele1_quantile"] = allele1_quantile
+            variants_table["allele2_quantile"] = allele2_quantile
+            variants_table["active_allele_quantile"] = variants_table[["allele1_quantile", "allele2_quantile"]].max(axis=1)
+            variants_table["quantile_change"] = variants_table["allele2_quantile"] - variants_table["allele1_quantile"]
+            variants_table["abs_quantile_change"] = np.abs(variants_table["quantile_change"])
+            variants_table["logfc_x_active_allele_quantile"] = variants_table["logfc"] * variants_table["active_allele_quantile"]
+            variants_table["abs_logfc_x_active_allele_quantile"] = variants_table["abs_logfc"] * variants_table["active_allele_quantile"]
+            if not self.counts_only:
+                variants_table["jsd_x_active_allele_quantile"] = variants_table["jsd"] * variants_table["active_allele_quantile"]
+                variants_table["logfc_x_jsd_x_active_allele_quantile"] = variants_table["logfc_x_jsd"] * variants_table["active_allele_quantile"]
+                variants_table["abs_logfc_x_jsd_x_active_allele_quantile"] = variants_table["abs_logfc_x_jsd"] * variants_table["active_allele_quantile"]
+        return variants_table
+
+    def add_pvals(self, variants_table):
+        if self.null is None or len(self.null) == 0:
+            return variants_table
+        for score, tail in PVAL_TAILS.items():
+            if score in variants_table.columns and score in self.null.columns:
+                variants_table[score + ".pval"] = get_pvals(variants_table[score].tolist(), self.null[score], tail=tail)
+        return variants_table
+
+    def build_null(self, variants_table=None, total_shuf=None, num_shuf=10, shuf_variants_table=None):
+        # score dinucleotide-shuffled copies of the variants as the null for the p-values
+        if shuf_variants_table is None:
+            shuf_variants_table = create_shuffle_table(variants_table, self.random_seed, total_shuf, num_shuf)
+        if len(shuf_variants_table) > 0:
+            preds = self.predict(shuf_variants_table, shuf=True, return_profiles=False)
+            shuf_variants_table = self.add_scores(shuf_variants_table, preds)
+        self.null = shuf_variants_table
+        return self.null
+
+    def score(self, variants, validate=True, return_predictions=False, return_profiles=None):
+        variants_table = to_variants_table(variants)
+        if validate:
+            variants_table = self.validate(variants_table)
+        if return_profiles is None:
+            return_profiles = return_predictions
+        preds = self.predict(variants_table, return_profiles=return_profiles)
+        variants_table = self.add_scores(variants_table, preds)
+        variants_table = order_columns(self.add_pvals(variants_table))
+        if return_predictions:
+            return variants_table, preds
+        return variants_table
+
+    def quantization_report(self, variants_table, num_variants=1000):
+        with instrument.stage("quantization_report"):
+            return accuracy_report(self.float_model, self.model, variants_table, self.input_len, self.genome,
+                                   self.batch_size, lite=self.lite, forward_only=self.forward_only,
+                                   num_variants=num_variants, random_seed=self.random_seed)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.prediction_cache is not None:
+            print("prediction cache: %d hits, %d misses in total" % (self.prediction_cache.hits, self.prediction_cache.misses))
+            self.prediction_cache.close()
+            self.prediction_cache = None
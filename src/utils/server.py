@@ -0,0 +1,309 @@
+"""
+Micro-batching variant scoring service.
+
+variant_server.py keeps one ScoringSession per model warm and answers small
+ad-hoc queries over HTTP on localhost or a Unix socket:
+
+    POST /score   {"variants": [["chr1", 1000000, "A", "G", "rs1"], ...],
+                   "schema": "chrombpnet", "model": "fold_0"}
+    GET  /health
+
+"variants" holds records in any schema from get_variant_schema (lists in
+schema column order or dicts keyed by column name), or the lines of a
+variant list as one TSV string. "schema" defaults to chrombpnet and "model"
+may be left out when a single model is served. The response has the same
+score columns as variant_scoring.py, with p-values from the null the model
+was started with, plus the number of variants dropped by validation.
+
+Requests for a model go to its MicroBatcher, which holds the first request
+for up to max_latency seconds (or until max_batch variants are waiting) and
+scores everything collected in one session.score() call. If that call
+fails, the requests in it are scored one at a time, so a bad request only
+fails itself. All batchers share a single inference thread, so the event
+loop keeps accepting requests while a batch runs on the model.
+
+query() is a small client for scripts and tests.
+"""
+
+import asyncio
+import http.client
+import json
+import socket
+import time
+from urllib.parse import urlparse
+
+import pandas as pd
+
+from utils import instrument
+from utils.helpers import get_variant_schema
+from utils.variant_reader import format_chunk
+
+
+MAX_BODY_BYTES = 64 << 20
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_variants(variants, schema="chrombpnet"):
+    try:
+        columns = get_variant_schema(schema)
+    except KeyError:
+        raise RequestError(400, "unknown schema: %s" % schema)
+    if isinstance(variants, str):
+        variants = [line.split('\t') for line in variants.splitlines() if line.strip()]
+    if not isinstance(variants, list) or len(variants) == 0:
+        raise RequestError(400, "variants must be a non-empty list of records or a TSV string")
+    if all(isinstance(x, dict) for x in variants):
+        variants_table = pd.DataFrame(variants)
+        missing = [x for x in columns if x not in variants_table.columns and not x.startswith('ignore')]
+        if missing:
+            raise RequestError(400, "variant records are missing columns: %s" % ", ".join(missing))
+    elif all(isinstance(x, list) and len(x) == len(columns) for x in variants):
+        variants_table = pd.DataFrame(variants, columns=columns)
+    else:
+        raise RequestError(400, "%s records have %d columns: %s" % (schema, len(columns), ", ".join(columns)))
+
+    try:
+        variants_table['pos'] = variants_table['pos'].astype(int)
+    except (TypeError, ValueError):
+        raise RequestError(400, "pos must be an integer")
+    variants_table['variant_id'] = variants_table['variant_id'].astype(str)
+    variants_table = format_chunk(variants_table, schema)
+    return variants_table[['chr', 'pos', 'allele1', 'allele2', 'variant_id']]
+
+
+def score_batch(session, tables):
+    # one model call for every queued request, then split back by request;
+    # if the batch fails, each request is scored alone so only the bad ones get the error
+    batch = pd.concat([table.assign(_request=i) for i, table in enumerate(tables)], ignore_index=True)
+    try:
+        with instrument.stage("server.batch", items=len(batch)):
+            scores = session.score(batch)
+    except Exception as e:
+        if len(tables) == 1:
+            return [e]
+        return [score_batch(session, [table])[0] for table in tables]
+    results = []
+    for i, table in enumerate(tables):
+        request_scores = scores.loc[scores['_request'] == i].drop(columns=['_request'])
+        results.append((request_scores.reset_index(drop=True), len(table) - len(request_scores)))
+    return results
+
+
+class MicroBatcher:
+    def __init__(self, session, executor, max_batch, max_latency):
+        self.session = session
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = None
+        self.num_batches = 0
+        self.num_variants = 0
+
+    async def submit(self, variants_table):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((variants_table, future))
+        return await future
+
+    async def collect(self):
+        # wait for a first request, then for up to max_latency for others to join it
+        pending = [await self.queue.get()]
+        num_variants = len(pending[0][0])
+        deadline = time.monotonic() + self.max_latency
+        while num_variants < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            pending.append(request)
+            num_variants += len(request[0])
+        return pending
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await self.collect()
+            tables = [table for table, _ in pending]
+            try:
+                results = await loop.run_in_executor(self.executor, score_batch, self.session, tables)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.num_batches += 1
+            self.num_variants += sum(len(table) for table in tables)
+            for (_, future), result in zip(pending, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise RequestError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, "request body is larger than %d bytes" % MAX_BODY_BYTES)
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, urlparse(target).path, body
+
+
+async def write_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    head = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % \
+           (status, STATUS_TEXT[status], len(body))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+def pick_batcher(batchers, name):
+    if name is None:
+        if len(batchers) > 1:
+            raise RequestError(400, "several models are served, pick one of: %s" % ", ".join(batchers))
+        return next(iter(batchers.values()))
+    if name not in batchers:
+        raise RequestError(404, "unknown model: %s" % name)
+    return batchers[name]
+
+
+async def handle_score(batchers, body):
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise RequestError(400, "request body is not JSON")
+    if not isinstance(request, dict):
+        raise RequestError(400, "request body must be a JSON object")
+    schema = request.get("schema", "chrombpnet")
+    batcher = pick_batcher(batchers, request.get("model"))
+    variants_table = parse_variants(request.get("variants"), schema)
+    scores, num_dropped = await batcher.submit(variants_table)
+    # scores keep the positions of the input schema, as in the score files
+    if schema == "bed":
+        scores['pos'] = scores['pos'] - 1
+    return {'model': request.get("model") or next(iter(batchers)),
+            'num_dropped': num_dropped,
+            'columns': list(scores.columns),
+            'scores': json.loads(scores.to_json(orient='records'))}
+
+
+async def handle_connection(batchers, reader, writer):
+    try:
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, body = request
+            if path == "/health":
+                status, payload = 200, {'status': 'ok',
+                                        'models': {name: {'batches': x.num_batches, 'variants': x.num_variants,
+                                                          'null_size': 0 if x.session.null is None else len(x.session.null)}
+                                                   for name, x in batchers.items()}}
+            elif path == "/score":
+                if method != "POST":
+                    raise RequestError(405, "use POST for /score")
+                status, payload = 200, await handle_score(batchers, body)
+            else:
+                raise RequestError(404, "unknown path: %s" % path)
+        except RequestError as e:
+            status, payload = e.status, {'error': str(e)}
+        except Exception as e:
+            status, payload = 500, {'error': "%s: %s" % (type(e).__name__, e)}
+        await write_response(writer, status, payload)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(batchers, host="127.0.0.1", port=8642, unix_socket=None):
+    # queues belong to the serving event loop
+    for batcher in batchers.values():
+        batcher.queue = asyncio.Queue()
+    workers = [asyncio.ensure_future(x.run()) for x in batchers.values()]
+    handler = lambda reader, writer: handle_connection(batchers, reader, writer)
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(handler, path=unix_socket)
+        print("serving", ", ".join(batchers), "on", unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+        print("serving", ", ".join(batchers), "on http://%s:%d" % (host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(method, path, payload=None, host="127.0.0.1", port=8642, unix_socket=None, timeout=600):
+    if unix_socket is not None:
+        connection = UnixHTTPConnection(unix_socket, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        body = None if payload is None else json.dumps(payload)
+        connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        result = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError("server returned %d: %s" % (response.status, result.get('error')))
+    return result
+
+
+def query(variants, schema="chrombpnet", model=None, as_frame=True, **kwargs):
+    payload = {'variants': variants, 'schema': schema}
+    if model is not None:
+        payload['model'] = model
+    result = request("POST", "/score", payload, **kwargs)
+    if as_frame:
+        return pd.DataFrame(result['scores'], columns=result['columns'])
+    return result
+
+
+def wait_until_ready(timeout=600, **kwargs):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return request("GET", "/health", timeout=5, **kwargs)
+        except (OSError, http.client.HTTPException):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
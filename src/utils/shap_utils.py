@@ -17,7 +17,8 @@ import sys
 sys.path.append('..')
 from generators.variant_generator import VariantGenerator
 from generators.peak_generator import PeakGenerator
-from utils import argmanager, losses
+from utils import argmanager, losses, instrument, autobatch
+from utils.helpers import load_model_wrapper
 import shap
 from deeplift.dinuc_shuffle import dinuc_shuffle
 tf.compat.v1.disable_v2_behavior()
@@ -100,14 +101,177 @@ def get_weightedsum_meannormed_logits(model):
     return weightedsum_meannormed_logits
 
 
-def fetch_shap(model, variants_table, input_len, genome_fasta, batch_size, debug_mode=False, lite=False, bias=None, shuf=False,shap_type="counts"):
+class SharedShuffles:
+    '''
+    Background function for TFDeepExplainer that hands every explainer the same
+    dinucleotide-shuffled references for a given sequence, so counts and
+    profile attributions share one round of shuffling. Call clear() between
+    chunks to bound memory.
+    '''
+    def __init__(self):
+        self.refs = {}
+
+    def __call__(self, s):
+        key = s[0].tobytes()
+        if key not in self.refs:
+            # dinuc_shuffle returns float64 one-hot; int8 is 8x smaller to hold
+            self.refs[key] = shuffle_several_times([s[0]])[0].astype(np.int8)
+        refs = self.refs[key]
+        if len(s)==2:
+            return [refs, np.array([s[1] for i in range(len(refs))])]
+        else:
+            return [refs]
+
+    def clear(self):
+        self.refs = {}
+
+
+class GradientExplainer:
+    '''
+    Cheap stand-in for TFDeepExplainer with the same shap_values interface.
+    With ig_steps=1 this is gradient x input; with more steps it is
+    integrated gradients from an all-zero reference, using midpoint steps.
+    The returned values are the (path-averaged) gradients mean-normalised
+    across ACGT, i.e. hypothetical contributions, so multiplying by the
+    one-hot input gives the attribution exactly as for DeepSHAP.
+    '''
+    def __init__(self, model_input, model_output, ig_steps=1):
+        if type(model_input) != list:
+            model_input = [model_input]
+        self.model_input = model_input
+        # the sum over the batch has per-example gradients, examples are independent
+        self.grads = tf.gradients(tf.reduce_sum(model_output), model_input[0])[0]
+        self.session = tf.compat.v1.keras.backend.get_session()
+        self.ig_steps = ig_steps
+
+    def shap_values(self, X, progress_message=None):
+        multi_input = type(X) == list
+        if not multi_input:
+            X = [X]
+
+        if self.ig_steps == 1:
+            alphas = [1.0]
+        else:
+            alphas = (np.arange(self.ig_steps) + 0.5) / self.ig_steps
+
+        grads = np.zeros(X[0].shape, dtype=np.float32)
+        for alpha in alphas:
+            feed_dict = {self.model_input[0]: alpha * X[0]}
+            for l in range(1, len(X)):
+                feed_dict[self.model_input[l]] = X[l]
+            grads += self.session.run(self.grads, feed_dict=feed_dict)
+        grads = grads / len(alphas)
+        grads = grads - np.mean(grads, axis=-1, keepdims=True)
+
+        if multi_input:
+            return [grads] + [np.zeros_like(X[l]) for l in range(1, len(X))]
+        return grads
+
+
+def get_shap_explainers(models, shap_types, lite=False, attribution="deepshap", ig_steps=10):
+    '''
+    Builds one explainer per requested shap type and model, returned as
+    {shap_type: [explainer per model]}. The explainers add ops to the graph,
+    so they are built once and reused for every batch. All of them share one
+    background function, so every model sees the same shuffled references.
+    attribution is one of deepshap, grad_x_input or integrated_gradients.
+    '''
+    background = SharedShuffles()
+    explainers = {shap_type: [] for shap_type in shap_types}
+    for model in models:
+        for shap_type in shap_types:
+            if shap_type == "counts":
+                if lite:
+                    model_input = [model.input[0], model.input[2]]
+                else:
+                    model_input = model.input
+                model_output = tf.reduce_sum(model.outputs[1], axis=-1)
+            else:
+                assert shap_type == "profile"
+                if lite:
+                    model_input = [model.input[0], model.input[1]]
+                else:
+                    model_input = model.input
+                model_output = get_weightedsum_meannormed_logits(model)
+
+            if attribution == "deepshap":
+                explainer = shap.explainers.deep.TFDeepExplainer(
+                    (model_input, model_output),
+                    background,
+                    combine_mult_and_diffref=combine_mult_and_diffref)
+            elif attribution == "grad_x_input":
+                explainer = GradientExplainer(model_input, model_output, ig_steps=1)
+            else:
+                assert attribution == "integrated_gradients"
+                explainer = GradientExplainer(model_input, model_output, ig_steps=ig_steps)
+            explainers[shap_type].append(explainer)
+
+    return explainers, background
+
+
+def get_shap_output_names(shap_types, num_models, save_folds=False):
+    # the cross-model mean is stored under the shap type, folds under <type>.fold_<i>
+    names = []
+    for shap_type in shap_types:
+        names.append(shap_type)
+        if save_folds:
+            names.extend(["%s.fold_%d" % (shap_type, fold) for fold in range(num_models)])
+    return names
+
+
+def get_explainer_input(model, seqs, shap_type, lite=False):
+    if not lite:
+        return seqs
+    if shap_type == "counts":
+        return [seqs, np.zeros((seqs.shape[0], 1))]
+    else:
+        assert shap_type == "profile"
+        return [seqs, np.zeros((seqs.shape[0], model.output_shape[0][1]))]
+
+
+def explain_chunk(model, chunk_seqs, explainers, lite=False, save_folds=False):
+    '''
+    Returns the attributions of one chunk of sequences keyed by
+    get_shap_output_names, as the running mean over each shap type's models.
+    '''
+    chunk_outputs = {}
+    for shap_type, model_explainers in explainers.items():
+        explainer_input = get_explainer_input(model, chunk_seqs, shap_type, lite=lite)
+        chunk_mean = None
+        for fold, explainer in enumerate(model_explainers):
+            with instrument.stage("shap.explain." + shap_type, items=len(chunk_seqs)):
+                chunk_shap = explainer.shap_values(explainer_input, progress_message=10)
+            if lite:
+                chunk_shap = chunk_shap[0] * chunk_seqs
+            chunk_shap = np.array(chunk_shap, dtype=np.float32)
+            if save_folds:
+                chunk_outputs["%s.fold_%d" % (shap_type, fold)] = chunk_shap
+            if chunk_mean is None:
+                chunk_mean = chunk_shap.copy()
+            else:
+                chunk_mean += (chunk_shap - chunk_mean) / (fold + 1)
+        chunk_outputs[shap_type] = chunk_mean
+    return chunk_outputs
+
+
+def fetch_shap(model, variants_table, input_len, genome_fasta, batch_size, explainers, background,
+               debug_mode=False, lite=False, bias=None, shuf=False, save_folds=False, chunk_size=256):
+    '''
+    Returns variant ids, the allele1 and allele2 one-hot inputs, and dicts of
+    allele1 and allele2 attributions keyed by get_shap_output_names. Every
+    explainer sees the same extracted sequences and the same shuffled
+    references; attributions from several models are combined as a running
+    mean per chunk, so per-fold arrays are only kept when save_folds is set.
+    With chunk_size "auto" the chunk size is calibrated on the first batch,
+    and a chunk that runs out of memory is explained again at half the size.
+    '''
     variant_ids = []
-    allele1_counts_shap = []
-    allele2_counts_shap = []
-    allele1_profile_shap = []
-    allele2_profile_shap = []
     allele1_inputs = []
     allele2_inputs = []
+    num_models = len(next(iter(explainers.values())))
+    output_names = get_shap_output_names(list(explainers), num_models, save_folds=save_folds)
+    allele1_shap = {name: [] for name in output_names}
+    allele2_shap = {name: [] for name in output_names}
 
     # variant sequence generator
     var_gen = VariantGenerator(variants_table=variants_table,
@@ -117,110 +281,197 @@ def fetch_shap(model, variants_table, input_len, genome_fasta, batch_size, debug
                            debug_mode=False,
                            shuf=shuf)
 
-    for i in tqdm(range(len(var_gen))):
-
-        batch_variant_ids, allele1_seqs, allele2_seqs = var_gen[i]
-
-        if lite:
-            if shap_type == "counts":
-                counts_model_input = [model.input[0], model.input[2]]
-                allele1_input = [allele1_seqs, np.zeros((allele1_seqs.shape[0], 1))]
-                allele2_input = [allele2_seqs, np.zeros((allele2_seqs.shape[0], 1))]
-
-                profile_model_counts_explainer = shap.explainers.deep.TFDeepExplainer(
-                    (counts_model_input, tf.reduce_sum(model.outputs[1], axis=-1)),
-                    shuffle_several_times,
-                    combine_mult_and_diffref=combine_mult_and_diffref)
-
-                allele1_counts_shap_batch = profile_model_counts_explainer.shap_values(
-                    allele1_input, progress_message=10)
-                allele2_counts_shap_batch = profile_model_counts_explainer.shap_values(
-                    allele2_input, progress_message=10)
-
-                allele1_counts_shap_batch = allele1_counts_shap_batch[0] * allele1_input[0]
-                allele2_counts_shap_batch = allele2_counts_shap_batch[0] * allele2_input[0]
+    auto = chunk_size == autobatch.AUTO
+    calibration_key = ('shap', id(model), tuple(explainers), lite, save_folds)
 
-                allele1_counts_shap.extend(allele1_counts_shap_batch)
-                allele2_counts_shap.extend(allele2_counts_shap_batch)
+    def calibration_run(seqs):
+        explain_chunk(model, seqs, explainers, lite=lite, save_folds=save_folds)
+        background.clear()
 
-            else:
-                assert shap_type == "profile"
-                profile_model_input = [model.input[0], model.input[1]]
-                outlen = model.output_shape[0][1]
-                
-                allele1_input = [allele1_seqs, np.zeros((allele1_seqs.shape[0], outlen))]
-                allele2_input = [allele2_seqs, np.zeros((allele2_seqs.shape[0], outlen))]
-                
-                weightedsum_meannormed_logits = get_weightedsum_meannormed_logits(model)
-                profile_model_profile_explainer = shap.explainers.deep.TFDeepExplainer(
-                    (profile_model_input, weightedsum_meannormed_logits),
-                    shuffle_several_times,
-                    combine_mult_and_diffref=combine_mult_and_diffref)
-                
-                allele1_profile_shap_batch = profile_model_profile_explainer.shap_values(
-                    allele1_input, progress_message=10)
-                allele2_profile_shap_batch = profile_model_profile_explainer.shap_values(
-                    allele2_input, progress_message=10)
-                
-                allele1_profile_shap_batch = allele1_profile_shap_batch[0] * allele1_input[0]
-                allele2_profile_shap_batch = allele2_profile_shap_batch[0] * allele2_input[0]
-
-                allele1_profile_shap.extend(allele1_profile_shap_batch)
-                allele2_profile_shap.extend(allele2_profile_shap_batch)
-
-        else:
-            allele1_input = allele1_seqs
-            allele2_input = allele2_seqs
-
-            if shap_type == "counts":
-                counts_model_input = model.input
-                profile_model_counts_explainer = shap.explainers.deep.TFDeepExplainer(
-                    (counts_model_input, tf.reduce_sum(model.outputs[1], axis=-1)),
-                    shuffle_several_times,
-                    combine_mult_and_diffref=combine_mult_and_diffref)
-
-                allele1_counts_shap_batch = profile_model_counts_explainer.shap_values(
-                    allele1_input, progress_message=10)
-                allele2_counts_shap_batch = profile_model_counts_explainer.shap_values(
-                    allele2_input, progress_message=10)
-
-                # allele1_counts_shap_batch = allele1_counts_shap_batch * allele1_input
-                # allele2_counts_shap_batch = allele2_counts_shap_batch * allele2_input
-
-                allele1_counts_shap.extend(allele1_counts_shap_batch)
-                allele2_counts_shap.extend(allele2_counts_shap_batch)
-
-                allele1_inputs.extend(allele1_input)
-                allele2_inputs.extend(allele2_input)
-
-            else:
-                assert shap_type == "profile"
-                profile_model_input = model.input
-                weightedsum_meannormed_logits = get_weightedsum_meannormed_logits(model)
-                profile_model_profile_explainer = shap.explainers.deep.TFDeepExplainer(
-                    (profile_model_input, weightedsum_meannormed_logits),
-                    shuffle_several_times,
-                    combine_mult_and_diffref=combine_mult_and_diffref)
-                
-                allele1_profile_shap_batch = profile_model_profile_explainer.shap_values(
-                    allele1_input, progress_message=10)
-                allele2_profile_shap_batch = profile_model_profile_explainer.shap_values(
-                    allele2_input, progress_message=10) 
-
-                # allele1_profile_shap_batch = allele1_profile_shap_batch * allele1_input
-                # allele2_profile_shap_batch = allele2_profile_shap_batch * allele2_input
-
-                allele1_profile_shap.extend(allele1_profile_shap_batch)
-                allele2_profile_shap.extend(allele2_profile_shap_batch)
-
-                allele1_inputs.extend(allele1_input)
-                allele2_inputs.extend(allele2_input)
+    for i in tqdm(range(len(var_gen))):
 
+        batch_variant_ids, allele1_seqs, allele2_seqs = var_gen[i]
+        chunk_size = autobatch.resolve(chunk_size, calibration_key, calibration_run,
+                                       lambda: allele1_seqs, autobatch.SHAP_CANDIDATES, repeats=1)
+
+        for seqs, allele_shap in [(allele1_seqs, allele1_shap), (allele2_seqs, allele2_shap)]:
+            start = 0
+            while start < len(seqs):
+                chunk_seqs = seqs[start:start + chunk_size]
+                try:
+                    chunk_outputs = explain_chunk(model, chunk_seqs, explainers, lite=lite, save_folds=save_folds)
+                except Exception as e:
+                    if not autobatch.is_oom(e) or chunk_size == 1:
+                        raise
+                    chunk_size = max(1, chunk_size // 2)
+                    print("out of memory, explaining the chunk again with chunk size", chunk_size)
+                    if auto:
+                        # later batches in this process start from the smaller size
+                        autobatch.calibrated[calibration_key] = chunk_size
+                    continue
+                for name in output_names:
+                    allele_shap[name].extend(chunk_outputs[name])
+                start += len(chunk_seqs)
+                background.clear()
+
+        allele1_inputs.extend(allele1_seqs)
+        allele2_inputs.extend(allele2_seqs)
         variant_ids.extend(batch_variant_ids)
 
-    if shap_type == "counts":
-        return np.array(variant_ids), np.array(allele1_inputs), np.array(allele2_inputs), \
-               np.array(allele1_counts_shap), np.array(allele2_counts_shap)
-    else:
-        return np.array(variant_ids), np.array(allele1_inputs), np.array(allele2_inputs), \
-               np.array(allele1_profile_shap), np.array(allele2_profile_shap)
+    allele1_shap = {name: np.array(allele1_shap[name]) for name in allele1_shap}
+    allele2_shap = {name: np.array(allele2_shap[name]) for name in allele2_shap}
+    return np.array(variant_ids), np.array(allele1_inputs), np.array(allele2_inputs), \
+           allele1_shap, allele2_shap
+
+
+shap_worker = {}
+
+def init_shap_worker(model_files, shap_types, lite=False, attribution="deepshap", ig_steps=10, threads=None, models=None):
+    '''
+    Loads the models and builds the explainers once per process. With threads
+    set, the TF session is limited to that many threads so that several
+    workers on one node don't oversubscribe the cores (OpenMP is limited
+    through the environment the workers are spawned with). Already loaded
+    models can be passed in to run in the current process.
+    '''
+    if threads is not None:
+        config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=threads,
+                                          inter_op_parallelism_threads=threads)
+        tf.compat.v1.keras.backend.set_session(tf.compat.v1.Session(config=config))
+    if models is None:
+        models = [load_model_wrapper(model_file) for model_file in model_files]
+    for other_model in models[1:]:
+        assert other_model.input_shape == models[0].input_shape, "all models must have the same input shape"
+    explainers, background = get_shap_explainers(models, shap_types, lite=lite,
+                                                 attribution=attribution, ig_steps=ig_steps)
+    shap_worker.update(models=models, explainers=explainers, background=background)
+
+
+def run_shap_worker(task):
+    '''
+    Explains one chunk of variants with the explainers set up by
+    init_shap_worker and returns it already windowed, tagged with its start row.
+    '''
+    start, sub_table, input_len, genome_fasta, lite, save_folds, shap_window, chunk_size = task
+    var_ids, allele1_inputs, allele2_inputs, \
+    allele1_shap, allele2_shap = fetch_shap(shap_worker['models'][0],
+                                            sub_table,
+                                            input_len,
+                                            genome_fasta,
+                                            len(sub_table),
+                                            shap_worker['explainers'],
+                                            shap_worker['background'],
+                                            lite=lite,
+                                            shuf=False,
+                                            save_folds=save_folds,
+                                            chunk_size=chunk_size)
+    allele1_shap = {name: get_central_window(allele1_shap[name], shap_window) for name in allele1_shap}
+    allele2_shap = {name: get_central_window(allele2_shap[name], shap_window) for name in allele2_shap}
+    return start, var_ids, get_central_window(allele1_inputs, shap_window), \
+           get_central_window(allele2_inputs, shap_window), allele1_shap, allele2_shap
+
+
+def get_central_window(arrays, width):
+    # arrays are N x L x 4; keep only the `width` bp centred on the variant,
+    # which VariantGenerator places at index L // 2
+    if width is None:
+        return arrays
+    seq_len = arrays.shape[1]
+    assert width <= seq_len, "window width exceeds the model input length"
+    start = seq_len // 2 - width // 2
+    return arrays[:, start:start + width]
+
+
+class ShapH5Writer:
+    '''
+    Writes SHAP results batch by batch into an h5 file laid out like the
+    chrombpnet/deepdish output that finemo reads: raw/seq, shap/seq and
+    projected_shap/seq of shape 2N x 4 x L (allele1 regions, then allele2
+    regions), plus variant_ids and alleles. The arrays are gzip-compressed
+    rather than blosc-compressed, so plain h5py reads them too, and
+    variant_ids is stored the way deepdish stores a unicode array (UTF-32
+    bytes with strtype and itemsize attributes), so dd.io.load still returns
+    the same dict. id_len is the longest variant id.
+    '''
+    def __init__(self, out_file, num_variants, seq_len, id_len):
+        self.num_variants = num_variants
+        self.id_len = max(1, id_len)
+        self.f = h5py.File(out_file, 'w')
+        shape = (2 * num_variants, 4, seq_len)
+        chunks = (min(2 * num_variants, 64), 4, seq_len)
+        self.raw = self.f.create_group('raw').create_dataset('seq', shape, dtype=np.int8, chunks=chunks,
+                                                             compression='gzip', compression_opts=9)
+        self.shap = self.f.create_group('shap').create_dataset('seq', shape, dtype=np.float16, chunks=chunks,
+                                                               compression='gzip', compression_opts=9)
+        self.projected_shap = self.f.create_group('projected_shap').create_dataset('seq', shape, dtype=np.float16, chunks=chunks,
+                                                                                   compression='gzip', compression_opts=9)
+        self.variant_ids = self.f.create_dataset('variant_ids', (2 * num_variants * self.id_len * 4,), dtype=np.uint8,
+                                                 chunks=True, compression='gzip', compression_opts=9)
+        self.variant_ids.attrs['strtype'] = np.bytes_(b'unicode')
+        self.variant_ids.attrs['itemsize'] = np.int64(self.id_len)
+        self.f.create_dataset('alleles', data=np.concatenate((np.array([0] * num_variants),
+                                                              np.array([1] * num_variants))))
+
+    def write(self, start, variant_ids, allele1_seqs, allele2_seqs, allele1_scores, allele2_scores):
+        assert(allele1_seqs.shape==allele1_scores.shape)
+        assert(allele2_seqs.shape==allele2_scores.shape)
+        assert(allele1_seqs.shape==allele2_seqs.shape)
+        assert(allele1_seqs.shape[2]==4)
+        assert(len(allele1_seqs)==len(variant_ids))
+        end = start + len(variant_ids)
+        variant_ids = np.array([str(x) for x in variant_ids])
+        assert(variant_ids.dtype.itemsize // 4 <= self.id_len)
+        id_bytes = variant_ids.astype((np.str_, self.id_len)).view(np.uint8)
+        id_width = self.id_len * 4
+        for offset, seqs, scores in [(0, allele1_seqs, allele1_scores),
+                                     (self.num_variants, allele2_seqs, allele2_scores)]:
+            self.raw[offset + start:offset + end] = np.transpose(seqs, (0, 2, 1)).astype(np.int8)
+            self.shap[offset + start:offset + end] = np.transpose(scores, (0, 2, 1)).astype(np.float16)
+            self.projected_shap[offset + start:offset + end] = np.transpose(seqs * scores, (0, 2, 1)).astype(np.float16)
+            self.variant_ids[(offset + start) * id_width:(offset + end) * id_width] = id_bytes
+
+    def close(self):
+        self.f.close()
+
+
+class ShapNpzWriter:
+    '''
+    Collects SHAP results into the npz layout `finemo extract-regions-chrombpnet-h5`
+    produces: sequences (int8) and contributions (float16) of shape 2N x 4 x W,
+    allele1 regions followed by allele2 regions. npz members cannot be
+    appended to out of order, so batches go to memory-mapped scratch arrays
+    next to the output (profile_store.allocate) and are streamed into the
+    compressed npz on close, PROFILE_CHUNK_SIZE regions at a time.
+    '''
+    def __init__(self, out_file, num_variants, seq_len):
+        from utils import profile_store
+
+        self.out_file = out_file
+        self.num_variants = num_variants
+        scratch_dir = os.path.dirname(os.path.abspath(out_file))
+        self.sequences = profile_store.allocate((2 * num_variants, 4, seq_len), scratch_dir, dtype=np.int8)
+        self.contributions = profile_store.allocate((2 * num_variants, 4, seq_len), scratch_dir, dtype=np.float16)
+
+    def write(self, start, variant_ids, allele1_seqs, allele2_seqs, allele1_scores, allele2_scores):
+        assert(allele1_seqs.shape==allele1_scores.shape)
+        assert(allele2_seqs.shape==allele2_scores.shape)
+        assert(len(allele1_seqs)==len(variant_ids))
+        end = start + len(variant_ids)
+        for offset, seqs, scores in [(0, allele1_seqs, allele1_scores),
+                                     (self.num_variants, allele2_seqs, allele2_scores)]:
+            self.sequences[offset + start:offset + end] = np.transpose(seqs, (0, 2, 1)).astype(np.int8)
+            self.contributions[offset + start:offset + end] = np.transpose(scores, (0, 2, 1)).astype(np.float16)
+
+    def close(self):
+        # the same members np.savez_compressed writes
+        import zipfile
+        from utils import profile_store
+
+        with zipfile.ZipFile(self.out_file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for name, array in [('sequences', self.sequences), ('contributions', self.contributions)]:
+                with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array_header_1_0(f, np.lib.format.header_data_from_array_1_0(array))
+                    for rows in profile_store.chunks(len(array)):
+                        f.write(np.ascontiguousarray(array[rows]).tobytes())
+        self.sequences = None
+        self.contributions = None
@@ -0,0 +1,116 @@
+"""
+Streaming variant list reader.
+
+    for chunk in variant_reader.read_variant_chunks("1kg.vcf.gz", "vcf", chunk_size=100000, region="chr22"):
+        ...
+
+reads a variant list in chunks of chunk_size records, so scoring can start
+on the first chunk and memory stays bounded by the chunk size. Plain, gzip
+and bgzip files are read in every schema of get_variant_schema, including
+"vcf".
+With region (tabix "chr", "chr:start-end" or several separated by commas),
+only the matching records of a bgzip file with a tabix index are read.
+
+Chunks have the same columns and types as load_variant_table: chr with the
+"chr" prefix, a 1-based int64 pos, allele1/allele2 as strings with "-" for
+empty alleles and a string variant_id. VCF records become one row per ALT
+allele, with REF as allele1, the ID as variant_id (suffixed with ":<ALT>"
+for multi-allelic records) and chr:pos:REF:ALT when the ID is missing.
+Symbolic, breakend and spanning-deletion ALTs cannot be scored and are
+skipped.
+"""
+
+import io
+
+import numpy as np
+import pandas as pd
+
+from utils.helpers import get_variant_schema, format_variant_table
+
+
+DEFAULT_CHUNK_SIZE = 100000
+STRING_COLUMNS = ['chr', 'allele1', 'allele2', 'variant_id']
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def read_options(schema):
+    if schema == "vcf":
+        # only the first five columns are needed; header lines start with '#'
+        names = get_variant_schema(schema)
+        return dict(names=names, usecols=list(range(len(names))), comment='#',
+                    dtype={x: str for x in names if x in STRING_COLUMNS})
+    names = get_variant_schema(schema)
+    return dict(names=names, dtype={x: str for x in names if x in STRING_COLUMNS})
+
+
+def split_alleles(chunk):
+    # one row per ALT allele of multi-allelic records
+    alts = chunk['allele2'].fillna('.').str.split(',')
+    multi_allelic = (alts.str.len() > 1).to_numpy()
+    chunk = chunk.assign(allele2=alts, multi_allelic=multi_allelic).explode('allele2', ignore_index=True)
+    scorable = ~(chunk['allele2'].isin(['.', '*']) | chunk['allele2'].str.contains(r'[<\[\]]', regex=True))
+    chunk = chunk.loc[scorable.to_numpy()].reset_index(drop=True)
+
+    missing_id = chunk['variant_id'].isna() | (chunk['variant_id'] == '.')
+    default_id = chunk['chr'] + ':' + chunk['pos'].astype(str) + ':' + chunk['allele1'] + ':' + chunk['allele2']
+    multi_id = chunk['variant_id'] + ':' + chunk['allele2']
+    chunk['variant_id'] = np.where(missing_id, default_id, np.where(chunk['multi_allelic'].to_numpy(dtype=bool), multi_id, chunk['variant_id']))
+    return chunk.drop(columns=['multi_allelic'])
+
+
+def format_chunk(raw_chunk, schema):
+    chunk = format_variant_table(raw_chunk, schema)
+    if schema == "vcf":
+        chunk = split_alleles(chunk)
+    chunk['pos'] = chunk['pos'].astype(np.int64)
+    chunk[['allele1', 'allele2']] = chunk[['allele1', 'allele2']].fillna('-')
+    chunk['variant_id'] = chunk['variant_id'].astype(str)
+    return chunk
+
+
+def iter_region_lines(path, region):
+    import pysam
+
+    with pysam.TabixFile(path) as tabix:
+        for x in region.split(','):
+            # tabix regions are 1-based; an unknown contig has no records
+            if x.split(':')[0] not in tabix.contigs:
+                continue
+            yield from tabix.fetch(region=x)
+
+
+def iter_raw_chunks(path, schema, chunk_size, region=None):
+    options = read_options(schema)
+    if region is None:
+        compression = 'gzip' if is_gzip(path) else None
+        yield from pd.read_csv(path, header=None, sep='\t', chunksize=chunk_size, compression=compression, **options)
+        return
+
+    lines = []
+    for line in iter_region_lines(path, region):
+        lines.append(line)
+        if len(lines) == chunk_size:
+            yield pd.read_csv(io.StringIO('\n'.join(lines)), header=None, sep='\t', **options)
+            lines = []
+    if lines:
+        yield pd.read_csv(io.StringIO('\n'.join(lines)), header=None, sep='\t', **options)
+
+
+def read_variant_chunks(path, schema, chunk_size=DEFAULT_CHUNK_SIZE, region=None, chrom=None):
+    for raw_chunk in iter_raw_chunks(path, schema, chunk_size, region=region):
+        chunk = format_chunk(raw_chunk, schema)
+        if chrom is not None:
+            chunk = chunk.loc[chunk['chr'] == chrom].reset_index(drop=True)
+        if len(chunk) > 0:
+            yield chunk
+
+
+def read_variant_table(path, schema, region=None, chrom=None):
+    chunks = list(read_variant_chunks(path, schema, region=region, chrom=chrom))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=[x for x in get_variant_schema(schema) if not x.startswith('ignore')])
+    return pd.concat(chunks, ignore_index=True)
@@ -0,0 +1,127 @@
+"""
+Compact variant tables, vectorized validation and the prepared-input cache.
+
+compact_variant_table() turns the object columns of a variant table into
+categoricals (chr, allele1, allele2) and pos into int32, which cuts the
+memory of a large list several-fold; values still read back as plain str
+and int, so the generators and score writers are unchanged.
+
+validate_variants() and validate_peaks() apply the bounds checks of
+get_valid_variants and get_valid_peaks to whole columns at once and count
+the dropped rows per reason:
+
+    unknown_chrom   chromosome not in the chrom sizes
+    left_edge       input window starts before the chromosome
+    right_edge      input window ends past the chromosome
+
+A prepared table (parsed, compacted and validated) can be cached with
+save_prepared() and found again with load_prepared(). The cache key is the
+sha256 of the list plus everything that changes the result (schema, region,
+chromosome, input length and chrom sizes), so repeated runs over the same
+list skip parsing and validation:
+
+    <cache_dir>/<key>.variants.pkl
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.model_cache import model_hash as file_hash
+
+
+CATEGORICAL_COLUMNS = ['chr', 'allele1', 'allele2']
+DROP_REASONS = ['unknown_chrom', 'left_edge', 'right_edge']
+
+
+def fill_missing_alleles(variants_table):
+    for column in ['allele1', 'allele2']:
+        values = variants_table[column]
+        if not values.isna().any():
+            continue
+        if isinstance(values.dtype, pd.CategoricalDtype) and '-' not in values.cat.categories:
+            values = values.cat.add_categories('-')
+        variants_table[column] = values.fillna('-')
+    return variants_table
+
+
+def compact_variant_table(variants_table):
+    variants_table = fill_missing_alleles(variants_table)
+    for column in CATEGORICAL_COLUMNS:
+        if not isinstance(variants_table[column].dtype, pd.CategoricalDtype):
+            variants_table[column] = variants_table[column].astype(str).astype('category')
+    variants_table['pos'] = variants_table['pos'].astype(np.int32)
+    return variants_table
+
+
+def check_bounds(chroms, centers, input_len, chrom_sizes_dict):
+    # the same checks as get_valid_variants, one boolean per row and reason
+    chroms = pd.Series(chroms)
+    if isinstance(chroms.dtype, pd.CategoricalDtype):
+        # look up each category once; code -1 (missing) picks the trailing nan
+        category_sizes = pd.Series(chroms.cat.categories).map(chrom_sizes_dict).to_numpy(dtype=np.float64)
+        chrom_sizes = np.append(category_sizes, np.nan)[chroms.cat.codes.to_numpy()]
+    else:
+        chrom_sizes = chroms.map(chrom_sizes_dict).to_numpy(dtype=np.float64)
+    flank = input_len // 2
+    centers = np.asarray(centers, dtype=np.int64)
+    unknown_chrom = np.isnan(chrom_sizes)
+    left_edge = ~unknown_chrom & (centers - flank <= 0)
+    right_edge = ~unknown_chrom & ~left_edge & ~(centers + flank <= chrom_sizes)
+    valid = ~(unknown_chrom | left_edge | right_edge)
+    drop_counts = dict(zip(DROP_REASONS, [int(x.sum()) for x in [unknown_chrom, left_edge, right_edge]]))
+    return valid, drop_counts
+
+
+def print_drop_counts(name, drop_counts):
+    dropped = {k: v for k, v in drop_counts.items() if v > 0}
+    if dropped:
+        print("Dropped %s:" % name, ", ".join("%d %s" % (v, k) for k, v in dropped.items()))
+
+
+def validate_variants(variants_table, input_len, chrom_sizes_dict):
+    valid, drop_counts = check_bounds(variants_table['chr'], variants_table['pos'], input_len, chrom_sizes_dict)
+    print_drop_counts("variants", drop_counts)
+    return variants_table.loc[valid].reset_index(drop=True), drop_counts
+
+
+def validate_peaks(peaks, input_len, chrom_sizes_dict):
+    valid, drop_counts = check_bounds(peaks['chr'], peaks['start'] + peaks['summit'], input_len, chrom_sizes_dict)
+    print_drop_counts("peaks", drop_counts)
+    return peaks.loc[valid].reset_index(drop=True), drop_counts
+
+
+def prepared_key(variants_file, schema, input_len, chrom_sizes_dict, region=None, chrom=None):
+    key = {'file': file_hash(variants_file),
+           'schema': schema,
+           'region': region,
+           'chrom': chrom,
+           'input_len': input_len,
+           'chrom_sizes': sorted(chrom_sizes_dict.items()),
+           'pandas': pd.__version__}
+    return hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest()
+
+
+def prepared_path(cache_dir, key):
+    return os.path.join(cache_dir, "%s.variants.pkl" % key)
+
+
+def load_prepared(cache_dir, key):
+    path = prepared_path(cache_dir, key)
+    if not os.path.isfile(path):
+        return None
+    print("loading prepared variants", path)
+    return pd.read_pickle(path)
+
+
+def save_prepared(variants_table, cache_dir, key):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = prepared_path(cache_dir, key)
+    tmp_path = path + ".tmp.%d" % os.getpid()
+    variants_table.to_pickle(tmp_path, protocol=5)
+    os.replace(tmp_path, path)
+    print("prepared variants written to", path)
+    return path
@@ -2,12 +2,14 @@ import pandas as pd
 import pybedtools
 from utils.argmanager import *
 from utils.helpers import *
+from utils import instrument
 pd.set_option('display.max_columns', 20)
 
 
 def main():
     args = fetch_variant_annotation_args()
     print(args)
+    instrument.report_at_exit(args.out_prefix + ".stage_report.json")
     variant_scores_file = args.list
     output_prefix = args.out_prefix
     peak_path = args.peaks
@@ -39,9 +41,10 @@ def main():
         print("annotating with closest genes")
         gene_df = pd.read_table(genes, header=None)
         gene_bed = pybedtools.BedTool.from_dataframe(gene_df)
-        closest_genes_bed = variant_bed.closest(gene_bed, d=True, t='first', k=3)
+        with instrument.stage("annotate.closest_genes", items=len(variant_scores)):
+            closest_genes_bed = variant_bed.closest(gene_bed, d=True, t='first', k=3)
 
-        closest_gene_df = closest_genes_bed.to_dataframe(header=None)
+            closest_gene_df = closest_genes_bed.to_dataframe(header=None)
 
         print()
         print(closest_gene_df.head())
@@ -79,9 +82,10 @@ def main():
         print("annotating with peak overlap")
         peak_df = pd.read_table(peak_path, header=None)
         peak_bed = pybedtools.BedTool.from_dataframe(peak_df)
-        peak_intersect_bed = variant_bed.intersect(peak_bed, wa=True, u=True)
+        with instrument.stage("annotate.peak_overlap", items=len(variant_scores)):
+            peak_intersect_bed = variant_bed.intersect(peak_bed, wa=True, u=True)
 
-        peak_intersect_df = peak_intersect_bed.to_dataframe(names=variant_scores_bed_format.columns.tolist())
+            peak_intersect_df = peak_intersect_bed.to_dataframe(names=variant_scores_bed_format.columns.tolist())
 
         print()
         print(peak_intersect_df.head())
@@ -96,7 +100,8 @@ def main():
     print()
 
     out_file = output_prefix + ".annotations.tsv"
-    variant_scores.to_csv(out_file, sep="\t", index=False)
+    with instrument.stage("write.annotations", items=len(variant_scores)):
+        variant_scores.to_csv(out_file, sep="\t", index=False)
 
     print("DONE")
     print()
@@ -0,0 +1,70 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils import argmanager, server
+from utils.scoring import ScoringSession
+
+
+def model_name(model_arg):
+    if '=' in model_arg:
+        return model_arg.split('=', 1)
+    return os.path.basename(model_arg).rsplit('.', 1)[0], model_arg
+
+
+def main():
+    args = argmanager.fetch_server_args()
+
+    np.random.seed(args.random_seed)
+
+    # every model is loaded, and its peaks scored, before the first request
+    models = [model_name(x) for x in args.model]
+    if len(set(name for name, _ in models)) != len(models):
+        raise ValueError("model names must be unique, use name=path")
+    nulls = args.null if args.null is not None else [None] * len(models)
+
+    # a single inference thread shared by all models
+    executor = ThreadPoolExecutor(max_workers=1)
+    batchers = {}
+    for (name, model_file), null in zip(models, nulls):
+        print("loading", name, "from", model_file)
+        session = ScoringSession(model_file,
+                                 args.genome,
+                                 args.chrom_sizes,
+                                 peaks=args.peaks,
+                                 null=null,
+                                 peak_genome=args.peak_genome,
+                                 peak_chrom_sizes=args.peak_chrom_sizes,
+                                 lite=args.lite,
+                                 batch_size=args.batch_size,
+                                 forward_only=args.forward_only,
+                                 counts_only=args.counts_only,
+                                 scoring_head=args.scoring_head,
+                                 predict_mode=args.predict_mode,
+                                 model_cache=args.model_cache,
+                                 quantize=args.quantize,
+                                 tflite_threads=args.tflite_threads,
+                                 max_peaks=args.max_peaks,
+                                 random_seed=args.random_seed,
+                                 prediction_cache=args.prediction_cache,
+                                 prediction_cache_size=args.prediction_cache_size)
+        if session.peaks is not None:
+            session.score_peaks()
+        if session.null is None:
+            print("no null for", name, ", scores will not have p-values")
+        else:
+            print("null for", name, "has", len(session.null), "shuffled variants")
+        batchers[name] = server.MicroBatcher(session, executor, args.max_batch, args.max_latency_ms / 1000)
+
+    try:
+        asyncio.run(server.serve(batchers, host=args.host, port=args.port, unix_socket=args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,19 +9,21 @@ import argparse
 import numpy as np
 import h5py
 import math
+import multiprocessing
 from generators.variant_generator import VariantGenerator
 from generators.peak_generator import PeakGenerator
-from utils import argmanager, losses
+from utils import argmanager, losses, instrument
+from utils.variant_table import validate_variants
 from utils.helpers import *
 import shap
 from utils.shap_utils import *
-import deepdish as dd
 tf.compat.v1.disable_v2_behavior()
 
 
 def main():
     args = argmanager.fetch_shap_args()
     print(args)
+    instrument.report_at_exit(''.join([args.out_prefix, ".stage_report.json"]))
 
     out_dir = os.path.sep.join(args.out_prefix.split(os.path.sep)[:-1])
     print()
@@ -30,9 +32,23 @@ def main():
     if not os.path.exists(out_dir):
         raise OSError("Output directory does not exist")
 
-    model = load_model_wrapper(args.model)
-    variants_table = load_variant_table(args.list, args.schema)
-    variants_table = variants_table.fillna('-')
+    # several models (e.g. one per fold) share sequence extraction and backgrounds;
+    # with worker processes each worker loads them all, and here the first gives the input length
+    models = [load_model_wrapper(model_file) for model_file in (args.model if args.num_workers == 1 else args.model[:1])]
+    model = models[0]
+    if args.score_file:
+        scores_table = load_score_table(args.score_file, args.schema)
+        print("Score table shape:", scores_table.shape)
+        variants_table = select_variants(scores_table,
+                                         args.select_by,
+                                         top_k=args.top_k,
+                                         select_min=args.select_min,
+                                         select_max=args.select_max,
+                                         per_chrom=args.per_chrom)
+        print("Selected variants table shape:", variants_table.shape)
+    else:
+        variants_table = load_variant_table(args.list, args.schema)
+        variants_table = variants_table.fillna('-')
 
     chrom_sizes = pd.read_csv(args.chrom_sizes, header=None, sep='\t', names=['chrom', 'size'])
     chrom_sizes_dict = chrom_sizes.set_index('chrom')['size'].to_dict()
@@ -49,117 +65,77 @@ def main():
     print("input length inferred from the model: ", input_len)
 
     print(variants_table.shape)
-    variants_table = variants_table.loc[variants_table.apply(lambda x: get_valid_variants(x.chr, x.pos, x.allele1, x.allele2, input_len, chrom_sizes_dict), axis=1)]
-    variants_table.reset_index(drop=True, inplace=True)
+    variants_table, _ = validate_variants(variants_table, input_len, chrom_sizes_dict)
     print(variants_table.shape)
-    
-    for shap_type in args.shap_type:
-        # fetch model prediction for variants
-        batch_size=args.batch_size
-        ### set the batch size to the length of variant table in case variant table is small to avoid error
-        batch_size=min(batch_size,len(variants_table))
-        # output_file=h5py.File(''.join([args.out_prefix, ".variant_shap.%s.h5"%shap_type]), 'w')
-        # observed = output_file.create_group('observed')
-        # allele1_write = observed.create_dataset('allele1_shap', (len(variants_table),2114,4), chunks=(batch_size,2114,4), dtype=np.float16, compression='gzip', compression_opts=9)
-        # allele2_write = observed.create_dataset('allele2_shap', (len(variants_table),2114,4), chunks=(batch_size,2114,4), dtype=np.float16, compression='gzip', compression_opts=9)
-        # variant_ids_write = observed.create_dataset('variant_ids', (len(variants_table),), chunks=(batch_size,), dtype='S100', compression='gzip', compression_opts=9)
-
-        allele1_seqs = []
-        allele2_seqs = []
-        allele1_scores = []
-        allele2_scores = []
-        variant_ids = []
-
-        num_batches=len(variants_table)//batch_size
-        for i in range(num_batches):
-            sub_table=variants_table[i*batch_size:(i+1)*batch_size]
-            var_ids, allele1_inputs, allele2_inputs, \
-            allele1_shap, allele2_shap = fetch_shap(model,
-                                                    sub_table,
-                                                    input_len,
-                                                    args.genome,
-                                                    args.batch_size,
-                                                    debug_mode=args.debug_mode,
-                                                    lite=args.lite,
-                                                    bias=None,
-                                                    shuf=False,
-                                                    shap_type=shap_type)
-            
-            # allele1_write[i*batch_size:(i+1)*batch_size] = allele1_shap
-            # allele2_write[i*batch_size:(i+1)*batch_size] = allele2_shap
-            # variant_ids_write[i*batch_size:(i+1)*batch_size] = [s.encode("utf-8") for s in var_ids]
-
-            if len(variant_ids) == 0:
-                allele1_seqs = allele1_inputs
-                allele2_seqs = allele2_inputs
-                allele1_scores = allele1_shap
-                allele2_scores = allele2_shap
-                variant_ids = var_ids
-            else:
-                allele1_seqs = np.concatenate((allele1_seqs, allele1_inputs))
-                allele2_seqs = np.concatenate((allele2_seqs, allele2_inputs))
-                allele1_scores = np.concatenate((allele1_scores, allele1_shap))
-                allele2_scores = np.concatenate((allele2_scores, allele2_shap))
-                variant_ids = np.concatenate((variant_ids, var_ids))
-
-        if len(variants_table)%batch_size != 0:
-            sub_table=variants_table[num_batches*batch_size:len(variants_table)]
-            var_ids, allele1_inputs, allele2_inputs, \
-            allele1_shap, allele2_shap = fetch_shap(model,
-                                                                    sub_table,
-                                                                    input_len,
-                                                                    args.genome,
-                                                                    args.batch_size,
-                                                                    debug_mode=args.debug_mode,
-                                                                    lite=args.lite,
-                                                                    bias=None,
-                                                                    shuf=False,
-                                                                    shap_type=shap_type)
-            
-            # allele1_write[num_batches*batch_size:len(variants_table)] = allele1_shap
-            # allele2_write[num_batches*batch_size:len(variants_table)] = allele2_shap
-            # variant_ids_write[num_batches*batch_size:len(variants_table)] = [s.encode("utf-8") for s in var_ids]
-
-            if len(variant_ids) == 0:
-                allele1_seqs = allele1_inputs
-                allele2_seqs = allele2_inputs
-                allele1_scores = allele1_shap
-                allele2_scores = allele2_shap
-                variant_ids = var_ids
-            else:
-                allele1_seqs = np.concatenate((allele1_seqs, allele1_inputs))
-                allele2_seqs = np.concatenate((allele2_seqs, allele2_inputs))
-                allele1_scores = np.concatenate((allele1_scores, allele1_shap))
-                allele2_scores = np.concatenate((allele2_scores, allele2_shap))
-                variant_ids = np.concatenate((variant_ids, var_ids))
-
-        # # store shap at variants
-        # with h5py.File(''.join([args.out_prefix, ".variant_shap.%s.h5"%shap_type]), 'w') as f:
-        #     observed = f.create_group('observed')
-        #     observed.create_dataset('allele1_shap', data=allele1_shap, compression='gzip', compression_opts=9)
-        #     observed.create_dataset('allele2_shap', data=allele2_shap, compression='gzip', compression_opts=9)
-            
-        assert(allele1_seqs.shape==allele1_scores.shape)
-        assert(allele2_seqs.shape==allele2_scores.shape)
-        assert(allele1_seqs.shape==allele2_seqs.shape)
-        assert(allele1_scores.shape==allele2_scores.shape)
-        assert(allele1_seqs.shape[2]==4)
-        assert(len(allele1_seqs==len(variant_ids)))
-        
-        shap_dict = {
-            'raw': {'seq': np.concatenate((np.transpose(allele1_seqs, (0, 2, 1)).astype(np.int8),
-                                           np.transpose(allele2_seqs, (0, 2, 1)).astype(np.int8)))},
-            'shap': {'seq': np.concatenate((np.transpose(allele1_scores, (0, 2, 1)).astype(np.float16),
-                                            np.transpose(allele2_scores, (0, 2, 1)).astype(np.float16)))},
-            'projected_shap': {'seq': np.concatenate((np.transpose(allele1_seqs * allele1_scores, (0, 2, 1)).astype(np.float16),
-                                                      np.transpose(allele2_seqs * allele2_scores, (0, 2, 1)).astype(np.float16)))},
-            'variant_ids': np.concatenate((np.array(variant_ids), np.array(variant_ids))),
-            'alleles': np.concatenate((np.array([0] * len(variant_ids)),
-                                       np.array([1] * len(variant_ids))))}
-
-        dd.io.save(''.join([args.out_prefix, ".variant_shap.%s.h5"%shap_type]),
-                   shap_dict,
-                   compression='blosc')
+
+    if args.score_file:
+        # record which variants were selected for attribution, with their scores
+        selection_table = variants_table.copy()
+        if args.schema == "bed":
+            selection_table['pos'] = selection_table['pos'] - 1
+        selection_table.to_csv(''.join([args.out_prefix, ".variant_shap.selection.tsv"]), sep="\t", index=False)
+
+    # the writers cannot make empty outputs, so stop before them
+    if len(variants_table) == 0:
+        if args.score_file:
+            raise ValueError("No variants selected from " + args.score_file)
+        raise ValueError("No valid variants in " + args.list)
+
+    batch_size=args.batch_size
+    # with auto, 10000-variant batches are explained in calibrated chunks
+    chunk_size = 256
+    if batch_size == "auto":
+        batch_size, chunk_size = 10000, "auto"
+    ### set the batch size to the length of variant table in case variant table is small to avoid error
+    batch_size=min(batch_size,len(variants_table))
+
+    # results are streamed to the outputs batch by batch
+    seq_len = args.shap_window if args.shap_window else input_len
+    id_len = int(variants_table['variant_id'].astype(str).str.len().max())
+    writers = {}
+    for name in get_shap_output_names(args.shap_type, len(args.model), save_folds=args.save_folds):
+        if args.output_format == "npz":
+            writers[name] = ShapNpzWriter(''.join([args.out_prefix, ".variant_shap.%s.npz"%name]),
+                                          len(variants_table), seq_len)
+        else:
+            writers[name] = ShapH5Writer(''.join([args.out_prefix, ".variant_shap.%s.h5"%name]),
+                                         len(variants_table), seq_len, id_len)
+
+    # every shap type and model is computed from the same extracted batch
+    tasks = ((start, variants_table[start:start+batch_size], input_len, args.genome,
+              args.lite, args.save_folds, args.shap_window, chunk_size)
+             for start in range(0, len(variants_table), batch_size))
+
+    if args.num_workers > 1:
+        # each worker loads the models once and takes chunks as they free up;
+        # imap hands the results back in order for the writers
+        threads = args.threads_per_worker if args.threads_per_worker else max(1, os.cpu_count() // args.num_workers)
+        print("running", args.num_workers, "shap workers with", threads, "threads each")
+        # the workers import NumPy and TF before init_shap_worker runs, so the
+        # OpenMP limit has to be in the environment they are spawned with
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+        pool = multiprocessing.get_context("spawn").Pool(args.num_workers,
+                                                         initializer=init_shap_worker,
+                                                         initargs=(args.model, args.shap_type, args.lite,
+                                                                   args.attribution, args.ig_steps, threads))
+        results = pool.imap(run_shap_worker, tasks)
+    else:
+        init_shap_worker(args.model, args.shap_type, lite=args.lite, attribution=args.attribution,
+                         ig_steps=args.ig_steps, models=models)
+        results = map(run_shap_worker, tasks)
+
+    for start, var_ids, allele1_inputs, allele2_inputs, allele1_shap, allele2_shap in results:
+        with instrument.stage("write.shap", items=len(var_ids)):
+            for name, writer in writers.items():
+                writer.write(start, var_ids, allele1_inputs, allele2_inputs, allele1_shap[name], allele2_shap[name])
+
+    if args.num_workers > 1:
+        pool.close()
+        pool.join()
+
+    with instrument.stage("write.shap"):
+        for writer in writers.values():
+            writer.close()
 
     print("DONE")
 
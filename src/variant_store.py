@@ -0,0 +1,21 @@
+import sys
+from utils import argmanager, score_store
+
+
+def main():
+    args = argmanager.fetch_store_args()
+
+    if args.command == "build":
+        score_store.build_store(args.inputs, args.out)
+        return
+
+    variant_ids = list(args.variant_id) if args.variant_id else []
+    if args.variant_id_file:
+        with open(args.variant_id_file) as f:
+            variant_ids += [line.strip() for line in f if line.strip()]
+    scores = score_store.query(args.store, regions=args.region, variant_ids=variant_ids)
+    scores.to_csv(args.out if args.out else sys.stdout, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    main()
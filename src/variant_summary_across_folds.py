@@ -3,11 +3,13 @@ import numpy as np
 import os
 from utils.argmanager import *
 from utils.helpers import *
+from utils import instrument
 
 
 def main():
     args = fetch_variant_summary_args()
     print(args)
+    instrument.report_at_exit(args.out_prefix + ".stage_report.json")
     variant_score_dir = args.score_dir
     variant_table_list = args.score_list
     output_prefix = args.out_prefix
@@ -16,7 +18,8 @@ def main():
     for i in range(len(variant_table_list)):
         variant_score_file = os.path.join(variant_score_dir, variant_table_list[i])
         assert os.path.isfile(variant_score_file)
-        var_score = pd.read_table(variant_score_file)
+        with instrument.stage("load_scores"):
+            var_score = pd.read_table(variant_score_file)
         score_dict[i] = var_score
 
     variant_scores = score_dict[0][get_variant_schema(args.schema)].copy()
@@ -45,9 +48,10 @@ def main():
     print()
 
     out_file = output_prefix + ".mean.variant_scores.tsv"
-    variant_scores.to_csv(out_file,\
-                          sep="\t",\
-                          index=False)
+    with instrument.stage("write.summary", items=len(variant_scores)):
+        variant_scores.to_csv(out_file,\
+                              sep="\t",\
+                              index=False)
 
     print("DONE")
     print()
@@ -0,0 +1,630 @@
+"""
+Hermetic performance benchmark for variant-scorer.
+
+Generates a synthetic genome, chrom sizes, variant lists in every schema,
+peaks, genes and small randomly initialized models with ChromBPNet's
+input/output shapes (standard and chrombpnet-lite signatures), then times
+each pipeline stage. Results are written as JSON (seconds, items/sec and
+peak RSS per stage) so runs can be compared across commits.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, SRC_DIR)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Times variant-scorer stages on synthetic data")
+    parser.add_argument("-o", "--out_dir", type=str, required=True, help="Directory for the synthetic data and outputs")
+    parser.add_argument("-r", "--results", type=str, help="JSON results file. Defaults to <out_dir>/benchmark_results.json")
+    parser.add_argument("-nv", "--num_variants", type=int, default=2000, help="Number of variants to score")
+    parser.add_argument("-np", "--num_peaks", type=int, default=500, help="Number of peaks")
+    parser.add_argument("-nc", "--num_chroms", type=int, default=3, help="Number of synthetic chromosomes")
+    parser.add_argument("-cl", "--chrom_len", type=int, default=1000000, help="Length of each synthetic chromosome")
+    parser.add_argument("-il", "--input_len", type=int, default=2114, help="Model input length")
+    parser.add_argument("-ol", "--output_len", type=int, default=1000, help="Model profile output length")
+    parser.add_argument("-bs", "--batch_size", type=int, default=256, help="Batch size for prediction")
+    parser.add_argument("-n", "--num_shuf", type=int, default=2, help="Number of shuffled scores per variant for the null")
+    parser.add_argument("-ns", "--num_shap", type=int, default=64, help="Number of variants to explain in the SHAP stages")
+    parser.add_argument("--skip_shap", action='store_true', help="Skip the SHAP stages")
+    parser.add_argument("-s", "--seed", type=int, default=1234, help="Random seed for the synthetic data")
+    return parser.parse_args()
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+class Benchmark:
+    def __init__(self):
+        self.stages = []
+
+    def record(self, name, seconds, items, rss_mb):
+        stage = {'stage': name,
+                 'seconds': seconds,
+                 'items': items,
+                 'items_per_sec': items / seconds if seconds > 0 else None,
+                 'peak_rss_mb': rss_mb}
+        self.stages.append(stage)
+        print("%-40s %10.3f s %12.1f items/s %10.1f MB" % (name, seconds, stage['items_per_sec'] or 0, rss_mb))
+
+    @contextmanager
+    def stage(self, name, items):
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start, items, peak_rss_mb())
+
+    def speedups(self, pairs):
+        # wall time ratio of each (baseline, candidate) stage pair
+        seconds = {stage['stage']: stage['seconds'] for stage in self.stages}
+        results = {}
+        for baseline, candidate in pairs:
+            if baseline in seconds and candidate in seconds:
+                results[candidate + " vs " + baseline] = seconds[baseline] / seconds[candidate]
+                print("%-40s %10.2fx over %s" % (candidate, results[candidate + " vs " + baseline], baseline))
+        return results
+
+    def run_script(self, name, items, script, script_args):
+        # entry points run in their own process, so the time includes startup
+        # and the RSS is that of the child alone
+        command = [sys.executable, os.path.join(SRC_DIR, script)] + [str(x) for x in script_args]
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, cwd=SRC_DIR, stdout=subprocess.DEVNULL)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+        if status != 0:
+            raise RuntimeError("benchmark stage failed: " + " ".join(command))
+        self.record(name, seconds, items, rusage.ru_maxrss / 1024)
+
+
+def make_genome(out_dir, num_chroms, chrom_len, rng):
+    genome = {}
+    fasta_file = os.path.join(out_dir, "genome.fa")
+    with open(fasta_file, 'w') as f:
+        for i in range(num_chroms):
+            chrom = "chr%d" % (i + 1)
+            seq = ''.join(np.array(list("ACGT"))[rng.randint(0, 4, chrom_len)])
+            genome[chrom] = seq
+            f.write(">%s\n" % chrom)
+            for start in range(0, chrom_len, 60):
+                f.write(seq[start:start + 60] + "\n")
+    chrom_sizes_file = os.path.join(out_dir, "chrom.sizes")
+    pd.DataFrame([[chrom, len(seq)] for chrom, seq in genome.items()]).to_csv(chrom_sizes_file, sep="\t", header=False, index=False)
+    return genome, fasta_file, chrom_sizes_file
+
+
+def make_variants(genome, num_variants, input_len, rng):
+    # SNPs, insertions and deletions; allele1 is always the reference allele
+    chroms = list(genome)
+    margin = input_len // 2 + 100
+    rows = []
+    for i in range(num_variants):
+        chrom = chroms[rng.randint(len(chroms))]
+        seq = genome[chrom]
+        pos = rng.randint(margin, len(seq) - margin)
+        ref = seq[pos - 1]
+        kind = rng.rand()
+        if kind < 0.8:
+            allele1, allele2 = ref, rng.choice([b for b in "ACGT" if b != ref])
+        elif kind < 0.9:
+            allele1, allele2 = ref, ref + ''.join(rng.choice(list("ACGT"), rng.randint(1, 10)))
+        else:
+            allele1, allele2 = seq[pos - 1:pos + rng.randint(1, 10)], ref
+        rows.append([chrom, pos, allele1, allele2, "var_%d" % i])
+    return pd.DataFrame(rows, columns=['chr', 'pos', 'allele1', 'allele2', 'variant_id'])
+
+
+def write_variant_schemas(variants, out_dir):
+    files = {}
+    schema_tables = {
+        'chrombpnet': variants[['chr', 'pos', 'allele1', 'allele2', 'variant_id']],
+        'bed': variants.assign(end=variants['pos'], pos=variants['pos'] - 1)[['chr', 'pos', 'end', 'allele1', 'allele2', 'variant_id']],
+        'plink': variants.assign(ignore1=0)[['chr', 'variant_id', 'ignore1', 'pos', 'allele1', 'allele2']],
+        'plink2': variants[['chr', 'variant_id', 'pos', 'allele1', 'allele2']],
+        'original': variants[['chr', 'pos', 'variant_id', 'allele1', 'allele2']],
+    }
+    for schema, table in schema_tables.items():
+        files[schema] = os.path.join(out_dir, "variants.%s.tsv" % schema)
+        table.to_csv(files[schema], sep="\t", header=False, index=False)
+
+    # gzipped VCF with the usual header and trailing columns
+    files['vcf'] = os.path.join(out_dir, "variants.vcf.gz")
+    vcf_table = variants.assign(qual='.', filter='PASS', info='.')[['chr', 'pos', 'variant_id', 'allele1', 'allele2',
+                                                                    'qual', 'filter', 'info']]
+    with gzip.open(files['vcf'], 'wt') as f:
+        f.write("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        vcf_table.to_csv(f, sep="\t", header=False, index=False)
+    return files
+
+
+def make_peaks(genome, num_peaks, input_len, out_dir, rng):
+    chroms = list(genome)
+    rows = []
+    for i in range(num_peaks):
+        chrom = chroms[rng.randint(len(chroms))]
+        start = rng.randint(input_len, len(genome[chrom]) - input_len)
+        rows.append([chrom, start, start + 500, '.', 1000, '.', rng.rand(), -1, -1, 250])
+    peaks_file = os.path.join(out_dir, "peaks.narrowPeak")
+    pd.DataFrame(rows).to_csv(peaks_file, sep="\t", header=False, index=False)
+    return peaks_file
+
+
+def make_genes(genome, out_dir, rng, num_genes=200):
+    chroms = list(genome)
+    rows = []
+    for i in range(num_genes):
+        chrom = chroms[rng.randint(len(chroms))]
+        start = rng.randint(0, len(genome[chrom]) - 1)
+        rows.append([chrom, start, start + 1, "gene_%d" % i])
+    genes = pd.DataFrame(rows).sort_values(by=[0, 1])
+    genes_file = os.path.join(out_dir, "genes.bed")
+    genes.to_csv(genes_file, sep="\t", header=False, index=False)
+    return genes_file
+
+
+def build_model(input_len, output_len, lite=False):
+    '''
+    Small random model with ChromBPNet's signature: one-hot input_len x 4 in,
+    [profile logits (output_len), log counts (1)] out. The lite signature also
+    takes bias profile and bias counts inputs.
+    '''
+    from tensorflow.keras import layers, Model, Input
+
+    seq = Input(shape=(input_len, 4), name="sequence")
+    x = layers.Conv1D(16, 21, activation='relu')(seq)
+    for dilation in (2, 4, 8, 16):
+        conv = layers.Conv1D(16, 3, dilation_rate=dilation, padding='same', activation='relu')(x)
+        x = layers.Add()([x, conv])
+    profile = layers.Conv1D(1, 75)(x)
+    crop = profile.shape[1] - output_len
+    profile = layers.Cropping1D((crop // 2, crop - crop // 2))(profile)
+    profile = layers.Flatten(name="logits_profile_predictions")(profile)
+    counts = layers.GlobalAveragePooling1D()(x)
+    counts = layers.Dense(1, name="logcount_predictions")(counts)
+
+    if not lite:
+        return Model(inputs=seq, outputs=[profile, counts])
+
+    bias_profile = Input(shape=(output_len,), name="bias_logits")
+    bias_counts = Input(shape=(1,), name="bias_logcounts")
+    profile = layers.Add(name="profile_with_bias")([profile, bias_profile])
+    counts = layers.Lambda(lambda t: tf.math.reduce_logsumexp(tf.concat(t, axis=-1), axis=-1, keepdims=True),
+                           name="counts_with_bias")([counts, bias_counts])
+    return Model(inputs=[seq, bias_profile, bias_counts], outputs=[profile, counts])
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=SRC_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    out_dir = os.path.abspath(args.out_dir)
+    results_file = args.results if args.results else os.path.join(out_dir, "benchmark_results.json")
+    rng = np.random.RandomState(args.seed)
+    np.random.seed(args.seed)
+
+    print("generating synthetic data")
+    genome, fasta_file, chrom_sizes_file = make_genome(out_dir, args.num_chroms, args.chrom_len, rng)
+    variants = make_variants(genome, args.num_variants, args.input_len, rng)
+    variant_files = write_variant_schemas(variants, out_dir)
+    peaks_file = make_peaks(genome, args.num_peaks, args.input_len, out_dir, rng)
+    genes_file = make_genes(genome, out_dir, rng)
+
+    model_files = {}
+    for signature, lite in [('chrombpnet', False), ('lite', True)]:
+        model_files[signature] = os.path.join(out_dir, "model.%s.h5" % signature)
+        build_model(args.input_len, args.output_len, lite=lite).save(model_files[signature])
+
+    import h5py
+    import pyfaidx
+    from utils.helpers import load_model_wrapper, load_variant_table, get_valid_variants, get_valid_peaks, \
+        fetch_variant_predictions, fetch_variant_scores, fetch_peak_predictions, get_variant_scores_with_peaks, adjust_indel_jsd, \
+        get_variant_scores, \
+        create_shuffle_table, get_pvals, add_missing_columns_to_peaks_df
+    from generators.variant_generator import VariantGenerator
+    from utils import one_hot, instrument, inference, model_cache, quantize
+    from utils.scoring import ScoringSession
+    from utils import server, variant_reader, variant_table, genome_mmap, pool, prediction_cache, score_store, autobatch
+
+    # build the fasta index outside the timed stages
+    pyfaidx.Fasta(fasta_file)
+    chrom_sizes_dict = {chrom: len(seq) for chrom, seq in genome.items()}
+
+    bench = Benchmark()
+    num_variants = args.num_variants
+
+    with bench.stage("load_model", 1):
+        model = load_model_wrapper(model_files['chrombpnet'])
+    input_len = model.input_shape[1]
+
+    # first load with a cache directory traces and verifies the artifact, later loads reuse it
+    model_cache_dir = os.path.join(out_dir, "model_cache")
+    shutil.rmtree(model_cache_dir, ignore_errors=True)
+    # later end-to-end runs over the same list reuse the first run's prepared table
+    shutil.rmtree(os.path.join(out_dir, "variant_cache"), ignore_errors=True)
+    with bench.stage("load_model.cache_build", 1):
+        load_model_wrapper(model_files['chrombpnet'], cache_dir=model_cache_dir)
+    with bench.stage("load_model.cached", 1):
+        cached_model = load_model_wrapper(model_files['chrombpnet'], cache_dir=model_cache_dir)
+    assert isinstance(cached_model, model_cache.CachedModel)
+
+    for schema, variant_file in variant_files.items():
+        with bench.stage("load_variant_table." + schema, num_variants):
+            variants_table = load_variant_table(variant_file, schema)
+        assert variants_table[['chr', 'pos', 'allele1', 'allele2', 'variant_id']].equals(variants[['chr', 'pos', 'allele1', 'allele2', 'variant_id']])
+
+    with bench.stage("read_variant_chunks.vcf", num_variants):
+        num_read = sum(len(chunk) for chunk in variant_reader.read_variant_chunks(variant_files['vcf'], 'vcf', chunk_size=500))
+    assert num_read == num_variants
+
+    variants_table = load_variant_table(variant_files['chrombpnet'], 'chrombpnet').fillna('-')
+    with bench.stage("validate_variants", num_variants):
+        variants_table = variants_table.loc[variants_table.apply(lambda x: get_valid_variants(x.chr, x.pos, x.allele1, x.allele2, input_len, chrom_sizes_dict), axis=1)]
+        variants_table.reset_index(drop=True, inplace=True)
+
+    # the same checks on whole columns of the compact table
+    compact_table = load_variant_table(variant_files['chrombpnet'], 'chrombpnet')
+    with bench.stage("compact_variant_table", num_variants):
+        compact_table = variant_table.compact_variant_table(compact_table)
+    with bench.stage("validate_variants.vectorized", num_variants):
+        compact_table, _ = variant_table.validate_variants(compact_table, input_len, chrom_sizes_dict)
+    assert compact_table['variant_id'].tolist() == variants_table['variant_id'].tolist()
+
+    # debug_mode makes the generator return the raw allele strings
+    var_gen = VariantGenerator(variants_table, input_len, fasta_file, batch_size=args.batch_size, debug_mode=True)
+    with bench.stage("sequence_extraction", num_variants):
+        seq_batches = [var_gen[i] for i in range(len(var_gen))]
+
+    with bench.stage("one_hot", num_variants):
+        onehot_batches = [(one_hot.dna_to_one_hot(allele1_seqs), one_hot.dna_to_one_hot(allele2_seqs))
+                          for _, allele1_seqs, allele2_seqs in seq_batches]
+
+    with bench.stage("predict", num_variants):
+        for allele1_seqs, allele2_seqs in onehot_batches:
+            model.predict(allele1_seqs, verbose=False)
+            model.predict(allele2_seqs, verbose=False)
+
+    # the same batches through the tf.function runners; tracing is timed separately
+    for predict_mode in ["compiled", "xla"]:
+        with bench.stage("trace." + predict_mode, 1):
+            runner = inference.get_runner(model, args.batch_size, predict_mode=predict_mode)
+            runner(onehot_batches[0][0])
+        with bench.stage("predict." + predict_mode, num_variants):
+            for allele1_seqs, allele2_seqs in onehot_batches:
+                runner(allele1_seqs)
+                runner(allele2_seqs)
+
+    with bench.stage("fetch_variant_predictions", num_variants):
+        variant_ids, allele1_pred_counts, allele2_pred_counts, \
+        allele1_pred_profiles, allele2_pred_profiles = fetch_variant_predictions(model, variants_table, input_len, fasta_file,
+                                                                                 args.batch_size)
+
+    with bench.stage("fetch_variant_predictions.cached_model", num_variants):
+        _, cached_allele1_pred_counts, _, _, _ = fetch_variant_predictions(cached_model, variants_table, input_len, fasta_file,
+                                                                           args.batch_size)
+    assert np.allclose(cached_allele1_pred_counts, allele1_pred_counts, rtol=1e-4)
+
+    with bench.stage("fetch_variant_predictions.keras_predict", num_variants):
+        fetch_variant_predictions(model, variants_table, input_len, fasta_file, args.batch_size, predict_mode="predict")
+
+    with bench.stage("fetch_variant_scores", num_variants):
+        _, _, _, head_logfc, head_jsd, head_adjusted_jsd, _, _ = fetch_variant_scores(model, variants_table, input_len, fasta_file,
+                                                                                      args.batch_size)
+
+    # the first run fills the prediction cache and the second only looks the variants up
+    prediction_cache_dir = os.path.join(out_dir, "prediction_cache")
+    shutil.rmtree(prediction_cache_dir, ignore_errors=True)
+    cache = prediction_cache.PredictionCache(prediction_cache_dir, model_files['chrombpnet'], fasta_file, input_len)
+    with bench.stage("fetch_variant_predictions.prediction_cache.cold", num_variants):
+        fetch_variant_predictions(model, variants_table, input_len, fasta_file, args.batch_size, prediction_cache=cache)
+    with bench.stage("fetch_variant_predictions.prediction_cache.warm", num_variants):
+        _, cache_allele1_pred_counts, _, \
+        cache_allele1_pred_profiles, _ = fetch_variant_predictions(model, variants_table, input_len, fasta_file, args.batch_size,
+                                                                   prediction_cache=cache)
+    assert cache.misses == len(variants_table) and cache.hits == len(variants_table)
+    cache.close()
+    assert np.allclose(cache_allele1_pred_counts, allele1_pred_counts, rtol=1e-4)
+    assert cache_allele1_pred_counts.dtype == allele1_pred_counts.dtype
+    assert cache_allele1_pred_profiles.dtype == allele1_pred_profiles.dtype
+    assert np.allclose(cache_allele1_pred_profiles, allele1_pred_profiles, atol=1e-4)
+
+    # profiles written batch by batch to memory-mapped scratch files, then scored in row chunks
+    with bench.stage("fetch_variant_predictions.memmap_profiles", num_variants):
+        _, _, _, mmap_allele1_pred_profiles, mmap_allele2_pred_profiles = fetch_variant_predictions(
+            model, variants_table, input_len, fasta_file, args.batch_size, profile_dir=os.path.join(out_dir, "scratch"))
+    assert isinstance(mmap_allele1_pred_profiles, np.memmap)
+    assert np.allclose(mmap_allele1_pred_profiles, allele1_pred_profiles, atol=1e-5)
+    with bench.stage("scores.memmap_profiles", num_variants):
+        _, mmap_jsd = get_variant_scores(allele1_pred_counts, allele2_pred_counts, mmap_allele1_pred_profiles, mmap_allele2_pred_profiles)
+    del mmap_allele1_pred_profiles, mmap_allele2_pred_profiles
+
+    with bench.stage("fetch_variant_predictions.counts_only", num_variants):
+        fetch_variant_predictions(model, variants_table, input_len, fasta_file, args.batch_size, counts_only=True)
+
+    with bench.stage("fetch_variant_predictions.forward_only", num_variants):
+        fetch_variant_predictions(model, variants_table, input_len, fasta_file, args.batch_size, forward_only=True)
+
+    # --batch_size auto: calibration on the first variants, then the fetch at the chosen size
+    with bench.stage("autobatch.calibrate", 1):
+        auto_batch_size = autobatch.resolve_for_predictions(autobatch.AUTO, model,
+                                                            lambda: autobatch.variant_sample(variants_table, input_len, fasta_file))
+    assert auto_batch_size in autobatch.PREDICT_CANDIDATES
+    print("calibrated batch size:", auto_batch_size)
+    with bench.stage("fetch_variant_predictions.autobatch", num_variants):
+        _, auto_allele1_pred_counts, _, _, _ = fetch_variant_predictions(model, variants_table, input_len, fasta_file, autobatch.AUTO)
+    assert np.allclose(auto_allele1_pred_counts, allele1_pred_counts, rtol=1e-4)
+
+    # a runner that runs out of memory above 64 rows is backed off to 64 without losing the batch
+    def make_runner(batch_size):
+        runner = inference.get_runner(model, batch_size)
+        def run(seqs):
+            if batch_size > 64:
+                raise tf.errors.ResourceExhaustedError(None, None, "synthetic out of memory")
+            return runner(seqs)
+        return run
+    backoff_runner = autobatch.BackoffRunner(make_runner, 256)
+    backoff_seqs = autobatch.variant_sample(variants_table, input_len, fasta_file, num_variants=256)
+    with bench.stage("autobatch.backoff", len(backoff_seqs)):
+        backoff_preds = backoff_runner(backoff_seqs)
+    assert backoff_runner.batch_size == 64
+    assert np.allclose(backoff_preds[1], inference.get_runner(model, 256)(backoff_seqs)[1], rtol=1e-4)
+
+    # the scoring head backs off the same way, scoring the batch in slices
+    def make_head(batch_size):
+        head = inference.get_scoring_head(model, batch_size)
+        def run(*inputs):
+            if batch_size > 64:
+                raise tf.errors.ResourceExhaustedError(None, None, "synthetic out of memory")
+            return head(*inputs)
+        return run
+    backoff_head = autobatch.BackoffHead(make_head, 256)
+    backoff_lengths = np.ones(len(backoff_seqs), dtype=int)
+    backoff_scores = backoff_head(backoff_seqs, backoff_seqs[::-1], backoff_lengths, backoff_lengths)
+    assert backoff_head.batch_size == 64
+    assert np.allclose(backoff_scores['logfc'],
+                       inference.get_scoring_head(model, 256)(backoff_seqs, backoff_seqs[::-1], backoff_lengths, backoff_lengths)['logfc'],
+                       atol=1e-4)
+
+    # the same predictions from pinned worker processes reading one memory-mapped genome
+    shutil.rmtree(os.path.join(out_dir, "genome_mmap"), ignore_errors=True)
+    with bench.stage("genome_mmap.build", 1):
+        genome_mmap.load(fasta_file, os.path.join(out_dir, "genome_mmap"))
+    with bench.stage("inference_pool.startup", 1):
+        inference_pool = pool.InferencePool(model_files['chrombpnet'], fasta_file, 2, args.batch_size,
+                                            cache_dir=os.path.join(out_dir, "genome_mmap"))
+        inference_pool.fetch_variant_predictions(variants_table.head(args.batch_size))
+    with bench.stage("fetch_variant_predictions.pool", num_variants):
+        pool_variant_ids, pool_allele1_pred_counts, _, \
+        pool_allele1_pred_profiles, _ = inference_pool.fetch_variant_predictions(variants_table)
+    inference_pool.close()
+    assert np.array_equal(pool_variant_ids, variant_ids)
+    assert np.allclose(pool_allele1_pred_counts, allele1_pred_counts, rtol=1e-4)
+    assert np.allclose(pool_allele1_pred_profiles, allele1_pred_profiles, atol=1e-4)
+
+    peaks = pd.read_csv(peaks_file, header=None, sep='\t')
+    peaks = add_missing_columns_to_peaks_df(peaks, schema='narrowpeak')
+    peaks = peaks.loc[peaks.apply(lambda x: get_valid_peaks(x.chr, x.start, x.summit, input_len, chrom_sizes_dict), axis=1)]
+    peaks.reset_index(drop=True, inplace=True)
+    with bench.stage("fetch_peak_predictions", len(peaks)):
+        peak_ids, peak_pred_counts, peak_pred_profiles = fetch_peak_predictions(model, peaks, input_len, fasta_file,
+                                                                                args.batch_size)
+
+    shuf_variants_table = create_shuffle_table(variants_table, args.seed, None, args.num_shuf)
+    with bench.stage("fetch_shuffled_predictions", len(shuf_variants_table)):
+        _, shuf_allele1_pred_counts, shuf_allele2_pred_counts, \
+        shuf_allele1_pred_profiles, shuf_allele2_pred_profiles = fetch_variant_predictions(model, shuf_variants_table, input_len,
+                                                                                           fasta_file, args.batch_size, shuf=True)
+
+    with bench.stage("scoring", num_variants):
+        logfc, jsd, allele1_quantile, allele2_quantile = get_variant_scores_with_peaks(allele1_pred_counts, allele2_pred_counts,
+                                                                                       allele1_pred_profiles, allele2_pred_profiles,
+                                                                                       peak_pred_counts)
+        indel_idx, adjusted_jsd_list = adjust_indel_jsd(variants_table, allele1_pred_profiles, allele2_pred_profiles, jsd)
+    # the on-graph scoring head should agree with the host-side scores
+    assert np.allclose(head_logfc, logfc, atol=1e-4)
+    assert np.allclose(head_jsd, jsd, atol=1e-4)
+    assert np.allclose(mmap_jsd, jsd, atol=1e-5)
+    assert np.allclose(head_adjusted_jsd, adjusted_jsd_list, atol=1e-4)
+
+    shuf_logfc, shuf_jsd, _, _ = get_variant_scores_with_peaks(shuf_allele1_pred_counts, shuf_allele2_pred_counts,
+                                                               shuf_allele1_pred_profiles, shuf_allele2_pred_profiles,
+                                                               peak_pred_counts)
+    with bench.stage("pvals", num_variants):
+        get_pvals(logfc, shuf_logfc, tail="both")
+        get_pvals(np.abs(logfc), np.abs(shuf_logfc), tail="right")
+        get_pvals(adjusted_jsd_list, shuf_jsd, tail="right")
+        get_pvals(logfc * adjusted_jsd_list, shuf_logfc * shuf_jsd, tail="both")
+        get_pvals(np.abs(logfc) * adjusted_jsd_list, np.abs(shuf_logfc) * shuf_jsd, tail="right")
+
+    variants_table["logfc"] = logfc
+    variants_table["jsd"] = adjusted_jsd_list
+    variants_table["allele1_quantile"] = allele1_quantile
+    variants_table["allele2_quantile"] = allele2_quantile
+    with bench.stage("write_scores_tsv", num_variants):
+        variants_table.to_csv(os.path.join(out_dir, "inprocess.variant_scores.tsv"), sep="\t", index=False)
+    with bench.stage("write_predictions_h5", num_variants):
+        with h5py.File(os.path.join(out_dir, "inprocess.variant_predictions.h5"), 'w') as f:
+            observed = f.create_group('observed')
+            observed.create_dataset('allele1_pred_counts', data=allele1_pred_counts, compression='gzip', compression_opts=9)
+            observed.create_dataset('allele2_pred_counts', data=allele2_pred_counts, compression='gzip', compression_opts=9)
+            observed.create_dataset('allele1_pred_profiles', data=allele1_pred_profiles, compression='gzip', compression_opts=9)
+            observed.create_dataset('allele2_pred_profiles', data=allele2_pred_profiles, compression='gzip', compression_opts=9)
+
+    quantization_reports = {}
+    for quantization in quantize.QUANTIZATIONS:
+        with bench.stage("quantize." + quantization, 1):
+            quant_model = quantize.load_quantized_model(model, model_files['chrombpnet'], quantization)
+        with bench.stage("fetch_variant_predictions." + quantization, num_variants):
+            fetch_variant_predictions(quant_model, variants_table, input_len, fasta_file, args.batch_size)
+        quantization_reports[quantization] = quantize.accuracy_report(model, quant_model, variants_table, input_len, fasta_file,
+                                                                      args.batch_size, num_variants=min(num_variants, 1000))
+
+    with bench.stage("load_model.lite", 1):
+        lite_model = load_model_wrapper(model_files['lite'])
+    with bench.stage("fetch_variant_predictions.lite", num_variants):
+        fetch_variant_predictions(lite_model, variants_table, input_len, fasta_file, args.batch_size, lite=True)
+
+    # a warm session re-scoring small lists, against the one-off setup it amortizes
+    small_table = variants_table[['chr', 'pos', 'allele1', 'allele2', 'variant_id']].head(args.batch_size)
+    with bench.stage("scoring_session.setup", 1):
+        session = ScoringSession(model_files['chrombpnet'], fasta_file, chrom_sizes_dict, peaks=peaks.copy(),
+                                 batch_size=args.batch_size)
+        session.score_peaks()
+        session.build_null(small_table, num_shuf=args.num_shuf)
+    with bench.stage("scoring_session.score", len(small_table) * 10):
+        for _ in range(10):
+            session_scores = session.score(small_table)
+    assert np.allclose(session_scores["logfc"], logfc[:len(small_table)], atol=1e-4)
+
+    # interpreter startup and imports of each entry point, up to argument parsing
+    for script in ["variant_scoring.py", "variant_scoring.per_chrom.py", "variant_summary_across_folds.py",
+                   "variant_annotation.py", "variant_shap.py", "hitcaller_variant.py", "variant_server.py",
+                   "variant_store.py"]:
+        bench.run_script("startup." + script[:-len(".py")], 1, script, ["--help"])
+
+    # end-to-end entry points, each in its own process
+    scoring_args = ["-l", variant_files['chrombpnet'], "-g", fasta_file, "-s", chrom_sizes_file, "-m", model_files['chrombpnet'],
+                    "-p", peaks_file, "-bs", args.batch_size, "-n", args.num_shuf, "-sc", "chrombpnet",
+                    "-vc", os.path.join(out_dir, "variant_cache")]
+    bench.run_script("variant_scoring", num_variants, "variant_scoring.py",
+                     scoring_args + ["-o", os.path.join(out_dir, "fold_0")])
+    bench.run_script("variant_scoring.per_chrom", num_variants, "variant_scoring.per_chrom.py",
+                     scoring_args + ["-o", os.path.join(out_dir, "per_chrom")])
+    bench.run_script("variant_scoring.fold_1", num_variants, "variant_scoring.py",
+                     scoring_args + ["-o", os.path.join(out_dir, "fold_1")])
+    # streamed from the gzipped VCF in chunks, reusing the fold_0 null
+    bench.run_script("variant_scoring.vcf_chunked", num_variants, "variant_scoring.py",
+                     scoring_args + ["-l", variant_files['vcf'], "-sc", "vcf", "-cs", 500,
+                                     "-sh", os.path.join(out_dir, "fold_0.variant_scores.shuffled.tsv"),
+                                     "-o", os.path.join(out_dir, "vcf_chunked")])
+    vcf_scores = pd.read_table(os.path.join(out_dir, "vcf_chunked.variant_scores.tsv"))
+    fold_0_scores = pd.read_table(os.path.join(out_dir, "fold_0.variant_scores.tsv"))
+
+    # the per-chrom outputs merged into one indexed store, queried by region and by id
+    per_chrom_files = sorted(os.path.join(out_dir, x) for x in os.listdir(out_dir)
+                             if x.startswith("per_chrom.") and x.endswith(".variant_scores.tsv") and x.count('.') == 3)
+    store_file = os.path.join(out_dir, "per_chrom" + score_store.STORE_SUFFIX)
+    with bench.stage("score_store.build", num_variants):
+        score_store.build_store(per_chrom_files, store_file)
+    query_ids = fold_0_scores['variant_id'].sample(100, random_state=args.seed).tolist()
+    with bench.stage("score_store.query_ids", len(query_ids)):
+        store_scores = score_store.query(store_file, variant_ids=query_ids)
+    assert store_scores['variant_id'].tolist() == query_ids
+    assert np.allclose(store_scores['logfc'], fold_0_scores.set_index('variant_id').loc[query_ids, 'logfc'], atol=1e-4)
+    first_chrom = sorted(genome)[0]
+    with bench.stage("score_store.query_region", 1):
+        region_scores = score_store.query(store_file, regions=["%s:1-%d" % (first_chrom, args.chrom_len // 2)])
+    assert (region_scores['chr'] == first_chrom).all() and (region_scores['pos'] <= args.chrom_len // 2).all()
+    assert np.allclose(vcf_scores.set_index('variant_id').loc[fold_0_scores['variant_id'], 'logfc'], fold_0_scores['logfc'], atol=1e-4)
+
+    # half the list scored first, then the whole list with --update only scores the other half
+    half_list = os.path.join(out_dir, "variants.half.tsv")
+    pd.read_table(variant_files['chrombpnet'], header=None).head(num_variants // 2).to_csv(half_list, sep="\t", header=False, index=False)
+    for name in ["update.variant_scores.tsv", "update.variant_scores.manifest.json"]:
+        if os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+    update_args = scoring_args + ["-sh", os.path.join(out_dir, "fold_0.variant_scores.shuffled.tsv"),
+                                  "-o", os.path.join(out_dir, "update")]
+    bench.run_script("variant_scoring.update_base", num_variants // 2, "variant_scoring.py",
+                     update_args + ["-l", half_list])
+    bench.run_script("variant_scoring.update", num_variants - num_variants // 2, "variant_scoring.py",
+                     update_args + ["-u"])
+    update_scores = pd.read_table(os.path.join(out_dir, "update.variant_scores.tsv"))
+    assert update_scores['variant_id'].tolist() == fold_0_scores['variant_id'].tolist()
+    assert np.allclose(update_scores['logfc'], fold_0_scores['logfc'], atol=1e-4)
+    with h5py.File(os.path.join(out_dir, "update.variant_predictions.h5"), 'r') as f:
+        assert len(f['observed']['allele1_pred_counts']) == len(update_scores)
+
+    # a warm server answering concurrent small queries, with the fold_0 null
+    server_variants = variants[['chr', 'pos', 'allele1', 'allele2', 'variant_id']].head(20 * 16).values.tolist()
+    server_socket = os.path.join(out_dir, "variant_server.sock")
+    server_proc = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, "variant_server.py"), "-m", model_files['chrombpnet'],
+                                    "-g", fasta_file, "-s", chrom_sizes_file, "-p", peaks_file, "-bs", str(args.batch_size),
+                                    "-nl", os.path.join(out_dir, "fold_0.variant_scores.shuffled.tsv"), "-us", server_socket],
+                                   cwd=SRC_DIR, stdout=subprocess.DEVNULL)
+    try:
+        with bench.stage("variant_server.startup", 1):
+            server.wait_until_ready(unix_socket=server_socket)
+        with bench.stage("variant_server.query", len(server_variants)):
+            with ThreadPoolExecutor(16) as executor:
+                server_scores = list(executor.map(lambda i: server.query(server_variants[i:i + 20], unix_socket=server_socket),
+                                                  range(0, len(server_variants), 20)))
+        health = server.request("GET", "/health", unix_socket=server_socket)
+        print("variant_server micro-batches:", health['models'])
+    finally:
+        server_proc.terminate()
+        server_proc.wait()
+    assert 'logfc.pval' in server_scores[0].columns
+
+    bench.run_script("variant_summary_across_folds", num_variants, "variant_summary_across_folds.py",
+                     ["-sd", out_dir, "-sl", "fold_0.variant_scores.tsv", "fold_1.variant_scores.tsv",
+                      "-o", os.path.join(out_dir, "summary"), "-sc", "chrombpnet"])
+    bench.run_script("variant_annotation", num_variants, "variant_annotation.py",
+                     ["-l", os.path.join(out_dir, "summary.mean.variant_scores.tsv"), "-p", peaks_file, "-ge", genes_file,
+                      "-o", os.path.join(out_dir, "summary"), "-sc", "chrombpnet"])
+
+    if not args.skip_shap:
+        shap_list = os.path.join(out_dir, "variants.shap.tsv")
+        pd.read_table(variant_files['chrombpnet'], header=None).head(args.num_shap).to_csv(shap_list, sep="\t", header=False, index=False)
+        shap_args = ["-l", shap_list, "-g", fasta_file, "-s", chrom_sizes_file, "-m", model_files['chrombpnet'],
+                     "-bs", args.num_shap, "-sc", "chrombpnet", "-st", "counts", "profile"]
+        bench.run_script("variant_shap.deepshap", args.num_shap, "variant_shap.py",
+                         shap_args + ["-o", os.path.join(out_dir, "shap")])
+        bench.run_script("variant_shap.grad_x_input", args.num_shap, "variant_shap.py",
+                         shap_args + ["-at", "grad_x_input", "-o", os.path.join(out_dir, "shap_grad")])
+        bench.run_script("variant_shap.grad_x_input.npz", args.num_shap, "variant_shap.py",
+                         shap_args + ["-at", "grad_x_input", "-of", "npz", "-o", os.path.join(out_dir, "shap_grad")])
+
+        # variant_ids are stored as deepdish stores unicode arrays, allele1 then allele2 regions
+        with h5py.File(os.path.join(out_dir, "shap_grad.variant_shap.counts.h5"), 'r') as f:
+            shap_ids = f['variant_ids'][:].view((np.str_, int(f['variant_ids'].attrs['itemsize'])))
+            shap_seqs = f['raw']['seq'][:]
+            shap_contribs = f['shap']['seq'][:]
+        num_explained = len(shap_ids) // 2
+        assert shap_ids[:num_explained].tolist() == shap_ids[num_explained:].tolist()
+        assert set(shap_ids) <= set(pd.read_table(shap_list, header=None)[4].astype(str))
+        # the streamed npz has the same regions as the h5
+        with np.load(os.path.join(out_dir, "shap_grad.variant_shap.counts.npz")) as npz:
+            assert np.array_equal(npz['sequences'], shap_seqs)
+            assert np.allclose(npz['contributions'], shap_contribs, atol=1e-3)
+
+    results = {'commit': get_commit(),
+               'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+               'config': vars(args),
+               'stages': bench.stages,
+               'speedups': bench.speedups([("validate_variants", "validate_variants.vectorized"),
+                                           ("predict", "predict.compiled"),
+                                           ("predict", "predict.xla"),
+                                           ("fetch_variant_predictions.keras_predict", "fetch_variant_predictions"),
+                                           ("fetch_variant_predictions", "fetch_variant_predictions.pool"),
+                                           ("fetch_variant_predictions", "fetch_variant_predictions.prediction_cache.warm")]),
+               'quantization_reports': quantization_reports,
+               'instrumented_stages': instrument.report()['stages']}
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("results written to", results_file)
+
+
+if __name__ == "__main__":
+    main()
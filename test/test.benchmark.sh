@@ -0,0 +1,14 @@
+#!/bin/bash
+
+set -e
+set -u
+set -o pipefail
+set -x
+
+mkdir -p output/benchmark
+
+python -u benchmark.py \
+  -o output/benchmark \
+  -nv 2000 \
+  -np 500 \
+  -bs 256
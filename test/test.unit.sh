@@ -0,0 +1,9 @@
+#!/bin/bash
+
+set -e
+set -u
+set -o pipefail
+set -x
+
+# small focused tests; the ones that need TensorFlow are skipped without it
+python -m pytest -q .
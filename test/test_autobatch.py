@@ -0,0 +1,47 @@
+"""
+Tests for batch size back-off. Out-of-memory errors are simulated with
+MemoryError, so TensorFlow is not needed.
+"""
+
+import numpy as np
+import pytest
+
+from utils import autobatch
+
+
+def fake_is_oom(error):
+    return isinstance(error, MemoryError)
+
+
+def make_head(batch_size):
+    def head(allele1_seqs, allele2_seqs, allele1_lengths, allele2_lengths):
+        if len(allele1_seqs) > 4:
+            raise MemoryError("synthetic out of memory")
+        return {'logfc': allele2_seqs.sum(axis=1) - allele1_seqs.sum(axis=1)}
+    return head
+
+
+def test_backoff_head_scores_the_batch_in_slices(monkeypatch):
+    monkeypatch.setattr(autobatch, "is_oom", fake_is_oom)
+    allele1_seqs = np.arange(20, dtype=np.float32).reshape(10, 2)
+    allele2_seqs = allele1_seqs * 3
+    lengths = np.ones(10, dtype=int)
+    head = autobatch.BackoffHead(make_head, 16)
+
+    scores = head(allele1_seqs, allele2_seqs, lengths, lengths)
+
+    assert head.batch_size == 4
+    assert np.array_equal(scores['logfc'], allele2_seqs.sum(axis=1) - allele1_seqs.sum(axis=1))
+
+
+def test_backoff_runner_raises_other_errors(monkeypatch):
+    monkeypatch.setattr(autobatch, "is_oom", fake_is_oom)
+    def make_runner(batch_size):
+        def run(seqs):
+            raise ValueError("not a memory error")
+        return run
+    runner = autobatch.BackoffRunner(make_runner, 16)
+
+    with pytest.raises(ValueError):
+        runner(np.zeros((10, 2)))
+    assert runner.batch_size == 16
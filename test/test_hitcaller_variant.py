@@ -0,0 +1,57 @@
+"""
+Tests for turning hit caller output into per-variant hit calls.
+"""
+
+import argparse
+import importlib.metadata
+
+import pandas as pd
+
+import hitcaller_variant
+
+
+def make_hits():
+    # two variants, so peak_ids 0-1 are allele1 regions and 2-3 allele2 regions
+    return pd.DataFrame({'peak_id': [0, 0, 0, 1, 2, 3],
+                         'chr': ['chr1', 'chr1', 'chr1', 'chr2', 'chr1', 'chr2'],
+                         'start': [990, 995, 1010, 1995, 996, 2010],
+                         'end': [1005, 1001, 1020, 2003, 1004, 2020],
+                         'motif_name': ['CTCF', 'SP1', 'AP1', 'CTCF', 'SP1', 'AP1'],
+                         'hit_coefficient': [0.5, 0.9, 2.0, 0.3, 0.4, 1.0],
+                         'hit_correlation': [0.8] * 6,
+                         'hit_importance': [1.0] * 6})
+
+
+def make_args(**kwargs):
+    args = dict(variant_file=None, window=100, hits_per_loc=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_hits_over_the_variant_in_genomic_coordinates(tmp_path):
+    variant_file = tmp_path / "variants.tsv"
+    variant_file.write_text("chr1\t1000\tA\tG\trs1\nchr2\t2000\tC\tT\trs2\n")
+
+    calls = hitcaller_variant.parse_hit_calls(make_args(variant_file=str(variant_file), hits_per_loc=1), make_hits())
+
+    assert calls['peak_id'].tolist() == [0, 1, 2]
+    assert calls['motif_name'].tolist() == ['SP1', 'CTCF', 'SP1']
+    assert calls['allele'].tolist() == ['allele1', 'allele1', 'allele2']
+    assert calls['variant_loc'].tolist() == [1000, 2000, 1000]
+
+
+def test_hits_over_the_window_centre_without_locations():
+    hits = make_hits().assign(start=[40, 45, 60, 0, 50, 51], end=[55, 51, 70, 10, 52, 60])
+
+    calls = hitcaller_variant.parse_hit_calls(make_args(), hits)
+
+    assert calls['peak_id'].tolist() == [0, 0, 2]
+    assert calls['hit_coefficient'].tolist() == [0.9, 0.5, 0.4]
+    assert set(calls['allele']) == {"N/A"}
+
+
+def test_in_process_hit_caller_needs_the_pinned_finemo(monkeypatch):
+    monkeypatch.setattr(importlib.metadata, "version", lambda name: hitcaller_variant.FINEMO_VERSION + ".2")
+    assert hitcaller_variant.load_finemo()
+    monkeypatch.setattr(importlib.metadata, "version", lambda name: "0.30")
+    assert not hitcaller_variant.load_finemo()
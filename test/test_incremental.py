@@ -0,0 +1,52 @@
+"""
+Tests for diffing and merging in incremental rescoring.
+"""
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import incremental
+
+
+def make_variants(positions):
+    return pd.DataFrame({'chr': 'chr1', 'pos': positions, 'allele1': 'A', 'allele2': 'G',
+                         'variant_id': ["rs%d" % x for x in positions]})
+
+
+def test_diff_and_merge_keep_list_order():
+    prior_scores = make_variants([100, 200, 300]).assign(logfc=[1.0, 2.0, 3.0])
+    variants_table = make_variants([300, 150, 100])
+
+    prior_rows = incremental.diff_variants(variants_table, prior_scores)
+    assert prior_rows.tolist() == [2, -1, 0]
+
+    new_scores = variants_table.loc[prior_rows < 0].assign(logfc=[9.0])
+    merged = incremental.merge_scores(variants_table, prior_scores, prior_rows, new_scores)
+    assert merged['variant_id'].tolist() == ['rs300', 'rs150', 'rs100']
+    assert merged['logfc'].tolist() == [3.0, 9.0, 1.0]
+
+
+def test_merge_predictions(tmp_path, monkeypatch):
+    monkeypatch.setattr(incremental, "MERGE_CHUNK_SIZE", 2)
+    prior_file = str(tmp_path / "prior.h5")
+    with h5py.File(prior_file, 'w') as f:
+        f.create_group('observed').create_dataset('allele1_pred_counts', data=np.array([[1.0], [2.0], [3.0]]))
+    prior_rows = np.array([2, -1, 0, 2, -1])
+    new_preds = {'allele1_pred_counts': np.array([[8.0], [9.0]])}
+
+    incremental.merge_predictions(prior_file, str(tmp_path / "out.h5"), prior_rows, new_preds, ['allele1_pred_counts'])
+
+    with h5py.File(tmp_path / "out.h5", 'r') as f:
+        assert f['observed']['allele1_pred_counts'][:, 0].tolist() == [3.0, 8.0, 1.0, 3.0, 9.0]
+
+
+def test_check_manifest():
+    prior = {'model': 'a', 'genome': 'g', 'schema': 'bed', 'hdf5': True, 'num_variants': 10}
+
+    incremental.check_manifest(prior, dict(prior, schema='chrombpnet', num_variants=20))
+    with pytest.raises(ValueError, match="model"):
+        incremental.check_manifest(prior, dict(prior, model='b'))
+    with pytest.raises(ValueError, match="variant_predictions.h5"):
+        incremental.check_manifest(dict(prior, hdf5=False), prior)
@@ -0,0 +1,32 @@
+"""
+Tests for stage instrumentation.
+"""
+
+import tracemalloc
+
+import numpy as np
+
+from utils import instrument
+
+
+def test_traced_stages_have_their_own_peak(monkeypatch):
+    monkeypatch.setattr(instrument, "tracemalloc_stages", {"all"})
+    monkeypatch.setattr(instrument, "stages", {})
+    monkeypatch.setattr(instrument, "tracemalloc_snapshots", {})
+
+    with instrument.stage("test.outer"):
+        with instrument.stage("test.big"):
+            big = np.ones(16 << 20, dtype=np.uint8)
+            del big
+        with instrument.stage("test.small"):
+            small = np.ones(1 << 20, dtype=np.uint8)
+            del small
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+
+    stats = instrument.stages
+    assert stats["test.big"]['traced_peak_mb'] >= 16
+    assert stats["test.small"]['traced_peak_mb'] < 8
+    # the outer stage still sees the peak of the nested stage that reset it
+    assert stats["test.outer"]['traced_peak_mb'] >= 16
+    assert stats["test.outer"]['process_peak_rss_mb'] > 0
@@ -0,0 +1,78 @@
+"""
+Tests for the persistent prediction cache, with a stand-in for the model.
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils import prediction_cache
+
+
+PROFILE_LEN = 8
+
+
+class FakePredict:
+    # fetch_variant_predictions outputs that depend only on the variant, in float16 like a quantized model
+    def __init__(self, counts_only=False):
+        self.counts_only = counts_only
+        self.num_predicted = 0
+
+    def __call__(self, variants_table):
+        self.num_predicted += len(variants_table)
+        pos = variants_table['pos'].to_numpy(dtype=np.float16)[:, None]
+        profiles = pos / 1000 + np.arange(PROFILE_LEN, dtype=np.float16)[None, :]
+        return (np.array(variants_table['variant_id'].tolist()), pos / 100, pos / 50,
+                None if self.counts_only else profiles, None if self.counts_only else -profiles)
+
+
+def make_variants(positions):
+    return pd.DataFrame({'chr': 'chr1', 'pos': positions, 'allele1': 'A', 'allele2': 'G',
+                         'variant_id': ["rs%d" % x for x in positions]})
+
+
+def make_cache(tmp_path):
+    model_file = tmp_path / "model.h5"
+    model_file.write_bytes(b"weights")
+    genome = tmp_path / "genome.fa"
+    genome.write_text(">chr1\nACGT\n")
+    return prediction_cache.PredictionCache(str(tmp_path / "cache"), str(model_file), str(genome), 2114)
+
+
+def test_hits_match_predictions(tmp_path, monkeypatch):
+    # small lookup chunks, so hits are filled in over several chunks
+    monkeypatch.setattr(prediction_cache, "LOOKUP_CHUNK_SIZE", 3)
+    cache = make_cache(tmp_path)
+    predict = FakePredict()
+    expected = predict(make_variants(list(range(100, 1100, 100))))
+
+    cache.fetch(make_variants([100, 300, 500, 700]), predict)
+    predict.num_predicted = 0
+    outputs = cache.fetch(make_variants(list(range(100, 1100, 100))), predict)
+
+    assert predict.num_predicted == 6
+    assert (cache.hits, cache.misses) == (4, 10)
+    assert np.array_equal(outputs[0], expected[0])
+    for output, expected_output in zip(outputs[1:], expected[1:]):
+        assert output.dtype == np.float16
+        assert np.array_equal(output, expected_output)
+
+
+def test_counts_only_entries_do_not_serve_profiles(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.fetch(make_variants([100, 200]), FakePredict(counts_only=True), counts_only=True)
+
+    predict = FakePredict()
+    outputs = cache.fetch(make_variants([100, 200]), predict)
+
+    assert predict.num_predicted == 2
+    assert outputs[3].shape == (2, PROFILE_LEN)
+
+
+def test_profiles_go_to_profile_dir(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.fetch(make_variants([100, 200]), FakePredict())
+
+    outputs = cache.fetch(make_variants([100, 200, 300]), FakePredict(), profile_dir=str(tmp_path / "profiles"))
+
+    assert isinstance(outputs[3], np.memmap)
+    assert np.array_equal(outputs[3], FakePredict()(make_variants([100, 200, 300]))[3])
@@ -0,0 +1,50 @@
+"""
+Tests for the indexed score store. They need pysam but not TensorFlow.
+"""
+
+import pandas as pd
+
+from utils import score_store
+
+
+def write_scores(path):
+    table = pd.DataFrame({'chr': ['chr1', 'chr1', 'chr2', 'chr2'],
+                          'pos': [100, 200, 50, 300],
+                          'allele1': ['A', 'C', 'G', 'T'],
+                          'allele2': ['G', 'T', 'A', 'C'],
+                          'variant_id': ['rs1', 'rs2', 'rs3', 'rs4'],
+                          'logfc': [0.5, -1.0, 2.0, 0.0]})
+    table.to_csv(path, sep='\t', index=False)
+    return table
+
+
+def test_query_ids_returns_every_id_in_order(tmp_path):
+    table = write_scores(tmp_path / "scores.tsv")
+    store = score_store.build_store([str(tmp_path / "scores.tsv")], str(tmp_path / "scores.variant_scores.tsv.gz"))
+
+    result = score_store.query(store, variant_ids=['rs3', 'rs2', 'rs4', 'missing'])
+
+    expected = table.set_index('variant_id').loc[['rs3', 'rs2', 'rs4']].reset_index()[table.columns]
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_query_regions_matches_ids(tmp_path):
+    write_scores(tmp_path / "scores.tsv")
+    store = score_store.build_store([str(tmp_path / "scores.tsv")], str(tmp_path / "scores.variant_scores.tsv.gz"))
+
+    by_region = score_store.query(store, regions=['chr1:1-1000', 'chr2:250-350'])
+    by_id = score_store.query(store, variant_ids=['rs1', 'rs2', 'rs4'])
+
+    pd.testing.assert_frame_equal(by_region, by_id)
+
+
+def test_build_store_merges_tables(tmp_path):
+    table = write_scores(tmp_path / "scores.tsv")
+    table.iloc[:2].to_csv(tmp_path / "a.tsv", sep='\t', index=False)
+    table.iloc[2:].to_csv(tmp_path / "b.tsv", sep='\t', index=False)
+    store = score_store.build_store([str(tmp_path / "b.tsv"), str(tmp_path / "a.tsv")],
+                                    str(tmp_path / "merged.variant_scores.tsv.gz"))
+
+    result = score_store.query(store, variant_ids=list(table['variant_id']))
+
+    pd.testing.assert_frame_equal(result, table, check_dtype=False)
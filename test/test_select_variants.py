@@ -0,0 +1,39 @@
+"""
+Tests for picking variants from a score table for attribution.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.helpers import select_variants
+
+
+def make_scores():
+    return pd.DataFrame({'chr': ['chr1', 'chr1', 'chr2', 'chr2', 'chr2'],
+                         'variant_id': ['a', 'b', 'c', 'd', 'e'],
+                         'logfc': [0.5, 3.0, -1.0, np.nan, 2.0],
+                         'logfc.pval': [0.5, 0.001, 0.2, 0.01, 0.05]})
+
+
+def test_top_k_keeps_file_order():
+    assert select_variants(make_scores(), 'logfc', top_k=2)['variant_id'].tolist() == ['b', 'e']
+
+
+def test_top_k_of_pvalues_takes_the_smallest():
+    assert select_variants(make_scores(), 'logfc.pval', top_k=2)['variant_id'].tolist() == ['b', 'd']
+
+
+def test_top_k_per_chrom():
+    selected = select_variants(make_scores(), 'logfc', top_k=1, per_chrom=True)
+    assert selected['variant_id'].tolist() == ['b', 'e']
+
+
+def test_range_drops_missing_scores():
+    selected = select_variants(make_scores(), 'logfc', select_min=-1.0, select_max=2.0)
+    assert selected['variant_id'].tolist() == ['a', 'c', 'e']
+
+
+def test_unknown_column():
+    with pytest.raises(ValueError, match="not_a_column"):
+        select_variants(make_scores(), 'not_a_column', top_k=1)
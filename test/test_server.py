@@ -0,0 +1,69 @@
+"""
+Tests for the micro-batching server. They use a stand-in session, so no
+model or TensorFlow is needed.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from utils import server
+
+
+class FakeSession:
+    # fails any batch holding a variant on chrBad, like a reference allele mismatch would
+    def __init__(self):
+        self.batch_sizes = []
+
+    def score(self, variants_table):
+        self.batch_sizes.append(len(variants_table))
+        if (variants_table['chr'] == 'chrBad').any():
+            raise ValueError("reference allele mismatch")
+        return variants_table.assign(logfc=variants_table['pos'] / 1000)
+
+
+def request_table(chrom, positions):
+    return pd.DataFrame({'chr': chrom, 'pos': positions, 'allele1': 'A', 'allele2': 'G',
+                         'variant_id': ["%s_%d" % (chrom, x) for x in positions]})
+
+
+def test_score_batch_splits_by_request():
+    session = FakeSession()
+    tables = [request_table('chr1', [100, 200]), request_table('chr2', [300])]
+
+    results = server.score_batch(session, tables)
+
+    assert session.batch_sizes == [3]
+    assert [x[0]['variant_id'].tolist() for x in results] == [['chr1_100', 'chr1_200'], ['chr2_300']]
+    assert [x[1] for x in results] == [0, 0]
+
+
+def test_failed_batch_only_fails_bad_request():
+    session = FakeSession()
+    tables = [request_table('chr1', [100]), request_table('chrBad', [200]), request_table('chr2', [300])]
+
+    results = server.score_batch(session, tables)
+
+    assert session.batch_sizes == [3, 1, 1, 1]
+    assert results[0][0]['logfc'].tolist() == [0.1]
+    assert isinstance(results[1], ValueError)
+    assert results[2][0]['logfc'].tolist() == [0.3]
+
+
+def test_batcher_sets_errors_per_request():
+    async def main():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            batcher = server.MicroBatcher(FakeSession(), executor, max_batch=100, max_latency=0.05)
+            batcher.queue = asyncio.Queue()
+            worker = asyncio.ensure_future(batcher.run())
+            try:
+                return await asyncio.gather(batcher.submit(request_table('chr1', [100])),
+                                            batcher.submit(request_table('chrBad', [200])),
+                                            return_exceptions=True)
+            finally:
+                worker.cancel()
+
+    good, bad = asyncio.run(main())
+    assert good[0]['variant_id'].tolist() == ['chr1_100']
+    assert isinstance(bad, ValueError)
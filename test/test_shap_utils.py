@@ -0,0 +1,34 @@
+"""
+Tests for combining attributions across models. They need the SHAP
+dependencies (TensorFlow, shap, deeplift) and are skipped without them.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("shap")
+pytest.importorskip("deeplift")
+
+from utils import shap_utils
+
+
+class ConstantExplainer:
+    def __init__(self, value):
+        self.value = value
+
+    def shap_values(self, seqs, progress_message=None):
+        return np.full(seqs.shape, self.value, dtype=np.float32)
+
+
+def test_explain_chunk_keeps_folds_apart_from_mean():
+    seqs = np.zeros((3, 10, 4), dtype=np.float32)
+    explainers = {'counts': [ConstantExplainer(1.0), ConstantExplainer(3.0), ConstantExplainer(5.0)]}
+
+    outputs = shap_utils.explain_chunk(None, seqs, explainers, save_folds=True)
+
+    assert np.allclose(outputs['counts.fold_0'], 1.0)
+    assert np.allclose(outputs['counts.fold_1'], 3.0)
+    assert np.allclose(outputs['counts.fold_2'], 5.0)
+    assert np.allclose(outputs['counts'], 3.0)
+    assert not np.shares_memory(outputs['counts'], outputs['counts.fold_0'])
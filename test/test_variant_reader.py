@@ -0,0 +1,72 @@
+"""
+Tests for the streaming variant list reader.
+"""
+
+import gzip
+
+import numpy as np
+import pandas as pd
+
+from utils import variant_reader
+
+
+VCF = """##fileformat=VCFv4.2
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+1\t100\trs1\tA\tG\t.\t.\t.
+1\t200\t.\tC\tT\t.\t.\t.
+2\t300\trs3\tG\tA,T\t.\t.\t.
+2\t400\trs4\tT\t<DEL>\t.\t.\t.
+2\t500\trs5\tT\t*\t.\t.\t.
+"""
+
+
+def test_vcf_records_become_one_row_per_alt(tmp_path):
+    path = tmp_path / "variants.vcf.gz"
+    with gzip.open(path, 'wt') as f:
+        f.write(VCF)
+
+    table = variant_reader.read_variant_table(str(path), "vcf")
+
+    assert table['chr'].tolist() == ['chr1', 'chr1', 'chr2', 'chr2']
+    assert table['pos'].tolist() == [100, 200, 300, 300]
+    assert table['pos'].dtype == np.int64
+    assert table['allele2'].tolist() == ['G', 'T', 'A', 'T']
+    assert table['variant_id'].tolist() == ['rs1', 'chr1:200:C:T', 'rs3:A', 'rs3:T']
+
+
+def test_chunks_match_whole_table(tmp_path):
+    path = tmp_path / "variants.tsv"
+    rows = pd.DataFrame({'chr': ['chr1'] * 5 + ['chr2'] * 5, 'pos': np.arange(1, 11) * 100,
+                         'allele1': 'A', 'allele2': ['G', '', 'T', 'C', 'G', 'A', 'T', '', 'C', 'G'],
+                         'variant_id': ["rs%d" % x for x in range(10)]})
+    rows.to_csv(path, sep='\t', header=False, index=False)
+
+    chunks = list(variant_reader.read_variant_chunks(str(path), "chrombpnet", chunk_size=3))
+    table = variant_reader.read_variant_table(str(path), "chrombpnet")
+
+    assert [len(x) for x in chunks] == [3, 3, 3, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), table)
+    assert table['allele2'].tolist()[1] == '-'
+    assert variant_reader.read_variant_table(str(path), "chrombpnet", chrom="chr2")['variant_id'].tolist() == \
+        ["rs%d" % x for x in range(5, 10)]
+
+
+def test_bed_positions_are_one_based(tmp_path):
+    path = tmp_path / "variants.bed"
+    path.write_text("1\t99\t100\tA\tG\trs1\n")
+
+    table = variant_reader.read_variant_table(str(path), "bed")
+
+    assert table[['chr', 'pos', 'variant_id']].values.tolist() == [['chr1', 100, 'rs1']]
+
+
+def test_region_reads_indexed_records(tmp_path):
+    import pysam
+
+    path = tmp_path / "variants.vcf"
+    path.write_text(VCF)
+    indexed = pysam.tabix_index(str(path), preset="vcf", force=True)
+
+    table = variant_reader.read_variant_table(indexed, "vcf", region="2:250-350,chrUn")
+
+    assert table['variant_id'].tolist() == ['rs3:A', 'rs3:T']
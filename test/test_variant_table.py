@@ -0,0 +1,50 @@
+"""
+Tests for compact variant tables, validation and the prepared-input cache.
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils import variant_table
+
+
+CHROM_SIZES = {'chr1': 10000, 'chr2': 5000}
+
+
+def make_variants():
+    return pd.DataFrame({'chr': ['chr1', 'chr1', 'chr2', 'chrUn', 'chr2'],
+                         'pos': [5000, 10, 4990, 100, 2500],
+                         'allele1': ['A', 'C', None, 'G', 'T'],
+                         'allele2': ['G', None, 'A', 'T', 'C'],
+                         'variant_id': ['ok1', 'left', 'right', 'unknown', 'ok2']})
+
+
+def test_validate_variants_counts_drops_per_reason():
+    valid, drop_counts = variant_table.validate_variants(make_variants(), 1000, CHROM_SIZES)
+
+    assert valid['variant_id'].tolist() == ['ok1', 'ok2']
+    assert drop_counts == {'unknown_chrom': 1, 'left_edge': 1, 'right_edge': 1}
+
+
+def test_compact_table_validates_the_same():
+    compact = variant_table.compact_variant_table(make_variants())
+
+    assert isinstance(compact['chr'].dtype, pd.CategoricalDtype)
+    assert compact['pos'].dtype == np.int32
+    assert compact['allele2'].tolist()[1] == '-'
+    valid, drop_counts = variant_table.validate_variants(compact, 1000, CHROM_SIZES)
+    assert valid['variant_id'].tolist() == ['ok1', 'ok2']
+    assert drop_counts == {'unknown_chrom': 1, 'left_edge': 1, 'right_edge': 1}
+
+
+def test_prepared_tables_round_trip(tmp_path):
+    variants_file = tmp_path / "variants.tsv"
+    make_variants().to_csv(variants_file, sep='\t', header=False, index=False)
+    key = variant_table.prepared_key(str(variants_file), "chrombpnet", 1000, CHROM_SIZES)
+    cache_dir = str(tmp_path / "cache")
+
+    assert variant_table.load_prepared(cache_dir, key) is None
+    compact = variant_table.compact_variant_table(make_variants())
+    variant_table.save_prepared(compact, cache_dir, key)
+    pd.testing.assert_frame_equal(variant_table.load_prepared(cache_dir, key), compact)
+    assert variant_table.prepared_key(str(variants_file), "chrombpnet", 2114, CHROM_SIZES) != key